@@ -0,0 +1,433 @@
+'''
+Zip helpers shared by the download scripts.
+
+rewrite_zip_members() renames and filters the members of a downloaded submissions zip
+without extracting it: each member's compressed bytes are copied as-is into the new
+archive, so nothing is inflated, deflated, or written to a temporary folder.
+A MemberFilter drops members by file extension while the central directory is
+read, so their bytes are never read or written at all.
+
+IncrementalZipArchive builds downloads.zip one finished assignment (or course) at a
+time. Every append opens the archive once, streams its files in and ends with a
+complete central directory on disk, so an interrupted run still leaves a valid
+archive of everything finished so far. Adding a name that is already in the
+archive supersedes the old copy, and compact() drops the superseded copies.
+Given an executor, it deflates the files of each append in parallel
+(deflate_file()) and only writes the compressed bytes in order, instead of
+compressing one file after the other on the writing thread. That pays off for
+gradescope_downloader.py, which archives the extracted files; the D2L scripts
+add assignment zips, which are stored as they are and need no executor.
+
+write_tar_zst() is the other output format: one tar stream compressed with
+multi-threaded zstd, written at the end of a run. Assignment zips are unpacked
+into it, so zstd sees the submitted files themselves and the long-distance
+matching finds what many students' files have in common. It needs the
+zstandard package, which the zip format doesn't.
+'''
+
+import os
+import struct
+import tarfile
+import threading
+import time
+import warnings
+import zipfile
+import zlib
+from collections import deque
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+copy_chunk_size = 1024 * 1024
+# bigger files are deflated on the writing thread instead of being held in memory on the executor
+parallel_compression_limit = 64 * 1024 * 1024
+
+# offsets into the local file header, see the zip specification (APPNOTE.TXT 4.3.7)
+_local_header_size = struct.calcsize(zipfile.structFileHeader)
+_local_header_flags = 3
+_local_header_compression = 4
+_local_header_time = 5
+_local_header_date = 6
+_local_header_crc = 7
+_local_header_compressed_size = 8
+_local_header_file_size = 9
+_local_header_name_length = 10
+_local_header_extra_length = 11
+_zip64_extra_id = 0x0001
+
+# bit 3 means sizes/CRC follow the data in a descriptor, bit 11 means a UTF-8 name (recomputed from the new name)
+_data_descriptor_flag = 0x08
+_utf8_name_flag = 0x800
+
+
+def _member_data_offset(source, info):
+    # the local header can have a different extra field than the central directory, so read it
+    source.fp.seek(info.header_offset)
+    header = struct.unpack(zipfile.structFileHeader, source.fp.read(_local_header_size))
+    if header[0] != zipfile.stringFileHeader:
+        raise zipfile.BadZipFile(f"Bad local file header for {info.filename}")
+    return info.header_offset + _local_header_size + header[_local_header_name_length] + header[_local_header_extra_length]
+
+
+def _register_member(destination, new_info):
+    # register the member the same way ZipFile.write() does so close() writes the central directory
+    destination.filelist.append(new_info)
+    destination.NameToInfo[new_info.filename] = new_info
+    destination.start_dir = destination.fp.tell()
+    destination._didModify = True
+
+
+def deflate_bytes(data, level=zlib.Z_DEFAULT_COMPRESSION):
+    # (raw deflate stream, CRC-32, size) of data, what zipfile would write for it with ZIP_DEFLATED
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    return compressor.compress(data) + compressor.flush(), zlib.crc32(data), len(data)
+
+
+def deflate_file(file_path, level=zlib.Z_DEFAULT_COMPRESSION):
+    # deflate_bytes() of a file, for an executor; zlib releases the GIL, so a thread pool uses every core as well
+    with open(file_path, 'rb') as file:
+        return deflate_bytes(file.read(), level)
+
+
+def write_deflated_member(destination, new_info, deflated):
+    # appends a member whose data was compressed elsewhere, deflated being what deflate_bytes() returned
+    data, new_info.CRC, new_info.file_size = deflated
+    new_info.compress_type = zipfile.ZIP_DEFLATED
+    new_info.compress_size = len(data)
+    new_info.header_offset = destination.fp.tell()
+    destination.fp.write(new_info.FileHeader())
+    destination.fp.write(data)
+    _register_member(destination, new_info)
+    return new_info
+
+
+def copy_raw_member(source, info, destination, new_name):
+    # copy one member's compressed bytes from source into destination under new_name
+    new_info = zipfile.ZipInfo(new_name, date_time=info.date_time)
+    new_info.compress_type = info.compress_type
+    new_info.flag_bits = info.flag_bits & ~(_data_descriptor_flag | _utf8_name_flag)
+    new_info.CRC = info.CRC
+    new_info.compress_size = info.compress_size
+    new_info.file_size = info.file_size
+    new_info.create_system = info.create_system
+    new_info.external_attr = info.external_attr
+    new_info.comment = info.comment
+
+    data_offset = _member_data_offset(source, info)
+    new_info.header_offset = destination.fp.tell()
+    destination.fp.write(new_info.FileHeader())
+
+    source.fp.seek(data_offset)
+    remaining = info.compress_size
+    while remaining > 0:
+        chunk = source.fp.read(min(copy_chunk_size, remaining))
+        if not chunk:
+            raise zipfile.BadZipFile(f"Truncated data for {info.filename}")
+        destination.fp.write(chunk)
+        remaining -= len(chunk)
+
+    _register_member(destination, new_info)
+    return new_info
+
+
+class MemberFilter:
+    # Keeps only members whose extension is allowed. The suffixes go into a set once, so each member costs one
+    # lookup, and the skipped members and their compressed bytes are counted for the whole run.
+
+    def __init__(self, allowed_extensions):
+        self.allowed_suffixes = frozenset(extension.lower() for extension in allowed_extensions)
+        self.lock = threading.Lock()
+        self.kept_members = 0
+        self.kept_bytes = 0
+        self.skipped_members = 0
+        self.skipped_bytes = 0
+
+    def allows(self, info):
+        # folder entries are kept, the files in them are filtered one by one
+        allowed = info.is_dir() or os.path.splitext(info.filename)[1].lower() in self.allowed_suffixes
+        with self.lock:
+            if allowed:
+                self.kept_members += 1
+                self.kept_bytes += info.compress_size
+            else:
+                self.skipped_members += 1
+                self.skipped_bytes += info.compress_size
+        return allowed
+
+    def summary(self):
+        with self.lock:
+            return {'kept_members': self.kept_members, 'kept_bytes': self.kept_bytes,
+                    'skipped_members': self.skipped_members, 'skipped_bytes': self.skipped_bytes}
+
+    def print_report(self):
+        total = self.kept_bytes + self.skipped_bytes
+        print(f"Extension filter: kept {self.kept_members} files ({self.kept_bytes / 1e6:.1f} MB), "
+              f"skipped {self.skipped_members} files ({self.skipped_bytes / 1e6:.1f} MB, "
+              f"{self.skipped_bytes / total * 100 if total else 0:.0f}% of the downloaded bytes)")
+
+
+def rewrite_zip_members(source_path, destination_path, rename, excluded_names=('index.html',), member_filter=None):
+    # rename(top_level_name) returns the new top-level name, or None to drop that entry.
+    # It is called once per top-level file/folder, so every member of a submitted folder shares one new name.
+    # Members member_filter doesn't allow are skipped before rename sees them.
+    renamed = {}
+    written = 0
+    with zipfile.ZipFile(source_path) as source, zipfile.ZipFile(destination_path, 'w') as destination:
+        for info in source.infolist():
+            top_level, separator, rest = info.filename.partition('/')
+            if top_level in excluded_names:
+                continue
+            if member_filter is not None and not member_filter.allows(info):
+                continue
+            if top_level not in renamed:
+                renamed[top_level] = rename(top_level)
+            if renamed[top_level] is None:
+                continue
+            copy_raw_member(source, info, destination, renamed[top_level] + separator + rest)
+            written += 1
+    return written
+
+
+# members with these suffixes are already compressed, deflating them again only burns CPU
+already_compressed_suffixes = {
+    '.zip', '.jar', '.gz', '.tgz', '.bz2', '.xz', '.zst', '.7z', '.rar',
+    '.png', '.jpg', '.jpeg', '.gif', '.webp', '.mp3', '.mp4', '.mov', '.avi',
+    '.pdf', '.docx', '.xlsx', '.pptx',
+}
+
+
+def compress_type_for(file_name):
+    if os.path.splitext(file_name)[1].lower() in already_compressed_suffixes:
+        return zipfile.ZIP_STORED
+    return zipfile.ZIP_DEFLATED
+
+
+def _read_local_entries(fp, file_length):
+    # walk the local file headers from the start of the file and yield every member that was fully written
+    offset = 0
+    while offset + _local_header_size <= file_length:
+        fp.seek(offset)
+        header = struct.unpack(zipfile.structFileHeader, fp.read(_local_header_size))
+        if header[0] != zipfile.stringFileHeader or header[_local_header_flags] & _data_descriptor_flag:
+            return
+        name = fp.read(header[_local_header_name_length])
+        extra = fp.read(header[_local_header_extra_length])
+        compress_size = header[_local_header_compressed_size]
+        file_size = header[_local_header_file_size]
+        position = 0
+        while position + 4 <= len(extra):
+            extra_id, extra_length = struct.unpack('<HH', extra[position:position + 4])
+            if extra_id == _zip64_extra_id and extra_length >= 16:
+                # zip64 sizes replace the 0xFFFFFFFF placeholders in the fixed header
+                file_size, compress_size = struct.unpack('<QQ', extra[position + 4:position + 20])
+            position += 4 + extra_length
+        data_end = offset + _local_header_size + len(name) + len(extra) + compress_size
+        # zipfile writes a header with compress_size 0 first and fixes it up once the data is written
+        if data_end > file_length or (compress_size == 0 and file_size != 0):
+            return
+
+        if header[_local_header_flags] & _utf8_name_flag:
+            name = name.decode('utf-8')
+        else:
+            name = name.decode('cp437')
+        date, time = header[_local_header_date], header[_local_header_time]
+        info = zipfile.ZipInfo(name, date_time=((date >> 9) + 1980, (date >> 5) & 0xF, date & 0x1F,
+                                                time >> 11, (time >> 5) & 0x3F, (time & 0x1F) * 2))
+        info.flag_bits = header[_local_header_flags] & ~_utf8_name_flag
+        info.compress_type = header[_local_header_compression]
+        info.CRC = header[_local_header_crc]
+        info.compress_size = compress_size
+        info.file_size = file_size
+        info.header_offset = offset
+        info.external_attr = 0o644 << 16
+        yield info, data_end
+        offset = data_end
+
+
+def recover_zip(zip_path):
+    # Rebuilds the central directory of a zip whose writer was killed mid-append.
+    # Members that were fully written are kept, anything after them is cut off.
+    # Returns the number of members in the recovered archive.
+    with open(zip_path, 'r+b') as fp:
+        file_length = fp.seek(0, 2)
+        recovered = []
+        good_length = 0
+        for info, data_end in _read_local_entries(fp, file_length):
+            recovered.append(info)
+            good_length = data_end
+
+        # an intact archive lists exactly the members found by walking it. Checking only that it opens isn't
+        # enough: a run killed right after storing an inner zip leaves a file that ends with that zip's directory
+        try:
+            with zipfile.ZipFile(fp) as zipf:
+                if [(info.filename, info.header_offset) for info in zipf.infolist()] == \
+                        [(info.filename, info.header_offset) for info in recovered]:
+                    return len(recovered)
+        except zipfile.BadZipFile:
+            pass
+
+        fp.seek(good_length)
+        fp.truncate()
+        with zipfile.ZipFile(fp, 'w') as zipf:
+            for info in recovered:
+                zipf.filelist.append(info)
+                zipf.NameToInfo[info.filename] = info
+    print(f"Recovered {len(recovered)} members of interrupted archive {zip_path}")
+    return len(recovered)
+
+
+class IncrementalZipArchive:
+
+    def __init__(self, zip_path, executor=None, max_pending=32):
+        # executor (a process or thread pool) deflates the files of add_files() in parallel, max_pending at a time
+        self.zip_path = zip_path
+        self.executor = executor
+        self.max_pending = max_pending
+        self.lock = threading.Lock()
+        self.superseded = False
+        if os.path.isfile(zip_path):
+            recover_zip(zip_path)
+            # an earlier run may have been interrupted before it could compact
+            with zipfile.ZipFile(zip_path) as zipf:
+                names = zipf.namelist()
+            self.superseded = len(names) != len(set(names))
+        else:
+            with zipfile.ZipFile(zip_path, 'w'):
+                pass
+
+    def add_file(self, file_path, arcname):
+        # safe to call from several download workers, appends are serialized
+        self.add_files([(file_path, arcname)])
+
+    def add_folder(self, folder_path, root_path):
+        # every file under folder_path, named by its path relative to root_path
+        files = []
+        for root, dirs, names in os.walk(folder_path):
+            dirs.sort()
+            for name in sorted(names):
+                file_path = os.path.join(root, name)
+                files.append((file_path, os.path.relpath(file_path, root_path)))
+        self.add_files(files)
+
+    def add_files(self, files):
+        # appends (file_path, arcname) pairs in one go: the archive is opened and its central directory
+        # written once for all of them, and if one fails none of them are kept
+        with self.lock, open(self.zip_path, 'r+b') as fp:
+            start_dir = None
+            try:
+                with zipfile.ZipFile(fp, 'a') as zipf:
+                    # keep the current central directory so a failed append can be rolled back
+                    start_dir = zipf.start_dir
+                    fp.seek(start_dir)
+                    directory = fp.read()
+                    fp.seek(start_dir)
+                    with warnings.catch_warnings():
+                        warnings.filterwarnings('ignore', 'Duplicate name', UserWarning)
+                        for file_path, arcname, deflated in self._compressed(files):
+                            if arcname.replace(os.sep, '/') in zipf.NameToInfo:
+                                self.superseded = True
+                            if deflated is None:
+                                zipf.write(file_path, arcname, compress_type=compress_type_for(file_path))
+                            else:
+                                write_deflated_member(zipf, zipfile.ZipInfo.from_file(file_path, arcname), deflated.result())
+            except BaseException:
+                if start_dir is None:
+                    raise
+                # put the old directory back over the members written so far
+                fp.seek(start_dir)
+                fp.write(directory)
+                fp.truncate()
+                raise
+            finally:
+                fp.flush()
+                os.fsync(fp.fileno())
+
+    def _compressed(self, files):
+        # yields (file_path, arcname, future of deflate_file() or None) in order, keeping up to max_pending
+        # files compressing on the executor; None is for what is written as it is or too big to hold in memory
+        pending = deque()
+        for file_path, arcname in files:
+            deflated = None
+            if self.executor is not None and compress_type_for(file_path) == zipfile.ZIP_DEFLATED \
+                    and os.path.getsize(file_path) <= parallel_compression_limit:
+                deflated = self.executor.submit(deflate_file, file_path)
+            pending.append((file_path, arcname, deflated))
+            if len(pending) >= self.max_pending:
+                yield pending.popleft()
+        while pending:
+            yield pending.popleft()
+
+    def compact(self, keep=None):
+        # Rewrites the archive with only the newest copy of each name, copying the compressed bytes as-is.
+        # keep(name) can drop more members, e.g. the old files of a folder that was downloaded again under new names
+        with self.lock:
+            if keep is not None:
+                with zipfile.ZipFile(self.zip_path) as source:
+                    if not all(keep(name) for name in source.namelist()):
+                        self.superseded = True
+            if not self.superseded:
+                return
+            temp_path = f'{self.zip_path}.tmp'
+            with zipfile.ZipFile(self.zip_path) as source, zipfile.ZipFile(temp_path, 'w') as destination:
+                newest = {info.filename: info for info in source.infolist()}
+                for info in source.infolist():
+                    if newest[info.filename] is info and (keep is None or keep(info.filename)):
+                        copy_raw_member(source, info, destination, info.filename)
+            with open(temp_path, 'r+b') as fp:
+                os.fsync(fp.fileno())
+            os.replace(temp_path, self.zip_path)
+            self.superseded = False
+
+
+def _add_zip_members(tar, zip_path, prefix):
+    # every file in the zip as prefix/<member name>, streamed from the zip into the tar
+    total = 0
+    with zipfile.ZipFile(zip_path) as zipf:
+        for info in zipf.infolist():
+            # member names come from students, never let one leave its folder
+            parts = [part for part in info.filename.split('/') if part not in ('', '.', '..')]
+            if info.is_dir() or not parts:
+                continue
+            member = tarfile.TarInfo('/'.join([prefix] + parts))
+            member.size = info.file_size
+            member.mtime = int(time.mktime(info.date_time + (0, 0, -1)))
+            member.mode = 0o644
+            with zipf.open(info) as source:
+                tar.addfile(member, source)
+            total += info.file_size
+    return total
+
+
+def tar_zst_available():
+    return zstandard is not None
+
+
+def write_tar_zst(folder_path, archive_path, level=10, threads=-1, expand_zips=True):
+    # Writes every file under folder_path, named by its path relative to folder_path, into a zstd-compressed tar.
+    # With expand_zips a zip's members go in under <zip name without .zip>/ instead of the zip itself.
+    # threads=-1 compresses on every core. Returns (bytes put into the tar, bytes of the archive).
+    if zstandard is None:
+        raise RuntimeError("The tar.zst format needs the zstandard package: pip install zstandard")
+    parameters = zstandard.ZstdCompressionParameters.from_level(level, threads=threads, enable_ldm=True)
+    compressor = zstandard.ZstdCompressor(compression_params=parameters)
+    temp_path = f'{archive_path}.tmp'
+    bytes_in = 0
+    with open(temp_path, 'wb') as raw:
+        with compressor.stream_writer(raw, closefd=False) as writer, \
+                tarfile.open(fileobj=writer, mode='w|', format=tarfile.PAX_FORMAT) as tar:
+            for root, dirs, names in os.walk(folder_path):
+                dirs.sort()
+                for name in sorted(names):
+                    file_path = os.path.join(root, name)
+                    arcname = os.path.relpath(file_path, folder_path).replace(os.sep, '/')
+                    if expand_zips and name.lower().endswith('.zip'):
+                        bytes_in += _add_zip_members(tar, file_path, arcname[:-len('.zip')])
+                    else:
+                        tar.add(file_path, arcname, recursive=False)
+                        bytes_in += os.path.getsize(file_path)
+        raw.flush()
+        os.fsync(raw.fileno())
+    os.replace(temp_path, archive_path)
+    return bytes_in, os.path.getsize(archive_path)
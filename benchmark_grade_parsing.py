@@ -0,0 +1,105 @@
+'''
+Benchmark of the grade page parsers in grade_parsers.py against the BeautifulSoup versions.
+
+Save a few real pages in the browser (right click, "Save as", "Webpage, HTML only")
+into one folder, named after the page they are:
+    *.grade_item_edit.html    Augusta's grade_item_edit.d2l page
+    *.folio_grade_item_edit.html    Georgia Southern's grade_item_edit.d2l page
+    *.review_grades.html    Gradescope's review_grades page
+and run
+    python benchmark_grade_parsing.py <folder>
+Without a folder, synthetic pages shaped like the real ones are generated instead.
+Each page is parsed both ways, the results are compared, and the average time is printed.
+'''
+
+import sys
+from pathlib import Path
+from time import perf_counter
+
+from grade_parsers import (parse_d2l_grades, parse_d2l_grades_soup, parse_folio_grades, parse_folio_grades_soup,
+                           parse_review_grades, parse_review_grades_soup)
+
+parsers = {
+    '.folio_grade_item_edit.html': (parse_folio_grades, parse_folio_grades_soup),
+    '.grade_item_edit.html': (parse_d2l_grades, parse_d2l_grades_soup),
+    '.review_grades.html': (parse_review_grades, parse_review_grades_soup),
+}
+repeats = 20
+
+
+def synthetic_grade_item_edit(students, folio=False):
+    # a page padded with navigation markup like the real one, around table#z_p with one row per student
+    rows = []
+    for student in range(students):
+        user_id = 100000 + student
+        if folio:
+            grade_cell = ''.join(f'<input type="hidden" name="f{field}_{user_id}" value="{field}">' for field in range(3)) + \
+                         f'<input type="text" name="grade_{user_id}" value="{student % 101}">'
+        else:
+            grade_cell = f'<d2l-input-number label="Grade" value="{student % 101}" max-fraction-digits="2"></d2l-input-number>'
+        rows.append(f'<tr class="d_ggl2"><th scope="row"><input type="checkbox" name="gridUsers_cb" value="u_{user_id}">'
+                    f'<a class="d2l-link" href="/d2l/lms/user/{user_id}" title="Student &amp; {student}">Student, Number {student}</a></th>'
+                    f'<td><div class="d2l-grades-cell">{grade_cell}</div></td><td><span>Feedback &lt;none&gt;</span></td></tr>')
+    navigation = '<div class="d2l-navigation"><ul>' + ''.join(f'<li><a href="/d2l/tool/{tool}">Tool {tool}</a></li>' for tool in range(200)) + '</ul></div>'
+    return (f'<!DOCTYPE html><html><head><title>Enter Grades</title><script>var x = "<b>" + 1;</script></head><body>{navigation}'
+            f'<form><table id="z_p" class="d2l-table" summary="grades"><tr><th>Name</th><th>Grade</th><th>Feedback</th></tr>'
+            f'{"".join(rows)}</table></form>{navigation}</body></html>')
+
+
+def synthetic_review_grades(students, course_id=1, assignment_id=2):
+    rows = []
+    for student in range(students):
+        grade = '' if student % 7 == 0 else f'{student % 30}.0'
+        extra = '<td>extra</td>' if student % 2 else ''
+        rows.append(f'<tr role="row"><td class="table--primaryLink"><a href="/courses/{course_id}/assignments/{assignment_id}/submissions/{student}">Student {student}</a></td>'
+                    f'<td>student{student}@example.edu</td><td>Section A</td>{extra}<td>{grade}</td><td>2024-01-01</td>'
+                    f'<td>false</td><td>0</td><td><a href="#">Regrade</a></td></tr>')
+    return (f'<html><head><meta name="csrf-token" content="mock-token-{course_id}"></head><body><table class="table js-reviewGradesTable"><thead><tr><th>Name</th><th>Email</th>'
+            f'<th class="u-centeredText"><span>Score / 30.0</span></th></tr></thead><tbody>{"".join(rows)}</tbody></table></body></html>')
+
+
+def synthetic_pages():
+    for students in (30, 300):
+        yield f'synthetic_{students}.grade_item_edit.html', synthetic_grade_item_edit(students)
+        yield f'synthetic_{students}.folio_grade_item_edit.html', synthetic_grade_item_edit(students, folio=True)
+        yield f'synthetic_{students}.review_grades.html', synthetic_review_grades(students)
+
+
+def page_parsers(name):
+    for suffix, functions in parsers.items():
+        if name.endswith(suffix):
+            return functions
+    return None
+
+
+def time_parser(function, html):
+    start = perf_counter()
+    for _ in range(repeats):
+        result = function(html)
+    return (perf_counter() - start) / repeats, result
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        pages = [(path.name, path.read_text(encoding='utf-8', errors='replace')) for path in sorted(Path(sys.argv[1]).iterdir())]
+    else:
+        pages = list(synthetic_pages())
+
+    try:
+        import bs4
+    except ImportError:
+        bs4 = None
+        print("BeautifulSoup is not installed, only timing the new parsers")
+
+    for name, html in pages:
+        functions = page_parsers(name)
+        if functions is None:
+            continue
+        fast, soup = functions
+        fast_time, fast_result = time_parser(fast, html)
+        line = f"{name} ({len(html) / 1e3:.0f} kB): new parser {fast_time * 1e3:.2f} ms"
+        if bs4 is not None:
+            soup_time, soup_result = time_parser(soup, html)
+            line += f", BeautifulSoup {soup_time * 1e3:.2f} ms ({soup_time / fast_time:.1f}x)"
+            line += ", same result" if fast_result == soup_result else ", DIFFERENT RESULT"
+        print(line)
@@ -0,0 +1,369 @@
+'''
+End-to-end stage benchmark of the D2L flow against the local mock LMS (mock_lms.py).
+
+Each stage of the scripts is timed with the same helpers they use, old and new
+versions side by side where both exist:
+    enumeration    list_courses() + list_assignments() through the REST API
+    grades_api    CourseGradebook, one gradebook load per course
+    grades_page    activities API + grade_item_edit.d2l + parse_d2l_grades() per assignment
+    download_single_request    every assignment zip in 1 KB chunks of one plain request, as the scripts used to
+    download    every assignment zip through download_resumable(), download_workers at a time over a pooled session
+    rewrite_extract    the old extract, rename and re-zip of each assignment zip
+    rewrite    rewrite_zip_members() with the extension filter
+    strip    strip_zip_members() on a process pool
+    final_zip_directory    the old zip_directory() of the downloads folder at the end
+    final_zip_incremental    IncrementalZipArchive.add_file() per assignment
+    archive_zip_serial    IncrementalZipArchive.add_folder() of every submitted file, deflated on the writing thread
+    archive_zip_threads    the same with a thread pool deflating, as gradescope_downloader.py does
+    archive_zip_processes    the same with a process pool deflating
+    archive_tar_zst    write_tar_zst() of the same files, multi-threaded zstd
+    gradescope_per_student    review_grades, then every student's zip downloaded through download_resumable() and extracted
+    gradescope_export    review_grades, then one export archive per assignment downloaded the same way and split with split_export()
+The mock data is generated from a seed, every stage runs --repeats times and the
+median is reported, so two runs with the same options are comparable. The
+archive stages all compress one folder of submitted files and also report the
+compression ratio, archive size over file size. --drop-every n
+has the mock cut every n-th zip reply off halfway, which download and the
+gradescope stages resume from where it stopped and download_single_request
+leaves truncated; both download stages report how many files they didn't get
+whole. --output
+saves the results as JSON, --compare prints the change against an earlier file.
+    python benchmark_stages.py --students 60 --file-size 50000 --output before.json
+    python benchmark_stages.py --students 60 --file-size 50000 --compare before.json
+'''
+
+import argparse
+import json
+import os
+import shutil
+import statistics
+import tempfile
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from pathlib import Path
+from time import perf_counter
+
+import requests
+
+from archive_utils import rewrite_zip_members, IncrementalZipArchive, MemberFilter, write_tar_zst, tar_zst_available
+from brightspace_api import list_courses, list_assignments, CourseGradebook
+from download_pool import make_pooled_session, download_resumable, DownloadFailed
+from grade_parsers import parse_d2l_grades, parse_review_grades
+import gradescope_export
+from mock_lms import MockLMS, start_mock_lms
+from source_stripping import strip_zip_members, python_extensions, c_family_extensions
+
+# the source and document extensions the download scripts keep
+allowed_extensions = sorted(python_extensions | c_family_extensions | {'.txt', '.ipynb', '.sql', '.html', '.htm', '.jar'})
+
+
+def rename_member(filename, grades, counter):
+    # same naming as submission_member_name() in download_D2L_submissions.py
+    split_filename = filename.split('-')
+    rest = " ".join(split_filename[3:]).replace('/', '_').replace('\\', '_')
+    counter[0] += 1
+    return f'{grades.get(split_filename[0], "NA")}%---{counter[0]}---{split_filename[1]}---{rest}'
+
+
+def zip_directory(folder_path, zip_file_path):
+    with zipfile.ZipFile(zip_file_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
+        for root, _, files in os.walk(folder_path):
+            for file in files:
+                file_path = os.path.join(root, file)
+                zipf.write(file_path, os.path.relpath(file_path, folder_path))
+
+
+class StageBenchmark:
+
+    def __init__(self, lms, hostname_url, work_dir, download_workers):
+        self.lms = lms
+        self.hostname_url = hostname_url
+        self.work_dir = Path(work_dir)
+        self.download_workers = download_workers
+        self.session = make_pooled_session(download_workers * 2)
+        self.assignments = lms.assignments()
+        self.grades = {}
+        # stage -> downloads of its last repeat that ended without the whole file, reported next to its time
+        self.incomplete = {}
+        # the export requests go to the mock instead of gradescope.com
+        gradescope_export.base_url = hostname_url
+
+    def downloaded(self):
+        return sorted((self.work_dir / 'downloaded').glob('*.zip'))
+
+    def fresh_folder(self, name):
+        folder = self.work_dir / name
+        if folder.exists():
+            shutil.rmtree(folder)
+        folder.mkdir()
+        return folder
+
+    def enumeration(self):
+        courses = list_courses(self.session, self.hostname_url)
+        assignments = list_assignments(self.session, self.hostname_url, courses, max_workers=self.download_workers)
+        return len(assignments), 0
+
+    def grades_api(self):
+        gradebook = CourseGradebook(self.session, self.hostname_url)
+        for _, course_id, assignment_id in self.assignments:
+            self.grades[assignment_id] = gradebook.assignment_grades(course_id, assignment_id)
+        return len(self.assignments), 0
+
+    def grades_page(self):
+        for _, course_id, assignment_id in self.assignments:
+            response = self.session.get(f'{self.hostname_url}/old/activities/6606_2000_{assignment_id}/usages/{course_id}')
+            grade_object_id = response.json()['links'][17]['href'].split('/')[-1]
+            response = self.session.get(f'{self.hostname_url}/d2l/lms/grades/admin/enter/grade_item_edit.d2l?objectId={grade_object_id}&ou={course_id}&dlg=true&d2l_body_type=2')
+            parse_d2l_grades(response.text)
+        return len(self.assignments), 0
+
+    def download_single_request(self):
+        folder = self.fresh_folder('downloaded_single_request')
+
+        def download_one(assignment):
+            # (bytes written, whether that is the whole file); a dropped reply leaves the file truncated
+            _, course_id, assignment_id = assignment
+            reply = self.session.get(f'{self.hostname_url}/d2l/common/viewFile.d2lfile/Temp/{assignment_id}.zip?ou={course_id}', stream=True)
+            expected = reply.headers.get('Content-Length')
+            downloaded = 0
+            with open(folder / f'{course_id}_{assignment_id}.zip', 'wb') as file:
+                try:
+                    for chunk in reply.iter_content(chunk_size=1024):
+                        file.write(chunk)
+                        downloaded += len(chunk)
+                except (requests.exceptions.ChunkedEncodingError, requests.ConnectionError):
+                    return downloaded, False
+            return downloaded, expected is None or downloaded == int(expected)
+
+        with ThreadPoolExecutor(max_workers=self.download_workers) as executor:
+            results = list(executor.map(download_one, self.assignments))
+        self.incomplete['download_single_request'] = sum(1 for _, complete in results if not complete)
+        return len(self.assignments), sum(downloaded for downloaded, _ in results)
+
+    def download(self):
+        folder = self.fresh_folder('downloaded')
+
+        def download_one(assignment):
+            # (bytes written, whether that is the whole file); only running out of retries gives up on a file
+            _, course_id, assignment_id = assignment
+            try:
+                downloaded, _ = download_resumable(self.session, f'{self.hostname_url}/d2l/common/viewFile.d2lfile/Temp/{assignment_id}.zip?ou={course_id}',
+                                                   folder / f'{course_id}_{assignment_id}.zip', backoff=.05)
+            except DownloadFailed:
+                return 0, False
+            return downloaded, True
+
+        with ThreadPoolExecutor(max_workers=self.download_workers) as executor:
+            results = list(executor.map(download_one, self.assignments))
+        self.incomplete['download'] = sum(1 for _, complete in results if not complete)
+        return len(self.assignments), sum(downloaded for downloaded, _ in results)
+
+    def rewrite_extract(self):
+        # what the scripts did before rewrite_zip_members(): extract everything, rename on disk, zip again
+        folder = self.fresh_folder('rewritten_extract')
+        counter = [0]
+        total = 0
+        for zip_path in self.downloaded():
+            total += zip_path.stat().st_size
+            extract_folder = folder / zip_path.stem
+            with zipfile.ZipFile(zip_path) as zipf:
+                zipf.extractall(extract_folder)
+            os.remove(extract_folder / 'index.html')
+            grades = self.grades.get(zip_path.stem.split('_')[1], {})
+            for filename in os.listdir(extract_folder):
+                os.rename(extract_folder / filename, extract_folder / rename_member(filename, grades, counter))
+            zip_directory(extract_folder, folder / zip_path.name)
+            shutil.rmtree(extract_folder)
+        return len(self.downloaded()), total
+
+    def rewrite(self):
+        folder = self.fresh_folder('rewritten')
+        counter = [0]
+        member_filter = MemberFilter(allowed_extensions)
+        total = 0
+        for zip_path in self.downloaded():
+            total += zip_path.stat().st_size
+            grades = self.grades.get(zip_path.stem.split('_')[1], {})
+            rewrite_zip_members(zip_path, folder / zip_path.name, lambda name: rename_member(name, grades, counter), member_filter=member_filter)
+        return len(self.downloaded()), total
+
+    def strip(self):
+        folder = self.fresh_folder('stripped')
+        total = 0
+        with ProcessPoolExecutor() as executor:
+            for zip_path in self.downloaded():
+                bytes_in, _ = strip_zip_members(zip_path, folder / zip_path.name, executor)
+                total += bytes_in
+        return len(self.downloaded()), total
+
+    def final_zip_directory(self):
+        zip_directory(self.work_dir / 'rewritten', self.work_dir / 'downloads_directory.zip')
+        return 1, (self.work_dir / 'downloads_directory.zip').stat().st_size
+
+    def final_zip_incremental(self):
+        zip_path = self.work_dir / 'downloads_incremental.zip'
+        if zip_path.exists():
+            zip_path.unlink()
+        archive = IncrementalZipArchive(str(zip_path))
+        for assignment_zip in sorted((self.work_dir / 'rewritten').glob('*.zip')):
+            archive.add_file(assignment_zip, assignment_zip.name)
+        return 1, zip_path.stat().st_size
+
+    def corpus(self):
+        # every submitted file under <assignment>/<student>/, written once for the archive stages
+        folder = self.work_dir / 'corpus'
+        if not folder.exists():
+            for _, _, assignment_id in self.assignments:
+                for student in range(self.lms.students):
+                    (folder / assignment_id / str(student)).mkdir(parents=True)
+                    for file_name, data in self.lms.submitted_files(assignment_id, student):
+                        (folder / assignment_id / str(student) / file_name).write_bytes(data)
+        return folder
+
+    def archive_zip(self, executor):
+        corpus = self.corpus()
+        zip_path = self.work_dir / 'corpus.zip'
+        if zip_path.exists():
+            zip_path.unlink()
+        IncrementalZipArchive(str(zip_path), executor=executor).add_folder(str(corpus), str(corpus))
+        files = [path for path in corpus.rglob('*') if path.is_file()]
+        return len(files), sum(path.stat().st_size for path in files), zip_path.stat().st_size
+
+    def archive_zip_serial(self):
+        return self.archive_zip(None)
+
+    def archive_zip_threads(self):
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            return self.archive_zip(executor)
+
+    def archive_zip_processes(self):
+        with ProcessPoolExecutor() as executor:
+            return self.archive_zip(executor)
+
+    def archive_tar_zst(self):
+        if not tar_zst_available():
+            print("archive_tar_zst skipped, it needs the zstandard package")
+            return 0, 0
+        corpus = self.corpus()
+        bytes_in, bytes_out = write_tar_zst(str(corpus), str(self.work_dir / 'corpus.tar.zst'), expand_zips=False)
+        return sum(1 for path in corpus.rglob('*') if path.is_file()), bytes_in, bytes_out
+
+    def review_grades(self, course_id, assignment_id):
+        response = self.session.get(f'{self.hostname_url}/courses/{course_id}/assignments/{assignment_id}/review_grades')
+        return response.text, parse_review_grades(response.text)[1]
+
+    def gradescope_per_student(self):
+        folder = self.fresh_folder('gradescope_per_student')
+
+        def download_one(job):
+            link, extract_folder = job
+            zip_path = f'{extract_folder}.zip'
+            extract_folder.parent.mkdir(parents=True, exist_ok=True)
+            downloaded, _ = download_resumable(self.session, f'{self.hostname_url}{link}.zip', zip_path, backoff=.05)
+            with zipfile.ZipFile(zip_path) as zipf:
+                zipf.extractall(extract_folder)
+            os.remove(zip_path)
+            return downloaded
+
+        jobs = []
+        for _, course_id, assignment_id in self.assignments:
+            _, rows = self.review_grades(course_id, assignment_id)
+            jobs.extend((link, folder / assignment_id / str(number)) for number, (_, link, _) in enumerate(rows))
+        with ThreadPoolExecutor(max_workers=self.download_workers) as executor:
+            return len(jobs), sum(executor.map(download_one, jobs))
+
+    def gradescope_export(self):
+        folder = self.fresh_folder('gradescope_export')
+        total = 0
+        for _, course_id, assignment_id in self.assignments:
+            html, rows = self.review_grades(course_id, assignment_id)
+            export_url = gradescope_export.request_export(self.session, course_id, assignment_id, gradescope_export.csrf_token(html))
+            export_path = folder / f'{assignment_id}.export.zip'
+            downloaded, _ = download_resumable(self.session, export_url, export_path, backoff=.05)
+            total += downloaded
+            submission_folders = {gradescope_export.submission_id(link): str(number) for number, (_, link, _) in enumerate(rows)}
+            gradescope_export.split_export(export_path, folder / assignment_id, submission_folders)
+            export_path.unlink()
+        return len(self.assignments), total
+
+
+stages = ['enumeration', 'grades_api', 'grades_page', 'download_single_request', 'download', 'rewrite_extract', 'rewrite', 'strip',
+          'final_zip_directory', 'final_zip_incremental', 'archive_zip_serial', 'archive_zip_threads', 'archive_zip_processes',
+          'archive_tar_zst', 'gradescope_per_student', 'gradescope_export']
+
+
+def run(options):
+    lms = MockLMS(courses=options.courses, assignments_per_course=options.assignments, students=options.students,
+                  files_per_submission=options.files, file_size=options.file_size, binary_share=options.binary_share, seed=options.seed,
+                  drop_every=options.drop_every)
+    server, hostname_url = start_mock_lms(lms)
+    results = {}
+    try:
+        with tempfile.TemporaryDirectory() as work_dir:
+            benchmark = StageBenchmark(lms, hostname_url, work_dir, options.download_workers)
+            # build every zip once up front, so the download stage measures transfer and not the mock generating data
+            for _, _, assignment_id in lms.assignments():
+                lms.submissions_zip(assignment_id)
+            # the archive stages compress the same files, written before any of them is timed
+            if not options.stages or any(stage.startswith('archive_') for stage in options.stages):
+                benchmark.corpus()
+            for stage in stages:
+                if options.stages and stage not in options.stages:
+                    continue
+                times = []
+                for _ in range(options.repeats):
+                    start = perf_counter()
+                    # the archive stages also return the size of what they wrote
+                    items, total_bytes, *bytes_out = getattr(benchmark, stage)()
+                    times.append(perf_counter() - start)
+                seconds = statistics.median(times)
+                results[stage] = {'seconds': seconds, 'items': items, 'bytes': total_bytes,
+                                  'mb_per_second': total_bytes / 1e6 / seconds if seconds and total_bytes else None,
+                                  'ratio': bytes_out[0] / total_bytes if bytes_out and total_bytes else None,
+                                  'incomplete': benchmark.incomplete.get(stage)}
+    finally:
+        server.shutdown()
+    return results
+
+
+def print_results(results, previous=None):
+    for stage, result in results.items():
+        line = f"{stage:24} {result['seconds'] * 1e3:10.1f} ms  {result['items']:5} items"
+        if result['mb_per_second']:
+            line += f"  {result['bytes'] / 1e6:8.1f} MB  {result['mb_per_second']:8.1f} MB/s"
+        if result.get('ratio'):
+            line += f"  ratio {result['ratio']:.3f}"
+        if result.get('incomplete') is not None:
+            line += f"  {result['incomplete']} incomplete"
+        if previous and stage in previous:
+            change = (result['seconds'] / previous[stage]['seconds'] - 1) * 100 if previous[stage]['seconds'] else 0
+            line += f"  {change:+6.1f}% vs before"
+        print(line)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Time each stage of the D2L flow against a local mock LMS.")
+    parser.add_argument('--courses', type=int, default=3)
+    parser.add_argument('--assignments', type=int, default=5, help="assignments per course")
+    parser.add_argument('--students', type=int, default=30)
+    parser.add_argument('--files', type=int, default=3, help="files per submission")
+    parser.add_argument('--file-size', type=int, default=20000, help="bytes per submitted file")
+    parser.add_argument('--binary-share', type=float, default=.5, help="fraction of files that are PDFs or images")
+    parser.add_argument('--download-workers', type=int, default=4)
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--drop-every', type=int, default=0, help="cut every n-th zip reply off halfway")
+    parser.add_argument('--stages', nargs='*', choices=stages, help="only run these stages (later stages need the files of earlier ones)")
+    parser.add_argument('--output', help="save the results to this JSON file")
+    parser.add_argument('--compare', help="JSON file of an earlier run to compare with")
+    options = parser.parse_args()
+
+    results = run(options)
+    previous = None
+    if options.compare:
+        with open(options.compare, 'r', encoding='utf-8') as file:
+            previous = json.load(file)['results']
+    print_results(results, previous)
+    if options.output:
+        with open(options.output, 'w', encoding='utf-8') as file:
+            json.dump({'options': vars(options), 'results': results}, file, indent=1)
@@ -0,0 +1,224 @@
+'''
+Course and assignment enumeration through the Brightspace (Valence) REST API.
+
+After the browser login, the D2L scripts can use the bearer token from
+localStorage['D2L.Fetch.Tokens'] plus the session cookies to list the user's
+enrollments and each course's dropbox folders as JSON, instead of driving the
+advanced course search and folders_manage.d2l pages through Selenium.
+CourseGradebook reads the grades of every dropbox folder in a course in one go,
+instead of an activities API request and a grade_item_edit.d2l page per assignment.
+hostname_url can point at a local stand-in server for testing.
+FetchTokenAuth keeps the short-lived token fresh for the pipeline's workers.
+'''
+
+import json
+import threading
+from time import perf_counter, time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+lp_api_version = '1.26'
+le_api_version = '1.41'
+course_offering_type_id = 3
+
+
+def authorize_session(session, access_token, cookies):
+    # cookies are the dicts returned by driver.get_cookies()
+    if access_token:
+        session.headers['Authorization'] = f'Bearer {access_token}'
+    for cookie in cookies:
+        session.cookies.set(cookie['name'], cookie['value'])
+
+
+def browser_fetch_tokens(driver):
+    # the raw localStorage['D2L.Fetch.Tokens'] of a browser, the D2L pages keep it fresh while they are used
+    return driver.execute_script("return localStorage['D2L.Fetch.Tokens'] || null")
+
+
+class FetchTokenAuth(requests.auth.AuthBase):
+    # Bearer auth with the D2L fetch token for a session the pipeline's workers share, set as session.auth.
+    # The token lives here behind a lock instead of in session.headers. It is read again from a browser when it is
+    # about to expire or a request got a 401, and that request is then sent once more with the new token.
+
+    def __init__(self, read_tokens, refresh_margin=60, min_refresh_interval=30):
+        # read_tokens() returns localStorage['D2L.Fetch.Tokens'] of a logged-in browser, the JSON text or None
+        self.read_tokens = read_tokens
+        self.refresh_margin = refresh_margin
+        self.min_refresh_interval = min_refresh_interval
+        self.lock = threading.Lock()
+        # one thread reads the browser at a time, the others wait for its token
+        self.refresh_lock = threading.Lock()
+        self.access_token = None
+        self.expires_at = None
+        self.refreshed_at = 0.0
+
+    def update(self, fetch_tokens):
+        # fetch_tokens is the JSON text of localStorage['D2L.Fetch.Tokens'], as any browser that has it can pass in
+        try:
+            token = json.loads(fetch_tokens)['*:*:*']
+        except (TypeError, ValueError, KeyError):
+            token = {}
+        with self.lock:
+            self.refreshed_at = time()
+            if token.get('access_token'):
+                self.access_token = token['access_token']
+                self.expires_at = token.get('expires_at')
+
+    def _current(self):
+        with self.lock:
+            return self.access_token, self.expires_at, self.refreshed_at
+
+    def _refresh(self, stale_token):
+        with self.refresh_lock:
+            # another thread may have got a new token while this one waited
+            if self._current()[0] != stale_token:
+                return
+            try:
+                self.update(self.read_tokens())
+            except Exception as e:
+                print(f"\tCould not read a new D2L token from the browser: {e!r}")
+
+    def __call__(self, request):
+        access_token, expires_at, refreshed_at = self._current()
+        # a browser that hasn't got a newer token yet isn't asked again on every request
+        if expires_at is not None and expires_at - time() < self.refresh_margin and time() - refreshed_at > self.min_refresh_interval:
+            self._refresh(access_token)
+            access_token = self._current()[0]
+        if access_token:
+            request.headers['Authorization'] = f'Bearer {access_token}'
+        request.register_hook('response', self._retry_unauthorized)
+        return request
+
+    def _retry_unauthorized(self, response, **kwargs):
+        # the way requests' HTTPDigestAuth answers a 401: the same request once more on the same connection
+        if response.status_code != 401:
+            return response
+        sent = response.request.headers.get('Authorization')
+        self._refresh(sent[len('Bearer '):] if sent else None)
+        access_token = self._current()[0]
+        if not access_token or sent == f'Bearer {access_token}':
+            return response
+        response.content
+        response.close()
+        retry = response.request.copy()
+        retry.headers['Authorization'] = f'Bearer {access_token}'
+        requests.cookies.extract_cookies_to_jar(retry._cookies, response.request, response.raw)
+        retry.prepare_cookies(retry._cookies)
+        retried = response.connection.send(retry, **kwargs)
+        retried.history.append(response)
+        retried.request = retry
+        return retried
+
+
+def get_json(session, url, params=None):
+    response = session.get(url, params=params)
+    response.raise_for_status()
+    return response.json()
+
+
+def list_courses(session, hostname_url, course_prefix='CSCI', role_name='Instructor'):
+    # myenrollments is paged with a bookmark, so the pages have to be read one after another
+    courses = []
+    params = {'orgUnitTypeId': course_offering_type_id}
+    while True:
+        page = get_json(session, f'{hostname_url}/d2l/api/lp/{lp_api_version}/enrollments/myenrollments/', params)
+        for item in page['Items']:
+            org_unit = item['OrgUnit']
+            if role_name and item.get('Access', {}).get('ClasslistRoleName') != role_name:
+                continue
+            if course_prefix and course_prefix not in org_unit['Name'] and course_prefix not in (org_unit.get('Code') or ''):
+                continue
+            courses.append((org_unit['Name'], str(org_unit['Id'])))
+        if not page['PagingInfo']['HasMoreItems']:
+            return courses
+        params['bookmark'] = page['PagingInfo']['Bookmark']
+
+
+def list_dropbox_folders(session, hostname_url, course_id):
+    return get_json(session, f'{hostname_url}/d2l/api/le/{le_api_version}/{course_id}/dropbox/folders/')
+
+
+def list_assignments(session, hostname_url, courses, count_field='TotalUsersWithSubmissions', max_workers=8, submission_counts=None, metrics=None):
+    # Returns the same (course_name, course_id, assignment_id) work list the page scraping builds,
+    # keeping only folders where count_field (a DropboxFolder submission count) is above 0.
+    # If given, submission_counts is filled with (course_id, assignment_id) -> count
+    # and each course's listing time goes into metrics (a run_metrics.RunMetrics) as 'assignment_scrape'
+    def course_assignments(course):
+        start = perf_counter()
+        course_name, course_id = course
+        assignments = []
+        for folder in list_dropbox_folders(session, hostname_url, course_id):
+            if (folder.get(count_field) or 0) > 0:
+                assignments.append((course_name, course_id, str(folder['Id'])))
+                if submission_counts is not None:
+                    submission_counts[(course_id, str(folder['Id']))] = folder[count_field]
+        print(f"\tFound {len(assignments)} assignments with submissions in course: {course_name}")
+        if metrics is not None:
+            metrics.observe('assignment_scrape', perf_counter() - start)
+        return assignments
+
+    all_assignments = []
+    # the threads are named after the stage, so the profiler puts their samples under it
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='assignment_scrape') as executor:
+        # map keeps the course order, so the work list comes out the same on every run
+        for assignments in executor.map(course_assignments, courses):
+            all_assignments.extend(assignments)
+    return all_assignments
+
+
+def list_grade_values(session, hostname_url, course_id, grade_object_id):
+    # every enrolled user's value for one grade object; the pages link to each other through 'Next'
+    values = []
+    url = f'{hostname_url}/d2l/api/le/{le_api_version}/{course_id}/grades/{grade_object_id}/values/'
+    while url:
+        page = get_json(session, url)
+        values.extend(page['Objects'])
+        url = page.get('Next')
+    return values
+
+
+def format_grade(grade_value):
+    # same text the grade_item_edit.d2l inputs hold: points without a trailing .0, empty when ungraded.
+    # 15 significant digits keep every decimal the points were entered with, :g would round 1234.567 to 1234.57
+    if grade_value is None or grade_value.get('PointsNumerator') is None:
+        return ''
+    return format(grade_value['PointsNumerator'], '.15g')
+
+
+class CourseGradebook:
+    # Loads a course's whole gradebook the first time one of its assignments is asked for and keeps
+    # an (assignment_id, student_id) -> grade index, so the rest of the course's assignments need no requests.
+    # Safe to share between the grade workers: a course is only loaded once even if several ask at the same time.
+
+    def __init__(self, session, hostname_url):
+        self.session = session
+        self.hostname_url = hostname_url
+        self.lock = threading.Lock()
+        self.course_locks = {}
+        self.grades = {}  # course_id -> {(assignment_id, student_id): grade}
+        self.students = {}  # (course_id, assignment_id) -> student ids with a value for that assignment
+
+    def _load_course(self, course_id):
+        grades = {}
+        for folder in list_dropbox_folders(self.session, self.hostname_url, course_id):
+            assignment_id = str(folder['Id'])
+            students = []
+            if folder.get('GradeItemId'):
+                for user_value in list_grade_values(self.session, self.hostname_url, course_id, folder['GradeItemId']):
+                    student_id = str(user_value['User']['Identifier'])
+                    grades[(assignment_id, student_id)] = format_grade(user_value.get('GradeValue'))
+                    students.append(student_id)
+            self.students[(course_id, assignment_id)] = students
+        self.grades[course_id] = grades
+        print(f"\tLoaded gradebook of course {course_id}: {len(grades)} grades")
+
+    def assignment_grades(self, course_id, assignment_id):
+        # student_id -> grade for one assignment, like the dict the grade page parsing builds
+        with self.lock:
+            course_lock = self.course_locks.setdefault(course_id, threading.Lock())
+        with course_lock:
+            if course_id not in self.grades:
+                self._load_course(course_id)
+        grades = self.grades[course_id]
+        return {student_id: grades[(assignment_id, student_id)] for student_id in self.students.get((course_id, assignment_id), ())}
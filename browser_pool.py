@@ -0,0 +1,102 @@
+'''
+Several browsers sharing one login, for the browser stage of the download pipeline.
+
+Preparing a download needs a popup window, so one browser can only work on one
+assignment at a time. BrowserPool takes the browser that went through the login,
+starts extra headless browsers, and injects the login's cookies and D2L token
+into them with the same code that restores a cached session. Each browser-stage
+worker borrows a browser for one assignment. A browser that fails is cleaned up,
+or replaced when it can't be, so one stuck popup only costs that one assignment.
+'''
+
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from selenium.common.exceptions import WebDriverException
+
+from session_cache import restore_browser_session
+
+
+class BrowserPool:
+
+    def __init__(self, driver, start_browser, hostname_url, home_url, size):
+        # driver is the logged-in browser, start_browser() starts a new headless one
+        self.start_browser = start_browser
+        self.hostname_url = hostname_url
+        self.home_url = home_url
+        self.login = {'cookies': driver.get_cookies(),
+                      'fetch_tokens': driver.execute_script("return localStorage['D2L.Fetch.Tokens'] || null")}
+        self.lock = threading.Lock()
+        self.idle = queue.Queue()
+        self.drivers = [driver]
+        self.idle.put(driver)
+        if size > 1:
+            with ThreadPoolExecutor(max_workers=size - 1) as executor:
+                for extra in executor.map(lambda _: self._start_logged_in(), range(size - 1)):
+                    if extra is not None:
+                        self.drivers.append(extra)
+                        self.idle.put(extra)
+        print(f"Browser pool: {len(self.drivers)} browsers")
+
+    def _start_logged_in(self):
+        # returns None if the browser couldn't be started or the login didn't carry over
+        try:
+            extra = self.start_browser()
+        except WebDriverException as e:
+            print(f"Could not start an extra browser: {e!r}")
+            return None
+        try:
+            if restore_browser_session(extra, self.hostname_url, self.home_url, self.login):
+                return extra
+            print("The login did not carry over to an extra browser")
+        except WebDriverException as e:
+            print(f"Could not share the login with an extra browser: {e!r}")
+        extra.quit()
+        return None
+
+    def _recover(self, driver):
+        # close whatever the failed assignment left open; a browser that doesn't respond is swapped for a new one
+        try:
+            driver.switch_to.default_content()
+            for handle in driver.window_handles[1:]:
+                driver.switch_to.window(handle)
+                driver.close()
+            driver.switch_to.window(driver.window_handles[0])
+            return driver
+        except WebDriverException as e:
+            print(f"Replacing browser that stopped responding: {e!r}")
+        replacement = self._start_logged_in()
+        with self.lock:
+            self.drivers.remove(driver)
+            if replacement is not None:
+                self.drivers.append(replacement)
+        try:
+            driver.quit()
+        except WebDriverException:
+            pass
+        return replacement
+
+    def run(self, function, *args):
+        # calls function(driver, *args) with a browser nobody else is using
+        while True:
+            with self.lock:
+                if not self.drivers:
+                    raise RuntimeError("No working browsers left")
+            try:
+                driver = self.idle.get(timeout=1)
+                break
+            except queue.Empty:
+                continue
+        try:
+            return function(driver, *args)
+        except BaseException:
+            driver = self._recover(driver)
+            raise
+        finally:
+            if driver is not None:
+                self.idle.put(driver)
+
+    def close(self):
+        # quits every browser, including the one the script logged in with
+        for driver in self.drivers:
+            driver.quit()
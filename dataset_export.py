@@ -0,0 +1,266 @@
+'''
+Sharded dataset export of the collected source files, for training and analysis jobs.
+
+Every kept file whose extension is in languages and that decodes as text becomes
+one record: the file's text, language, extension and name, the grade, course,
+assignment and anonymized id its archive name encodes, its size and sha256, and
+the run it was exported by. Like in the submission catalog, grade_unit is
+'points' for the D2L scripts' grades and 'percent' for Gradescope's.
+Records are appended to size-bounded shards as each assignment finishes:
+    dataset/part-<run>-00000.jsonl    one JSON object per line
+    dataset/part-<run>-00000.parquet    the same records in columns (needs pyarrow)
+A shard is written under a .tmp name and only gets its real name once it is full
+or the run ends, so whatever reads the dataset folder only ever sees complete
+shards and can give each one to a different worker.
+
+Incremental runs add shards instead of rewriting the old ones. index.json lists
+every complete shard and, for each assignment, the run that exported it last;
+an assignment that was downloaded again has records in an older run's shards
+too, and only the records whose run matches the index are current. An
+assignment is only listed once the shard with its records is complete, so the
+scripts download it again when a run was interrupted before that (exported()).
+'''
+
+import hashlib
+import json
+import os
+import threading
+import zipfile
+from datetime import datetime
+
+from submission_catalog import parse_d2l_member_name, parse_gradescope_folder_name, grade_number
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# the language of every extension in the scripts' allowed_extensions, named the way the comments there name them
+languages = {
+    '.txt': 'Text', '.py': 'Python', '.java': 'Java', '.js': 'JavaScript', '.c': 'C',
+    '.cpp': 'C++', '.cc': 'C++', '.cxx': 'C++', '.c++': 'C++', '.h': 'C++', '.hpp': 'C++', '.hxx': 'C++', '.hh': 'C++', '.h++': 'C++',
+    '.cs': 'C#', '.php': 'PHP', '.rb': 'Ruby', '.swift': 'Swift', '.m': 'Objective-C', '.go': 'Go', '.kt': 'Kotlin', '.kts': 'Kotlin',
+    '.ts': 'TypeScript', '.scala': 'Scala', '.r': 'R', '.pl': 'Perl', '.pm': 'Perl', '.lua': 'Lua', '.sh': 'Shell', '.bash': 'Shell',
+    '.vb': 'Visual Basic .NET', '.fs': 'F#', '.fsx': 'F#', '.dart': 'Dart', '.rs': 'Rust', '.hs': 'Haskell', '.lhs': 'Haskell',
+    '.ipynb': 'Jupyter Notebook', '.sql': 'SQL', '.css': 'CSS', '.html': 'HTML', '.htm': 'HTML',
+}
+
+_fields = ('text', 'language', 'extension', 'file_name', 'path', 'grade', 'grade_unit', 'grade_text', 'lms', 'course_id', 'course_name',
+           'assignment_id', 'assignment_name', 'anonymized_id', 'size', 'sha256', 'run')
+
+
+def parquet_available():
+    return pyarrow is not None
+
+
+def _parquet_schema():
+    string = pyarrow.string()
+    types = {'grade': pyarrow.float64(), 'anonymized_id': pyarrow.int64(), 'size': pyarrow.int64()}
+    return pyarrow.schema([(field, types.get(field, string)) for field in _fields])
+
+
+def decode_text(data):
+    # the text of a source file, None for binary files; files that aren't UTF-8 are mostly from Windows editors
+    if b'\x00' in data:
+        return None
+    try:
+        return data.decode('utf-8-sig')
+    except UnicodeDecodeError:
+        return data.decode('cp1252', errors='replace')
+
+
+class _Shard:
+    # one shard being filled, in every format the exporter writes
+
+    def __init__(self, folder, name, formats, row_group_bytes=16 * 1024 * 1024):
+        self.paths = {extension: os.path.join(folder, f'{name}.{extension}') for extension in formats}
+        self.records = 0
+        self.bytes = 0
+        self.row_group_bytes = row_group_bytes
+        self.pending_rows = []
+        self.pending_bytes = 0
+        self.jsonl = None
+        self.parquet = None
+        if 'jsonl' in formats:
+            self.jsonl = open(f"{self.paths['jsonl']}.tmp", 'w', encoding='utf-8', newline='\n')
+        if 'parquet' in formats:
+            self.parquet = pyarrow.parquet.ParquetWriter(f"{self.paths['parquet']}.tmp", _parquet_schema(), compression='zstd')
+
+    def write(self, records):
+        if self.jsonl is not None:
+            self.jsonl.write(''.join(json.dumps(record, ensure_ascii=False) + '\n' for record in records))
+            self.jsonl.flush()
+        size = sum(record['size'] for record in records)
+        if self.parquet is not None:
+            # rows are collected into row groups of a useful size, the shard can't be read before it is closed anyway
+            self.pending_rows.extend(records)
+            self.pending_bytes += size
+            if self.pending_bytes >= self.row_group_bytes:
+                self._write_row_group()
+        self.records += len(records)
+        self.bytes += size
+
+    def _write_row_group(self):
+        self.parquet.write_table(pyarrow.Table.from_pylist(self.pending_rows, schema=self.parquet.schema))
+        self.pending_rows = []
+        self.pending_bytes = 0
+
+    def close(self):
+        # closes the files and gives them their real names, returns those names
+        if self.jsonl is not None:
+            self.jsonl.close()
+        if self.parquet is not None:
+            if self.pending_rows:
+                self._write_row_group()
+            self.parquet.close()
+        for path in self.paths.values():
+            os.replace(f'{path}.tmp', path)
+        return [os.path.basename(path) for path in self.paths.values()]
+
+
+class DatasetExporter:
+
+    def __init__(self, folder, formats=('jsonl',), shard_bytes=128 * 1024 * 1024, max_file_bytes=1024 * 1024, reset=False):
+        # shard_bytes bounds the text in one shard, max_file_bytes leaves out files too big to be hand-written source
+        if 'parquet' in formats and pyarrow is None:
+            raise RuntimeError("Parquet shards need the pyarrow package: pip install pyarrow")
+        self.folder = folder
+        self.formats = tuple(formats)
+        self.shard_bytes = shard_bytes
+        self.max_file_bytes = max_file_bytes
+        self.index_path = os.path.join(folder, 'index.json')
+        self.run = datetime.now().strftime('%Y%m%d%H%M%S')
+        self.lock = threading.Lock()
+        self.shard = None
+        self.shard_number = 0
+        self.records = 0
+        self.skipped_files = 0
+        os.makedirs(folder, exist_ok=True)
+        for name in os.listdir(folder):
+            # the unfinished shards of an interrupted run, and everything when starting over
+            if name.endswith('.tmp') or reset and (name.startswith('part-') or name == 'index.json'):
+                os.remove(os.path.join(folder, name))
+        self.index = {'shards': [], 'assignments': {}}
+        if os.path.isfile(self.index_path):
+            with open(self.index_path, 'r', encoding='utf-8') as file:
+                self.index = json.load(file)
+        # the assignments whose records are in the shard being filled, they go into the index when it is closed
+        self.open_assignments = {}
+
+    @staticmethod
+    def key(lms, course_id, assignment_id):
+        return f'{lms}/{course_id}/{assignment_id}'
+
+    def exported(self, lms, course_id, assignment_id):
+        # whether the assignment's records are in the dataset, an interrupted run loses those of its unfinished shard
+        key = self.key(lms, course_id, assignment_id)
+        with self.lock:
+            return key in self.index['assignments'] or key in self.open_assignments
+
+    def _record(self, data, path, anonymized_id, grade_text, grade_unit, metadata):
+        file_name = path.rsplit('/', 1)[-1]
+        extension = os.path.splitext(file_name)[1].lower()
+        if extension not in languages or len(data) > self.max_file_bytes:
+            return None
+        text = decode_text(data)
+        if text is None:
+            return None
+        return dict(metadata, text=text, language=languages[extension], extension=extension, file_name=file_name, path=path,
+                    grade=grade_number(grade_text), grade_unit=grade_unit, grade_text=grade_text, anonymized_id=anonymized_id, size=len(data),
+                    sha256=hashlib.sha256(data).hexdigest(), run=self.run)
+
+    def add_zip(self, zip_path, archive_member, lms, course_id, course_name, assignment_id, assignment_name=None):
+        # the files of an assignment zip, members named by submission_member_name(), archive_member being its name in downloads.zip.
+        # Folio keeps the original names of files without a grade, student id and name included, those are left out
+        metadata = {'lms': lms, 'course_id': str(course_id), 'course_name': course_name,
+                    'assignment_id': str(assignment_id), 'assignment_name': assignment_name}
+        records = []
+        skipped = 0
+        with zipfile.ZipFile(zip_path) as zipf:
+            for info in zipf.infolist():
+                if info.is_dir():
+                    continue
+                anonymized_id, grade_text = parse_d2l_member_name(info.filename)
+                record = None
+                if anonymized_id is not None and info.file_size <= self.max_file_bytes:
+                    record = self._record(zipf.read(info), f'{archive_member}/{info.filename}', anonymized_id, grade_text, 'points', metadata)
+                if record is None:
+                    skipped += 1
+                else:
+                    records.append(record)
+        self._add(metadata, records, skipped)
+
+    def add_folder(self, folder_path, root_path, lms, course_id, course_name, assignment_id, assignment_name=None):
+        # the files of an assignment folder with a '<increasing_no>_<grade>%' folder per submission, paths relative to root_path;
+        # files outside those folders aren't anyone's submission and are left out
+        metadata = {'lms': lms, 'course_id': str(course_id), 'course_name': course_name,
+                    'assignment_id': str(assignment_id), 'assignment_name': assignment_name}
+        records = []
+        skipped = 0
+        for root, dirs, names in os.walk(folder_path):
+            dirs.sort()
+            submission_folder = os.path.relpath(root, folder_path).replace(os.sep, '/').split('/')[0]
+            anonymized_id, grade_text = parse_gradescope_folder_name(submission_folder)
+            for name in sorted(names):
+                file_path = os.path.join(root, name)
+                record = None
+                if anonymized_id is not None and os.path.getsize(file_path) <= self.max_file_bytes:
+                    with open(file_path, 'rb') as file:
+                        data = file.read()
+                    record = self._record(data, os.path.relpath(file_path, root_path).replace(os.sep, '/'), anonymized_id, grade_text, 'percent', metadata)
+                if record is None:
+                    skipped += 1
+                else:
+                    records.append(record)
+        self._add(metadata, records, skipped)
+
+    def _add(self, metadata, records, skipped):
+        # an assignment's records go into one shard together, which is then closed if it is full
+        key = self.key(metadata['lms'], metadata['course_id'], metadata['assignment_id'])
+        with self.lock:
+            self.records += len(records)
+            self.skipped_files += skipped
+            if not records:
+                self.index['assignments'][key] = self.run
+                self._write_index()
+                return
+            if self.shard is None:
+                self.shard = _Shard(self.folder, f'part-{self.run}-{self.shard_number:05d}', self.formats)
+                self.shard_number += 1
+            self.shard.write(records)
+            self.open_assignments[key] = self.run
+            if key in self.index['assignments']:
+                # the records of the earlier export are out of date, and the new ones aren't complete yet
+                del self.index['assignments'][key]
+                self._write_index()
+            if self.shard.bytes >= self.shard_bytes:
+                self._close_shard()
+
+    def _close_shard(self):
+        self.index['shards'].extend(self.shard.close())
+        self.index['assignments'].update(self.open_assignments)
+        self.open_assignments = {}
+        self.shard = None
+        self._write_index()
+
+    def _write_index(self):
+        temp_path = f'{self.index_path}.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as file:
+            json.dump(self.index, file, indent=1)
+        os.replace(temp_path, self.index_path)
+
+    def close(self):
+        with self.lock:
+            if self.shard is not None:
+                self._close_shard()
+            else:
+                self._write_index()
+
+    def summary(self):
+        with self.lock:
+            return {'records': self.records, 'skipped_files': self.skipped_files, 'shards': self.shard_number, 'formats': list(self.formats)}
+
+    def print_report(self):
+        print(f"Dataset export: {self.records} source files in {self.shard_number} shards ({', '.join(self.formats)}), "
+              f"{self.skipped_files} binary, oversized, non-source or unanonymized files left out")
@@ -39,13 +39,31 @@ This script is adapted from a similar script that targetted Georgia Southern Uni
 # Replace with your credentials and preferences
 username = 'username' # just username, no email (i.e. 'asanders4' not 'asanders4@augusta.edu')
 password = 'password' # The password gets used to login to D2L
+grade_workers = 4 # how many assignments have their grades fetched at the same time
+browser_workers = 1 # how many browsers prepare downloads at the same time, more than 1 starts extra headless browsers that share the login
+download_workers = 4 # how many assignments are downloaded at the same time
+rewrite_workers = 2 # how many downloaded zips are renamed and added to downloads.zip at the same time
+pipeline_queue_size = 8 # how many assignments can wait between two stages, e.g. prepared by the browser but not downloaded yet
+filter_extensions = True # only keep submitted files whose extension is in allowed_extensions, the rest is never read or written
+strip_comments = False # strip comments and docstrings from Python and C-family source files before they go into downloads.zip
+strip_processes = None # how many processes strip source files, None uses one per CPU
+connection_pool_size = 8 # how many HTTP connections to the LMS are kept open for the download workers
+incremental_sync = True # keep earlier downloads and only fetch assignments whose submissions or grades changed
+use_session_cache = True # reuse the login of an earlier run while it is still valid, so Duo is only needed once the session expires
+enumeration_backend = 'api' # 'api' lists courses and assignments through the Brightspace REST API, 'browser' scrapes the course search pages
+grade_backend = 'api' # 'api' loads each course's gradebook once through the REST API, 'page' reads one grade page per assignment
+archive_format = 'zip' # 'zip' adds each assignment to downloads.zip as it finishes, stored as it is since its members are already deflated (by D2L or the strip stage); 'tar.zst' writes downloads.tar.zst with multi-threaded zstd at the end (pip install zstandard)
+export_dataset = False # write every kept source file with its grade, course and anonymized id into sharded files in dataset/ for training and analysis jobs
+dataset_formats = ['jsonl'] # add 'parquet' for columnar shards as well (pip install pyarrow)
+fingerprint_submissions = False # fingerprint every submission into similarity_index.sqlite while it is rewritten, for near-duplicate lookups (see similarity_index.py)
+verbose = True # print every step of the run, False only prints problems and the reports at the end
+save_metrics = True # write the counters and latency histograms of every stage to run_metrics.json at the end
 
 if username == 'username' or password == 'password':
     print("Make sure to replace 'username' and 'password' in the python script before running!")
     print("(also I hope that you accidentally left 'username' or 'password' as their defaults values and those aren't your actually credentials)")
     exit()
 
-from time import sleep
 #from getpass import getuser
 from selenium import webdriver
 from selenium.webdriver.common.by import By
@@ -56,21 +74,42 @@ from selenium.webdriver.chrome.service import Service
 from selenium.common.exceptions import ElementClickInterceptedException, TimeoutException
 #import pickle
 from os.path import isfile
-from os import getcwd,listdir
+from os import getcwd
 import os
 from pathlib import Path
 import requests
-import shutil
-import zipfile
-import re
-import io
-import tokenize
-from bs4 import BeautifulSoup
+from grade_parsers import parse_d2l_grades
+from download_pool import make_pooled_session, download_resumable
+from pipeline import Pipeline
+from concurrent.futures import ProcessPoolExecutor
+from source_stripping import strip_zip_members
+from browser_pool import BrowserPool
+from page_waits import WaitTimings, document_ready, network_idle, option_value_is
+from archive_utils import rewrite_zip_members, IncrementalZipArchive, MemberFilter, write_tar_zst, tar_zst_available
+from brightspace_api import authorize_session, browser_fetch_tokens, FetchTokenAuth, list_courses, list_assignments, CourseGradebook
+from session_cache import load_session, save_session, session_is_valid, restore_browser_session
+from sync_manifest import SyncManifest, grade_snapshot_hash
+from run_metrics import RunMetrics, quiet_print
+from submission_catalog import SubmissionCatalog, zip_member_rows
+from dataset_export import DatasetExporter, parquet_available
+from similarity_index import SimilarityIndex
+from time import perf_counter
+from sampling_profiler import SamplingProfiler
+import sys
 #import ast
 
 
 executable_path = f'{getcwd()}/chromedriver.exe'
-print(f"Chromedriver path: {executable_path}")
+session_cache_path = f'{getcwd()}/session_cache.bin'
+manifest_path = f'{getcwd()}/downloads_manifest.json'
+metrics_path = f'{getcwd()}/run_metrics.json'
+catalog_path = f'{getcwd()}/downloads_catalog.sqlite'
+profile_path = f'{getcwd()}/profile.folded'
+# every stage of the run is timed into this, shared by all worker threads
+metrics = RunMetrics()
+# the step by step output; problems and the reports at the end always use print
+log = print if verbose else quiet_print
+log(f"Chromedriver path: {executable_path}")
 
 hostname_url = 'https://lms.augusta.edu'
 home_url = f'{hostname_url}/d2l/home'
@@ -121,421 +160,532 @@ allowed_extensions = [
 #    '.log',             # Log
 ]
 
-def remove_java_comments(java_code):
-    # Remove single-line comments (//...)
-    single_line_comment_pattern = r"//.*"
-    java_code = re.sub(single_line_comment_pattern, '', java_code)
-
-    # Remove multi-line comments (/*...*/)
-    multi_line_comment_pattern = r"/\*[\s\S]*?\*/"
-    java_code = re.sub(multi_line_comment_pattern, '', java_code)
-
-    return java_code
-
-def remove_python_comments_and_docstrings(source):
-    io_obj = io.StringIO(source)
-    out = ""
-    prev_toktype = tokenize.INDENT
-    last_lineno = -1
-    last_col = 0
-    for tok in tokenize.generate_tokens(io_obj.readline):
-        token_type = tok[0]
-        token_string = tok[1]
-        start_line, start_col = tok[2]
-        end_line, end_col = tok[3]
-        ltext = tok[4]
-        if start_line > last_lineno:
-            last_col = 0
-        if start_col > last_col:
-            out += (" " * (start_col - last_col))
-        if token_type == tokenize.COMMENT:
-            pass
-        elif token_type == tokenize.STRING:
-            if prev_toktype != tokenize.INDENT:
-                if prev_toktype != tokenize.NEWLINE:
-                    if start_col > 0:
-                        out += token_string
-        else:
-            out += token_string
-        prev_toktype = token_type
-        last_col = end_col
-        last_lineno = end_line
-    out = '\n'.join(l for l in out.splitlines() if l.strip())
-    return out
-
 def download_file(session, url, file_path):
-    reply = session.get(url, stream=True)
-    with open(file_path, 'wb') as file:
-        for chunk in reply.iter_content(chunk_size=1024): 
-            if chunk:
-                file.write(chunk)
-
-def zip_directory(folder_path, zip_file_path):
-    with zipfile.ZipFile(zip_file_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-        for root, _, files in os.walk(folder_path):
-            for file in files:
-                file_path = os.path.join(root, file)
-                zipf.write(file_path, os.path.relpath(file_path, folder_path))
+    # retried and resumed where it stopped when the connection drops, the file only appears once it is complete
+    downloaded, sha256 = download_resumable(session, url, file_path)
+    log(f"\t\tDownloaded {downloaded} bytes, sha256 {sha256}")
+    return downloaded
+
+def submission_member_name(filename, student_id_assignment_grades, unique_ids):
+    # Include grades in filename and remove student names
+    split_filename = filename.split('-')
+    file_student_id = split_filename[0]
+    file_assignment_id = split_filename[1]
+    file_student_name = split_filename[2]
+    file_rest_of_filename = " ".join(str(item) for item in split_filename[3:]).replace('/', '_').replace('\\', '_')
+    
+    if file_student_id in student_id_assignment_grades:
+        log(f"\t\tThere is an associated grade with file")
+        metrics.count('files_with_grade')
+        grade = student_id_assignment_grades[file_student_id]
+
+        output_name = f'{grade}%---{next(unique_ids)}---{file_assignment_id}---{file_rest_of_filename}'
+    else:
+        log(f"\t\tThere is no associated grade with file")
+        metrics.count('files_without_grade')
+        output_name = f'NA%---{next(unique_ids)}---{file_assignment_id}---{file_rest_of_filename}'
+    log(f"\t\tRenaming file to {output_name}")
+    return output_name
+
+def fetch_grade_page(session, course_id, assignment_id):
+    # get grades
+    # https://lms.augusta.edu/d2l/lms/grades/admin/enter/grade_item_edit.d2l?objectId=597438&ou=398537&dlg=true&d2l_body_type=2
+    log(f"\tUsing token to get grade object id of assignment {assignment_id}")
+    with metrics.timer('activities_api'):
+        response = session.get(f'https://83ea0a02-fd06-4d2d-8623-48ed62e25340.activities.api.brightspace.com/old/activities/6606_2000_{assignment_id}/usages/{course_id}')
+        associated_grade_object_id = response.json()['links'][17]['href'].split('/')[-1]
+    log(f"\tUsing grade object id to get grades of assignment {assignment_id}")
+    with metrics.timer('grade_page'):
+        response = session.get(f'{hostname_url}/d2l/lms/grades/admin/enter/grade_item_edit.d2l?objectId={associated_grade_object_id}&ou={course_id}&dlg=true&d2l_body_type=2')
+    # only the student id and grade cells of table#z_p are read, rows without them are skipped
+    with metrics.timer('grade_parse'):
+        return parse_d2l_grades(response.text)
+
+def fetch_assignment_grades(session, gradebook, item, manifest, dataset):
+    course_id = item['course_id']
+    assignment_id = item['assignment_id']
+    student_id_assignment_grades = None
+    if grade_backend == 'api':
+        try:
+            # the first assignment of a course waits for the whole gradebook, the others are lookups
+            with metrics.timer('gradebook_api'):
+                student_id_assignment_grades = gradebook.assignment_grades(course_id, assignment_id)
+        except (requests.RequestException, KeyError, ValueError) as e:
+            print(f"\tREST API gradebook failed for course {course_id} ({e!r}), reading the grade page instead")
+    if student_id_assignment_grades is None:
+        student_id_assignment_grades = fetch_grade_page(session, course_id, assignment_id)
+    log(f"\tTotal student grades for assignment {assignment_id}: {len(student_id_assignment_grades)}")
+    item['grades'] = student_id_assignment_grades
+    item['grades_hash'] = grade_snapshot_hash(student_id_assignment_grades)
+
+    # skip assignments that haven't changed since they were downloaded by an earlier run, and exported if that is on
+    if (incremental_sync and manifest.is_unchanged(course_id, assignment_id, item['submission_count'], item['grades_hash'])
+            and (dataset is None or dataset.exported('d2l', course_id, assignment_id))):
+        metrics.count('assignments_unchanged')
+        log(f"\tSubmissions and grades of assignment {assignment_id} unchanged since the last run, skipping download")
+        return None
+    return item
+
+def prepare_assignment_download(driver, waits, auth, item):
+    # everything that needs the browser: have D2L prepare the zip of all submissions and get its link
+    course_name = item['course_name']
+    course_id = item['course_id']
+    assignment_id = item['assignment_id']
+    log(f"\tGoing to submission page of course name: {course_name}, course id: {course_id}, assignment id: {assignment_id}")
+    driver.get(f'{hostname_url}/d2l/lms/dropbox/admin/mark/folder_submissions_files.d2l?d2l_isfromtab=1&db={assignment_id}&ou={course_id}&d2l_change=0')
+    log(f"\tSuccessfully navigated, waiting for the '200 per page' option")
+    waits.wait(driver, 'submissions page', EC.presence_of_element_located((By.XPATH, '/html/body/div[2]/div/div[2]/div/div/div/form/div/div/div[2]/div[3]/div/table[2]/tbody/tr/td/table/tbody/tr/td[2]/div/select/option[5]')), 300)
+
+    # little hack to load all submissions
+    log("\tExecuting script to set '200 per page' to actually use 1000")
+    driver.execute_script("document.evaluate('/html/body/div[2]/div/div[2]/div/div/div/form/div/div/div[2]/div[3]/div/table[2]/tbody/tr/td/table/tbody/tr/td[2]/div/select/option[5]', document, null, XPathResult.ANY_TYPE, null).iterateNext().value = 1000;")
+    log("\tExecuted script, checking that it took")
+    waits.wait(driver, 'page size hack', option_value_is('/html/body/div[2]/div/div[2]/div/div/div/form/div/div/div[2]/div[3]/div/table[2]/tbody/tr/td/table/tbody/tr/td[2]/div/select/option[5]', 1000))
+
+    # keep the token the worker threads use fresh, FetchTokenAuth takes it under its lock
+    log("\tExecuting script to get D2L access token from localStorage")
+    with metrics.timer('token_fetch'):
+        auth.update(browser_fetch_tokens(driver))
+
+    # click on top-left select all box and click download
+    log("\tClicking '200 per page' dropdown box option, which will load 1000")
+    waits.wait(driver, 'page size dropdown', EC.presence_of_element_located((By.XPATH, '/html/body/div[2]/div/div[2]/div/div/div/form/div/div/div[2]/div[3]/div/table[2]/tbody/tr/td/table/tbody/tr/td[2]/div/select')), 300)
+    driver.find_element(By.XPATH, '/html/body/div[2]/div/div[2]/div/div/div/form/div/div/div[2]/div[3]/div/table[2]/tbody/tr/td/table/tbody/tr/td[2]/div/select').click()
+    waits.wait(driver, 'page size option', EC.presence_of_element_located((By.XPATH, '/html/body/div[2]/div/div[2]/div/div/div/form/div/div/div[2]/div[3]/div/table[2]/tbody/tr/td/table/tbody/tr/td[2]/div/select/option[5]')), 300)
+    driver.find_element(By.XPATH, '/html/body/div[2]/div/div[2]/div/div/div/form/div/div/div[2]/div[3]/div/table[2]/tbody/tr/td/table/tbody/tr/td[2]/div/select/option[5]').click()
+
+    log("\tClicking 'select all' box")
+    waits.wait(driver, 'select all box', EC.presence_of_element_located((By.XPATH, '/html/body/div[2]/div/div[2]/div/div/div/form/div/div/div[2]/div[3]/div/d2l-table-wrapper/table/tbody/tr[1]/th[1]/input')), 300)
+    driver.find_element(By.XPATH, '/html/body/div[2]/div/div[2]/div/div/div/form/div/div/div[2]/div[3]/div/d2l-table-wrapper/table/tbody/tr[1]/th[1]/input').click()
+    waits.wait(driver, 'download button', EC.presence_of_element_located((By.XPATH, '/html/body/div[2]/div/div[2]/div/div/div/form/div/div/div[2]/div[3]/div/table[1]/tbody/tr/td/table/tbody/tr/td/div/d2l-overflow-group/d2l-button-subtle[1]')), 300)
+
+    # Wait for download window to open and click download
+    log("\tClicking 'Download' and waiting for new window to pop up")
+    driver.find_element(By.XPATH, '/html/body/div[2]/div/div[2]/div/div/div/form/div/div/div[2]/div[3]/div/table[1]/tbody/tr/td/table/tbody/tr/td/div/d2l-overflow-group/d2l-button-subtle[1]').click()
+    waits.wait(driver, 'download popup', EC.number_of_windows_to_be(2), 300)
+    log("\tNew window appeared, switching to it")
+    driver.switch_to.window(driver.window_handles[1])
+    log("\tWaiting for its frame and switching to it")
+    waits.wait(driver, 'download popup frame', EC.frame_to_be_available_and_switch_to_it((By.XPATH, '/html/frameset/frame[2]')), 300)
+    log("\tWaiting for download to be ready")
+    try:
+        waits.wait(driver, 'download ready', EC.element_to_be_clickable((By.XPATH,'/html/body/div/div[1]/div[3]/div/div/div/form/div/div/span/a')), 60)
+        href = driver.find_element(By.XPATH,'/html/body/div/div[1]/div[3]/div/div/div/form/div/div/span/a').get_attribute('href')
+        log("\tDownload ready, queueing download to /downloads/")
+    except TimeoutException:
+        print("\tTimed out waiting for download, going to next assignment...")
+        metrics.count('download_not_ready')
+        href = None
+
+    # close download window and go back to main window
+    log("\tClosing extra window and going back to main window")
+    driver.switch_to.default_content()
+    driver.close()
+    waits.wait(driver, 'popup closed', EC.number_of_windows_to_be(1))
+    driver.switch_to.window(driver.window_handles[0])
+    log("\tDone with assignment")
+    log()
+    if href is None:
+        return None
+    item['href'] = href
+    return item
+
+def download_assignment(session, item):
+    log(f"\tDownloading assignment {item['assignment_id']} to /downloads/")
+    item['download_path'] = Path(f"{getcwd()}/downloads/{item['course_id']}_{item['course_name']}_{item['assignment_id']}.download.zip")
+    with metrics.timer('download') as measurement:
+        item['stage_bytes'] = measurement.bytes = download_file(session, item['href'], item['download_path'])
+    log(f"\tDownload of assignment {item['assignment_id']} complete")
+    return item
+
+def strip_assignment(item, executor, member_filter):
+    # strips the source files of the downloaded zip on the process pool, the rewrite stage then reads the stripped copy
+    download_path = item['download_path']
+    stripped_path = download_path.with_suffix('.stripped.zip')
+    with metrics.timer('strip') as measurement:
+        bytes_in, _ = strip_zip_members(download_path, stripped_path, executor, member_filter=member_filter)
+        measurement.bytes = bytes_in
+    download_path.unlink()
+    # the stripped copy only has allowed files left, so the rewrite stage doesn't filter or count them again
+    item['download_path'] = stripped_path
+    item['filtered'] = True
+    item['stage_bytes'] = bytes_in
+    return item
+
+def rewrite_assignment(item, unique_ids, downloads_archive, manifest, member_filter, catalog, dataset, similarity):
+    # copies the downloaded zip's members, renamed and without index.html, straight into the final zip
+    assignment_id = item['assignment_id']
+    download_path = item['download_path']
+    zip_path = Path(f"{getcwd()}/downloads/{item['course_id']}_{item['course_name']}_{assignment_id}.zip")
+    log(f"\tRenaming all files in zip of assignment {assignment_id}")
+    rename = lambda filename: submission_member_name(filename, item['grades'], unique_ids)
+    # files with other extensions are skipped while the zip is read, they never reach the disk
+    with metrics.timer('rewrite') as measurement:
+        measurement.bytes = download_path.stat().st_size
+        written = rewrite_zip_members(download_path, zip_path, rename, member_filter=None if item.get('filtered') else member_filter)
+    log(f"\tNumber of files kept from assignment {assignment_id}: {written}")
+
+    log("\tDeleting original zip")
+    download_path.unlink()
+
+    if downloads_archive is not None:
+        # add the finished assignment to downloads.zip right away so an interrupted run keeps it
+        log(f"\tAdding assignment {assignment_id} to downloads.zip")
+        with metrics.timer('final_zip') as measurement:
+            measurement.bytes = zip_path.stat().st_size
+            downloads_archive.add_file(zip_path, zip_path.name)
+    # one catalog row per kept file, replacing the rows of an earlier download of the assignment
+    with metrics.timer('catalog'):
+        catalog.replace_assignment('d2l', item['course_id'], item['course_name'], assignment_id, None, zip_member_rows(zip_path, zip_path.name))
+    if dataset is not None:
+        with metrics.timer('dataset_export'):
+            dataset.add_zip(zip_path, zip_path.name, 'd2l', item['course_id'], item['course_name'], assignment_id)
+    if similarity is not None:
+        with metrics.timer('fingerprint'):
+            similarity.add_zip(zip_path, 'd2l', item['course_id'], item['course_name'], assignment_id)
+    manifest.record(item['course_id'], assignment_id, item['submission_count'], item['grades_hash'], zip_path)
+    return item
+
+def start_browser(headless):
+    options = webdriver.ChromeOptions()
+
+    # Use existing broswer session. Warning: Will close all tabs
+    #options.add_argument(f'user-data-dir=C:/Users/{getuser()}/AppData/Local/Google/Chrome/User Data/')
+    prefs = {'download.prompt_for_download': False,
+            'download.default_directory': f"{getcwd()}/downloads",
+            'download.directory_upgrage': True,
+            'profile.default_content_settings.popups': 0,
+            }
+    options.add_experimental_option("prefs",prefs)
+
+    if headless:
+        options.add_argument("--headless")
+    return webdriver.Chrome(options=options, service = Service(executable_path))
 
 if __name__ == '__main__':
+    if archive_format == 'tar.zst' and not tar_zst_available():
+        print("archive_format 'tar.zst' needs the zstandard package: pip install zstandard")
+        exit()
+    if export_dataset and 'parquet' in dataset_formats and not parquet_available():
+        print("dataset_formats 'parquet' needs the pyarrow package: pip install pyarrow")
+        exit()
+
+    # run with --profile to sample every thread's stack for the whole run, see sampling_profiler.py
+    profiling = '--profile' in sys.argv
+    profiler = SamplingProfiler()
+    if profiling:
+        profiler.start()
+    profiler.set_stage('setup')
 
     # make directory if it doesn't exist
     if not os.path.exists(f"{getcwd()}/downloads/"):
         os.makedirs(f"{getcwd()}/downloads/")
-    else:
+    elif not incremental_sync:
         for root, dirs, files in os.walk(f"{getcwd()}/downloads/", topdown=False):
             for directory in dirs:
                 os.rmdir(os.path.join(root, directory))
             for file in files:
                 os.remove(os.path.join(root, file))
 
-    if os.path.isfile(os.path.join(f"{getcwd()}", "downloads.zip")):
+    if not incremental_sync and os.path.isfile(os.path.join(f"{getcwd()}", "downloads.zip")):
         os.remove(os.path.join(f"{getcwd()}", "downloads.zip"))
 
-    s = requests.Session()
+    # downloads.zip is built up as each assignment finishes, downloads.tar.zst is written in one go at the end.
+    # No compression executor: the archive's members are the assignment zips, which are stored as they are
+    downloads_archive = IncrementalZipArchive(f"{getcwd()}/downloads.zip") if archive_format == 'zip' else None
+    # what earlier runs downloaded, starts over when the old downloads were just deleted
+    manifest = SyncManifest(manifest_path, reset=not incremental_sync)
+    # indexed list of every file in downloads.zip, see submission_catalog.py for querying it
+    catalog = SubmissionCatalog(catalog_path, reset=not incremental_sync)
+    # the kept source files as JSONL/Parquet shards, see dataset_export.py
+    dataset = DatasetExporter(f"{getcwd()}/dataset", dataset_formats, reset=not incremental_sync) if export_dataset else None
+    # winnowing/MinHash fingerprints of every submission in an LSH index, see similarity_index.py
+    similarity = SimilarityIndex(f"{getcwd()}/similarity_index.sqlite", reset=not incremental_sync) if fingerprint_submissions else None
 
-    # Initialize the WebDriver and authenticate
-    options = webdriver.ChromeOptions()
+    s = make_pooled_session(connection_pool_size)
 
-    # Use existing broswer session. Warning: Will close all tabs
-    #options.add_argument(f'user-data-dir=C:/Users/{getuser()}/AppData/Local/Google/Chrome/User Data/')
-    prefs = {'download.prompt_for_download': False,
-            'download.default_directory': f"{getcwd()}/downloads",
-            'download.directory_upgrage': True,
-            'profile.default_content_settings.popups': 0,
-            }
-    options.add_experimental_option("prefs",prefs)
-    
-    #options.add_argument("--headless")
-    driver = webdriver.Chrome(options=options, service = Service(executable_path))
+    # Initialize the WebDriver and authenticate
+    driver = start_browser(headless=False)
     original_window = driver.current_window_handle
+    # every wait on the page is timed for the report at the end
+    waits = WaitTimings()
 
 
-    # # Go to homepage and load previously stored cookies if they exist
-    # driver.get(home_url)
-    # if isfile("cookies.pkl"):
-    #     cookies = pickle.load(open("cookies.pkl", "rb"))
-    #     for cookie in cookies:
-    #         driver.add_cookie(cookie)
-    # driver.refresh()
-    # sleep(1)
+    # Go to homepage and load the cookies of an earlier run if that session is still valid
+    login_start = perf_counter()
+    profiler.set_stage('login')
+    if use_session_cache:
+        cached_session = load_session(session_cache_path)
+        if cached_session is not None and session_is_valid(s, hostname_url, cached_session['cookies']):
+            log("Cached session is still valid, loading its cookies into the browser")
+            if restore_browser_session(driver, hostname_url, home_url, cached_session):
+                log("Restored cached session, skipping DUO Authentication")
 
     # go through Duo auth process
-    print("Attempting DUO Authentication")
+    log("Attempting DUO Authentication")
     if driver.current_url != home_url:
-        print("Going to login url")
+        log("Going to login url")
         driver.get(login_url)
-        print("Inputting username and password")
+        log("Inputting username and password")
         driver.find_element(By.ID, 'userNameInput').send_keys(username)
         driver.find_element(By.ID, 'passwordInput').send_keys(password)
-        print("Pressing enter")
+        log("Pressing enter")
         driver.find_element(By.ID, 'passwordInput').send_keys(Keys.ENTER)
         driver.switch_to.default_content()
-    print("Waiting for DUO Authentication")
+    log("Waiting for DUO Authentication")
     WebDriverWait(driver, 500).until(EC.url_to_be(home_url) or EC.url_to_be(session_expired_url))
-    print("DUO Authentication appears successful")
+    log("DUO Authentication appears successful")
 
     if driver.current_url == session_expired_url:
         driver.get(home_url)
 
     WebDriverWait(driver, 300).until(EC.url_to_be(home_url))
-    print("Successfully redirected to home url")
-
-    # Dumping cookies so it doesn't need to login every time
-    # cookies = driver.get_cookies()
-    # pickle.dump(cookies, open("cookies.pkl", "wb"))
-
-    # for cookie in cookies:
-    #     s.cookies.set(cookie['name'], cookie['value'])
-
-    # Wait for the page to load
-    print("Going to advanced course search")
-    driver.get(advanced_course_search_url)
-    WebDriverWait(driver, 100).until(EC.presence_of_element_located((By.XPATH, '/html/body/div[2]/div/div[3]/d2l-input-search')))
-    print("At advanced course search")
-
-    # only get CSCI courses
-    print("Entering CSCI into search bar")
-    driver.find_element(By.XPATH, "/html/body/div[2]/div/div[3]/d2l-input-search").send_keys("CSCI")
-    print("Sending Enter Key")
-    driver.find_element(By.XPATH, "/html/body/div[2]/div/div[3]/d2l-input-search").send_keys(Keys.ENTER)
-
-    # only get courses in which the user was an Instructor
-    print("Finding course role dropdown menu")
-    select = Select(driver.find_element(By.XPATH, "/html/body/div[2]/div/form/div[1]/div/div/div/div/div[1]/div/select"))
-    print("Clicking element with 'Instructor' role")
-    select.select_by_visible_text("Instructor")
-    print("Successfully clicked 'Instructor' Role")
-
-    # get courses from all semesters
-    print("Finding semester dropdown menu")
-    select = Select(driver.find_element(By.XPATH, "/html/body/div[2]/div/form/div[1]/div/div/div/div/div[2]/div/select"))
-    print("Clicking element with 'All' semester")
-    select.select_by_visible_text("All")
-    print("Successfully clicked 'All' semester")
-
-    # little hack to load all courses
-    print("Executing script to set '100 per page' to actually use 1000")
-    driver.execute_script("document.evaluate('/html/body/div[2]/div/div[5]/div/div/div[2]/div/div/div[2]/div/select/option[4]', document, null, XPathResult.ANY_TYPE, null).iterateNext().value = 1000;")
-    print("Executed script, waiting 2 seconds")
-    sleep(2)
-    print("Finding dropdown menu containing the 'x per page' options")
-    WebDriverWait(driver, 100).until(EC.presence_of_element_located((By.XPATH, '/html/body/div[2]/div/div[5]/div/div/div[2]/div/div/div[2]/div/select')))
-    sleep(3)
-    print("Checking if downdown menu is visible, indicating that there are courses found")
-    if not driver.find_element(By.XPATH, '/html/body/div[2]/div/div[5]/div/div/div[2]/div/div/div[2]/div/select').is_displayed():
-        print("Dropdown menu is not displayed, which mean the search result failed. 'CSCI' and 'Instructor' seemed to not return any results")
-        print("Ending program")
-        quit()
-    print("Clicking dropdown menu containing the 'x per page' options")
-    try:
-        driver.find_element(By.XPATH, '/html/body/div[2]/div/div[5]/div/div/div[2]/div/div/div[2]/div/select').click()
-    except ElementClickInterceptedException:
-        print("There was an issue clicking the dropdown menu but it should have worked. Try running again.")
-        quit()
-    print("Waiting for options to load")
-    WebDriverWait(driver, 100).until(EC.presence_of_element_located((By.XPATH, '/html/body/div[2]/div/div[5]/div/div/div[2]/div/div/div[2]/div/select/option[4]')))
-    print("Clicking '100 per page' dropdown menu option, which will load 1000 courses")
-    driver.find_element(By.XPATH, '/html/body/div[2]/div/div[5]/div/div/div[2]/div/div/div[2]/div/select/option[4]').click()
-    print("Clicked '100 per page' dropdown menu option, waiting")
-    sleep(1)
-
-    # loop through table of courses and add each course name and id to a list
-    print("Looping through courses that contain a 'd2l-link', i.e., course name is a link")
-    courses = []
-    table = driver.find_element(By.XPATH, '/html/body/div[2]/div/div[5]/div/div/d2l-table-wrapper/table').find_elements(By.CLASS_NAME, 'd2l-link')
-    print(f"Total found courses in table: {len(table)}")
-    for row in table:
-        course_name = row.text
-        course_id = row.get_attribute("href").split("/")[-1]
-        print(f"\tFound course: {course_name}, course_id: {course_id}")
-        courses.append((course_name, course_id))
-
-    # visit each course's page and get all of the assignments
-    print("Going through each course and going through each assignment")
+    log("Successfully redirected to home url")
+    # includes the time waiting for the Duo push to be accepted
+    metrics.observe('login', perf_counter() - login_start)
+
+    # Saving cookies so it doesn't need to login every time
+    if use_session_cache:
+        log("Saving session for the next run")
+        fetch_tokens = driver.execute_script("return localStorage['D2L.Fetch.Tokens'] || null")
+        save_session(session_cache_path, driver.get_cookies(), fetch_tokens)
+
+    profiler.set_stage('course_enumeration')
     all_assignments = []
-    for course in courses:
-        course_name = course[0].replace('/', '_').replace('\\', '_')
-        course_id = course[1]
-        print(f"\tGoing to assignments page of course name: {course_name}")
-        driver.get(f"{hostname_url}/d2l/lms/dropbox/admin/folders_manage.d2l?ou={course_id}&d2l_stateScopes=%7B%221%22%3A%5B%22gridpagenum%22,%22search%22,%22pagenum%22%5D,%222%22%3A%5B%22lcs%22%5D,%223%22%3A%5B%22grid%22,%22pagesize%22,%22htmleditor%22,%22hpg%22%5D%7D&d2l_stateGroups=%5B%22grid%22,%22gridpagenum%22%5D&d2l_statePageId=223&d2l_state_grid=%7B%22Name%22%3A%22grid%22,%22Controls%22%3A%5B%7B%22ControlId%22%3A%7B%22ID%22%3A%22grid_main%22%7D,%22StateType%22%3A%22%22,%22Key%22%3A%22%22,%22Name%22%3A%22gridFolders%22,%22State%22%3A%7B%22PageSize%22%3A%222000%22,%22SortField%22%3A%22DropBoxId%22,%22SortDir%22%3A0%7D%7D%5D%7D&d2l_state_gridpagenum=%7B%22Name%22%3A%22gridpagenum%22,%22Controls%22%3A%5B%7B%22ControlId%22%3A%7B%22ID%22%3A%22grid_main%22%7D,%22StateType%22%3A%22pagenum%22,%22Key%22%3A%22%22,%22Name%22%3A%22gridFolders%22,%22State%22%3A%7B%22PageNum%22%3A1%7D%7D%5D%7D&d2l_change=1")
-        print(f"\tAt assignments page, waiting .5 seconds")
-        sleep(.5)
-
-        # If there are no assignments, go to next course
+    submission_counts = {}
+    if enumeration_backend == 'api':
+        # list courses and assignments as JSON with the token and cookies the login left behind
+        log("Listing courses and assignments through the Brightspace REST API")
+        try:
+            access_token = driver.execute_script("return JSON.parse(localStorage['D2L.Fetch.Tokens'] || '{}')['*:*:*']?.['access_token']")
+            authorize_session(s, access_token, driver.get_cookies())
+            with metrics.timer('course_enumeration'):
+                courses = list_courses(s, hostname_url, course_prefix='CSCI', role_name='Instructor')
+            log(f"Total found courses: {len(courses)}")
+            courses = [(course_name.replace('/', '_').replace('\\', '_'), course_id) for course_name, course_id in courses]
+            all_assignments = list_assignments(s, hostname_url, courses, count_field='TotalUsersWithSubmissions', max_workers=connection_pool_size, submission_counts=submission_counts, metrics=metrics)
+        except (requests.RequestException, KeyError, ValueError) as e:
+            print(f"REST API listing failed ({e!r}), falling back to the course search pages")
+            enumeration_backend = 'browser'
+
+    if enumeration_backend == 'browser':
+        course_search_start = perf_counter()
+        # Wait for the page to load
+        log("Going to advanced course search")
+        driver.get(advanced_course_search_url)
+        WebDriverWait(driver, 100).until(EC.presence_of_element_located((By.XPATH, '/html/body/div[2]/div/div[3]/d2l-input-search')))
+        log("At advanced course search")
+
+        # only get CSCI courses
+        log("Entering CSCI into search bar")
+        driver.find_element(By.XPATH, "/html/body/div[2]/div/div[3]/d2l-input-search").send_keys("CSCI")
+        log("Sending Enter Key")
+        driver.find_element(By.XPATH, "/html/body/div[2]/div/div[3]/d2l-input-search").send_keys(Keys.ENTER)
+
+        # only get courses in which the user was an Instructor
+        log("Finding course role dropdown menu")
+        select = Select(driver.find_element(By.XPATH, "/html/body/div[2]/div/form/div[1]/div/div/div/div/div[1]/div/select"))
+        log("Clicking element with 'Instructor' role")
+        select.select_by_visible_text("Instructor")
+        log("Successfully clicked 'Instructor' Role")
+
+        # get courses from all semesters
+        log("Finding semester dropdown menu")
+        select = Select(driver.find_element(By.XPATH, "/html/body/div[2]/div/form/div[1]/div/div/div/div/div[2]/div/select"))
+        log("Clicking element with 'All' semester")
+        select.select_by_visible_text("All")
+        log("Successfully clicked 'All' semester")
+
+        # little hack to load all courses
+        log("Executing script to set '100 per page' to actually use 1000")
+        driver.execute_script("document.evaluate('/html/body/div[2]/div/div[5]/div/div/div[2]/div/div/div[2]/div/select/option[4]', document, null, XPathResult.ANY_TYPE, null).iterateNext().value = 1000;")
+        log("Executed script, waiting for the search results to finish loading")
+        waits.wait(driver, 'course search results', network_idle(), 10, required=False)
+        log("Finding dropdown menu containing the 'x per page' options")
+        waits.wait(driver, 'course page size dropdown', EC.presence_of_element_located((By.XPATH, '/html/body/div[2]/div/div[5]/div/div/div[2]/div/div/div[2]/div/select')), 100)
+        log("Checking if downdown menu is visible, indicating that there are courses found")
+        if not driver.find_element(By.XPATH, '/html/body/div[2]/div/div[5]/div/div/div[2]/div/div/div[2]/div/select').is_displayed():
+            print("Dropdown menu is not displayed, which mean the search result failed. 'CSCI' and 'Instructor' seemed to not return any results")
+            print("Ending program")
+            quit()
+        log("Clicking dropdown menu containing the 'x per page' options")
         try:
-            print("\tChecking to see if there is an assignments table")
-            table = driver.find_element(By.XPATH, '/html/body/div[2]/div/div[2]/div/div/div[2]/form/div/div/div/div/d2l-table-wrapper/table/tbody')
-        except:
-            print("\tNo assignments table found, going to next course")
-            continue
-
-        print("\tFound assignments table")
-        # find all elements with "d2l-link" in the class name. This is only contained within the assignment links. I'm not aware of it being contained anywhere else.
-        print("\tFinding all elements with 'd2l-link', which correspond to the assignments")
-        table_inner_rows = table.find_elements(By.CLASS_NAME, 'd2l-link')
-        print("\tFound all elements")
-
-        # go through each row in table on the assignments page
-        print(f"\tTotal found rows in table: {len(table_inner_rows)}")
-        for row in table_inner_rows:
-            # If a row doesn't have text, like a new category(?), skip it
-            print("\t\tChecking if row has text")
-            if row.text == '':
-                print("\t\tRow doesn't have text, going to next row")
-                print()
+            driver.find_element(By.XPATH, '/html/body/div[2]/div/div[5]/div/div/div[2]/div/div/div[2]/div/select').click()
+        except ElementClickInterceptedException:
+            print("There was an issue clicking the dropdown menu but it should have worked. Try running again.")
+            quit()
+        log("Waiting for options to load")
+        WebDriverWait(driver, 100).until(EC.presence_of_element_located((By.XPATH, '/html/body/div[2]/div/div[5]/div/div/div[2]/div/div/div[2]/div/select/option[4]')))
+        log("Clicking '100 per page' dropdown menu option, which will load 1000 courses")
+        driver.find_element(By.XPATH, '/html/body/div[2]/div/div[5]/div/div/div[2]/div/div/div[2]/div/select/option[4]').click()
+        log("Clicked '100 per page' dropdown menu option, waiting for the courses to load")
+        waits.wait(driver, 'course list', network_idle(), 10, required=False)
+
+        # loop through table of courses and add each course name and id to a list
+        log("Looping through courses that contain a 'd2l-link', i.e., course name is a link")
+        courses = []
+        table = driver.find_element(By.XPATH, '/html/body/div[2]/div/div[5]/div/div/d2l-table-wrapper/table').find_elements(By.CLASS_NAME, 'd2l-link')
+        log(f"Total found courses in table: {len(table)}")
+        for row in table:
+            course_name = row.text
+            course_id = row.get_attribute("href").split("/")[-1]
+            log(f"\tFound course: {course_name}, course_id: {course_id}")
+            courses.append((course_name, course_id))
+        metrics.observe('course_enumeration', perf_counter() - course_search_start)
+
+        # visit each course's page and get all of the assignments
+        log("Going through each course and going through each assignment")
+        profiler.set_stage('assignment_scrape')
+        for course in courses:
+            course_start = perf_counter()
+            course_name = course[0].replace('/', '_').replace('\\', '_')
+            course_id = course[1]
+            log(f"\tGoing to assignments page of course name: {course_name}")
+            driver.get(f"{hostname_url}/d2l/lms/dropbox/admin/folders_manage.d2l?ou={course_id}&d2l_stateScopes=%7B%221%22%3A%5B%22gridpagenum%22,%22search%22,%22pagenum%22%5D,%222%22%3A%5B%22lcs%22%5D,%223%22%3A%5B%22grid%22,%22pagesize%22,%22htmleditor%22,%22hpg%22%5D%7D&d2l_stateGroups=%5B%22grid%22,%22gridpagenum%22%5D&d2l_statePageId=223&d2l_state_grid=%7B%22Name%22%3A%22grid%22,%22Controls%22%3A%5B%7B%22ControlId%22%3A%7B%22ID%22%3A%22grid_main%22%7D,%22StateType%22%3A%22%22,%22Key%22%3A%22%22,%22Name%22%3A%22gridFolders%22,%22State%22%3A%7B%22PageSize%22%3A%222000%22,%22SortField%22%3A%22DropBoxId%22,%22SortDir%22%3A0%7D%7D%5D%7D&d2l_state_gridpagenum=%7B%22Name%22%3A%22gridpagenum%22,%22Controls%22%3A%5B%7B%22ControlId%22%3A%7B%22ID%22%3A%22grid_main%22%7D,%22StateType%22%3A%22pagenum%22,%22Key%22%3A%22%22,%22Name%22%3A%22gridFolders%22,%22State%22%3A%7B%22PageNum%22%3A1%7D%7D%5D%7D&d2l_change=1")
+            log(f"\tAt assignments page, waiting for it to finish loading")
+            waits.wait(driver, 'assignments page', document_ready, 10, required=False)
+
+            # If there are no assignments, go to next course
+            try:
+                log("\tChecking to see if there is an assignments table")
+                table = driver.find_element(By.XPATH, '/html/body/div[2]/div/div[2]/div/div/div[2]/form/div/div/div/div/d2l-table-wrapper/table/tbody')
+            except:
+                log("\tNo assignments table found, going to next course")
+                metrics.observe('assignment_scrape', perf_counter() - course_start)
                 continue
-            print(f"\t\tRow has text: {row.text}")
-            print("\t\tChecking if link goes to assignment")
-            if len(row.get_attribute("title")) < 4 or row.get_attribute("title")[0:4] != 'View':
-                    print("\t\tRow is not assignment, continuing...")
-                    print()
+
+            log("\tFound assignments table")
+            # find all elements with "d2l-link" in the class name. This is only contained within the assignment links. I'm not aware of it being contained anywhere else.
+            log("\tFinding all elements with 'd2l-link', which correspond to the assignments")
+            table_inner_rows = table.find_elements(By.CLASS_NAME, 'd2l-link')
+            log("\tFound all elements")
+
+            # go through each row in table on the assignments page
+            log(f"\tTotal found rows in table: {len(table_inner_rows)}")
+            for row in table_inner_rows:
+                # If a row doesn't have text, like a new category(?), skip it
+                log("\t\tChecking if row has text")
+                if row.text == '':
+                    log("\t\tRow doesn't have text, going to next row")
+                    log()
                     continue
+                log(f"\t\tRow has text: {row.text}")
+                log("\t\tChecking if link goes to assignment")
+                if len(row.get_attribute("title")) < 4 or row.get_attribute("title")[0:4] != 'View':
+                        log("\t\tRow is not assignment, continuing...")
+                        log()
+                        continue
             
-            print("\t\tGetting number of completed submissions")
-            completed_assignment_string = row.find_elements(By.XPATH, './parent::*/parent::*/parent::*/parent::*/parent::*/parent::*/parent::*/parent::*/*')[3].text
-            print(f"\t\tValue of evaluated assignment string: {completed_assignment_string}")
-            if completed_assignment_string != '':
-                print("\t\tString not empty, indicating an assignment")
-                print("\t\tEvaluating string")
-                completed_assignment = eval(completed_assignment_string)
-                print(f"\t\tEvaluated string successfully: {completed_assignment}")
-                if completed_assignment > 0:
-                    print("\t\tCompleted assignment is > 0, indicating there are assignment submissions")
-                    assignment_id = row.get_attribute("href").split("?db=")[1].split("&")[0]
-                    print(f"\t\tAssignment id: {assignment_id}")
-                    all_assignments.append((course_name, course_id, assignment_id))
+                log("\t\tGetting number of completed submissions")
+                completed_assignment_string = row.find_elements(By.XPATH, './parent::*/parent::*/parent::*/parent::*/parent::*/parent::*/parent::*/parent::*/*')[3].text
+                log(f"\t\tValue of evaluated assignment string: {completed_assignment_string}")
+                if completed_assignment_string != '':
+                    log("\t\tString not empty, indicating an assignment")
+                    log("\t\tEvaluating string")
+                    completed_assignment = eval(completed_assignment_string)
+                    log(f"\t\tEvaluated string successfully: {completed_assignment}")
+                    if completed_assignment > 0:
+                        log("\t\tCompleted assignment is > 0, indicating there are assignment submissions")
+                        assignment_id = row.get_attribute("href").split("?db=")[1].split("&")[0]
+                        log(f"\t\tAssignment id: {assignment_id}")
+                        all_assignments.append((course_name, course_id, assignment_id))
+                        submission_counts[(course_id, assignment_id)] = completed_assignment
+                    else:
+                        log("\t\tompleted assignment is <= 0, indicating no assignment submissions")
                 else:
-                    print("\t\tompleted assignment is <= 0, indicating no assignment submissions")
-            else:
-                print("\t\tString empty, indicating not an assignment")
-            print("\tGoing to next row...")
-            print()
-        print(f"\tFinishing going through assignments of course: {course_id}")
-        print()
-
-    incrementing_unique_id = 0
+                    log("\t\tString empty, indicating not an assignment")
+                log("\tGoing to next row...")
+                log()
+            log(f"\tFinishing going through assignments of course: {course_id}")
+            metrics.observe('assignment_scrape', perf_counter() - course_start)
+            log()
+
+    # ids that replace student names, continuing from earlier runs; safe to share between the workers
+    unique_ids = manifest.unique_ids
+
+    # the grade and download requests need the D2L access token and cookies from the browser. The cookies are set once
+    # here, before the stages share the session. The token expires during a long run: FetchTokenAuth holds it for the
+    # workers, the browser stage hands it the token of every page it loads, and a request that still gets a 401
+    # waits for an idle browser of the pool to read a new one
+    authorize_session(s, None, driver.get_cookies())
+    s.headers.pop('Authorization', None)
+    auth = FetchTokenAuth(lambda: browsers.run(browser_fetch_tokens))
+    with metrics.timer('token_fetch'):
+        auth.update(browser_fetch_tokens(driver))
+    s.auth = auth
+    # grades of a whole course are loaded the first time one of its assignments reaches the grades stage
+    gradebook = CourseGradebook(s, hostname_url)
+    # extra headless browsers get the login of this one, each prepares the downloads of different assignments
+    browsers = BrowserPool(driver, lambda: start_browser(headless=True), hostname_url, home_url, browser_workers)
+
+    # grades are fetched ahead of the browser so unchanged assignments never open the download popup.
+    # The browser only prepares each download, so it can move on while earlier zips are still downloading and being rewritten.
+    # built once, every member of every downloaded zip is checked against it
+    member_filter = MemberFilter(allowed_extensions) if filter_extensions else None
+    stages = [
+        ('grades', lambda item: fetch_assignment_grades(s, gradebook, item, manifest, dataset), grade_workers),
+        ('browser', lambda item: browsers.run(prepare_assignment_download, waits, auth, item), len(browsers.drivers)),
+        ('download', lambda item: download_assignment(s, item), download_workers),
+        ('rewrite', lambda item: rewrite_assignment(item, unique_ids, downloads_archive, manifest, member_filter, catalog, dataset, similarity), rewrite_workers),
+    ]
+    if strip_comments:
+        # one thread is enough, it keeps several files in flight on the process pool
+        strip_executor = ProcessPoolExecutor(strip_processes)
+        stages.insert(-1, ('strip', lambda item: strip_assignment(item, strip_executor, member_filter), 1))
+    pipeline = Pipeline(stages, queue_size=pipeline_queue_size)
+
     # for each assignment, go to the page and download all submissions
-    print("Going through each assignment to download submissions")
-    print(f"Total Assignments: {len(all_assignments)}")
-    for assignment in all_assignments:
-        course_name = assignment[0]
-        course_id = assignment[1]
-        assignment_id = assignment[2]
-        print(f"\tGoing to submission page of course name: {course_name}, course id: {course_id}, assignment id: {assignment_id}")
-        driver.get(f'{hostname_url}/d2l/lms/dropbox/admin/mark/folder_submissions_files.d2l?d2l_isfromtab=1&db={assignment_id}&ou={course_id}&d2l_change=0')
-        print(f"\tSuccessfully navigated, waiting .1 seconds")
-        sleep(.1)
-
-        # little hack to load all submissions
-        print("\tExecuting script to set '200 per page' to actually use 1000")
-        driver.execute_script("document.evaluate('/html/body/div[2]/div/div[2]/div/div/div/form/div/div/div[2]/div[3]/div/table[2]/tbody/tr/td/table/tbody/tr/td[2]/div/select/option[5]', document, null, XPathResult.ANY_TYPE, null).iterateNext().value = 1000;")
-        print("\tExecuted script, waiting .1 seconds")
-        sleep(.1)
-
-        # get grades
-        # https://lms.augusta.edu/d2l/lms/grades/admin/enter/grade_item_edit.d2l?objectId=597438&ou=398537&dlg=true&d2l_body_type=2
-        print("\tExecuting script to get D2L access token from localStorage")
-        access_token = driver.execute_script("return JSON.parse(localStorage['D2L.Fetch.Tokens'])['*:*:*']['access_token']")
-        print("\tExecuted script")
-        print("\tSetting selenium cookies for requests session")
-        d2lSecureSessionVal = driver.get_cookies()[0]['value']
-        d2lSessionVal = driver.get_cookies()[1]['value']
-        s.headers['Authorization'] = f'Bearer {access_token}'
-        cookies = driver.get_cookies()
-        for cookie in cookies:
-            s.cookies.set(cookie['name'], cookie['value'])
-        print("\tUsing token to get grade object id")
-        response = s.get(f'https://83ea0a02-fd06-4d2d-8623-48ed62e25340.activities.api.brightspace.com/old/activities/6606_2000_{assignment_id}/usages/{course_id}')
-        associated_grade_object_id = response.json()['links'][17]['href'].split('/')[-1]
-        print("\tDone")
-        print("\tUsing grade object id to get assignment grades")
-        response = s.get(f'{hostname_url}/d2l/lms/grades/admin/enter/grade_item_edit.d2l?objectId={associated_grade_object_id}&ou={course_id}&dlg=true&d2l_body_type=2')
-        soup = BeautifulSoup(response.text, 'html.parser')
-        student_id_assignment_grades = {}
-        print("\tParsing Grades")
-        if soup.find('table', id='z_p') is not None:
-            for row in soup.find('table', id='z_p').find_all('tr')[1:]:
-                try:
-                    student_id = row.find('input').get('value').split('_')[1]
-                    assignment_grade = row.find('d2l-input-number').get('value')
-                    student_id_assignment_grades[student_id] = assignment_grade
-                except:
-                    print(f"\tIssue on row: {row.text}, going to next row")
-        print("\tParsed student grades for assignment")
-        print(f"\tTotal student grades for assignment: {len(student_id_assignment_grades)}")
-        table_path = '/html/body/div/div[2]/div[3]/div/div/div/form/div/div[4]/d2l-table-wrapper/table'
-
-        # click on top-left select all box and click download
-        print("\tClicking '200 per page' dropdown box option, which will load 1000")
-        WebDriverWait(driver, 300).until(EC.presence_of_element_located((By.XPATH, '/html/body/div[2]/div/div[2]/div/div/div/form/div/div/div[2]/div[3]/div/table[2]/tbody/tr/td/table/tbody/tr/td[2]/div/select')))
-        driver.find_element(By.XPATH, '/html/body/div[2]/div/div[2]/div/div/div/form/div/div/div[2]/div[3]/div/table[2]/tbody/tr/td/table/tbody/tr/td[2]/div/select').click()
-        WebDriverWait(driver, 300).until(EC.presence_of_element_located((By.XPATH, '/html/body/div[2]/div/div[2]/div/div/div/form/div/div/div[2]/div[3]/div/table[2]/tbody/tr/td/table/tbody/tr/td[2]/div/select/option[5]')))
-        driver.find_element(By.XPATH, '/html/body/div[2]/div/div[2]/div/div/div/form/div/div/div[2]/div[3]/div/table[2]/tbody/tr/td/table/tbody/tr/td[2]/div/select/option[5]').click()
-
-        print("\tClicking 'select all' box")
-        WebDriverWait(driver, 300).until(EC.presence_of_element_located((By.XPATH, '/html/body/div[2]/div/div[2]/div/div/div/form/div/div/div[2]/div[3]/div/d2l-table-wrapper/table/tbody/tr[1]/th[1]/input')))
-        driver.find_element(By.XPATH, '/html/body/div[2]/div/div[2]/div/div/div/form/div/div/div[2]/div[3]/div/d2l-table-wrapper/table/tbody/tr[1]/th[1]/input').click()
-        WebDriverWait(driver, 300).until(EC.presence_of_element_located((By.XPATH, '/html/body/div[2]/div/div[2]/div/div/div/form/div/div/div[2]/div[3]/div/table[1]/tbody/tr/td/table/tbody/tr/td/div/d2l-overflow-group/d2l-button-subtle[1]')))
-
-        # Wait for download window to open and click download
-        print("\tClicking 'Download' and waiting for new window to pop up")
-        driver.find_element(By.XPATH, '/html/body/div[2]/div/div[2]/div/div/div/form/div/div/div[2]/div[3]/div/table[1]/tbody/tr/td/table/tbody/tr/td/div/d2l-overflow-group/d2l-button-subtle[1]').click()
-        WebDriverWait(driver, 300).until(EC.number_of_windows_to_be(2))
-        print("\tNew window appeared, waiting .2 seconds")
-        sleep(.2)
-        print("\tSwitching to new window")
-        driver.switch_to.window(driver.window_handles[1])
-        print("\tSwitching to frame")
-        driver.switch_to.frame(driver.find_element(By.XPATH, '/html/frameset/frame[2]'))
-        print("\tWaiting for download to be ready")
-        try:
-            WebDriverWait(driver, 60).until(EC.element_to_be_clickable((By.XPATH,'/html/body/div/div[1]/div[3]/div/div/div/form/div/div/span/a')))
-        except TimeoutException:
-            print("\tTimed out waiting for download, going to next assignment...")
-            print("\tClosing extra window and going back to main window")
-            driver.switch_to.default_content()
-            driver.close()
-            driver.switch_to.window(driver.window_handles[0])
-            print()
-            continue
-        href = driver.find_element(By.XPATH,'/html/body/div/div[1]/div[3]/div/div/div/form/div/div/span/a').get_attribute('href')
+    log("Going through each assignment to download submissions")
+    log(f"Total Assignments: {len(all_assignments)}")
+    # the main thread only feeds the pipeline and waits for it, the stages' own threads are sampled under their names
+    profiler.set_stage('pipeline_feed')
+    metrics.count('assignments_listed', len(all_assignments))
+    for course_name, course_id, assignment_id in all_assignments:
+        pipeline.put({'course_name': course_name, 'course_id': course_id, 'assignment_id': assignment_id,
+                      'submission_count': submission_counts.get((course_id, assignment_id))})
+
+    # wait for the remaining assignments to go through every stage
+    log("Waiting for remaining downloads to finish")
+    pipeline.close()
+    if strip_comments:
+        strip_executor.shutdown()
+    pipeline.print_report()
+    waits.print_report()
+    if member_filter is not None:
+        member_filter.print_report()
+
+    profiler.set_stage('final_zip')
+    if downloads_archive is not None:
+        # drop the copies of re-downloaded assignments that earlier runs left in downloads.zip
+        log("Removing replaced assignments from downloads.zip")
+        with metrics.timer('final_zip_compact'):
+            downloads_archive.compact()
+    else:
+        # the whole downloads folder in one go, the assignment zips unpacked so zstd compresses the submitted files themselves
+        with metrics.timer('final_tar_zst') as measurement:
+            measurement.bytes, archive_bytes = write_tar_zst(f"{getcwd()}/downloads", f"{getcwd()}/downloads.tar.zst")
+        print(f"Wrote downloads.tar.zst: {measurement.bytes / 1e6:.1f} MB of files in {archive_bytes / 1e6:.1f} MB")
+    manifest.save()
+    catalog.close()
+    if dataset is not None:
+        dataset.close()
+        dataset.print_report()
+    if similarity is not None:
+        similarity.close()
+        similarity.print_report()
+    metrics.print_report()
+    if save_metrics:
+        metrics.write(metrics_path, pipeline=pipeline.summary(), browser_waits=waits.summary(),
+                      extension_filter=member_filter.summary() if member_filter is not None else None,
+                      dataset=dataset.summary() if dataset is not None else None)
+    if profiling:
+        profiler.stop()
+        profiler.print_report()
+        profiler.write(profile_path)
+        print(f"Flame graph stacks written to {profile_path}")
 
-        # Downloads zip and removes all irrelevant files
-        print("\tDownload ready, downloading to /downloads/")
-        download_file(s, href, f"{getcwd()}/downloads/{course_id}_{course_name}_{assignment_id}.zip")
-        print("\tDownload complete")
-        print("\tUnzipping")
-        zip_path = Path(f"{getcwd()}/downloads/{course_id}_{course_name}_{assignment_id}.zip")
-        z = zipfile.ZipFile(zip_path)
-        z.extractall(f"{getcwd()}/downloads/{course_id}_{course_name}_{assignment_id}/")
-        z.close()
-        zip_path.unlink()
-        zip_folder = Path(f"{getcwd()}/downloads/{course_id}_{course_name}_{assignment_id}/")
-        
-        if os.path.isfile(os.path.join(zip_folder, "index.html")):
-            os.remove(os.path.join(zip_folder, "index.html"))
-        print("\tRenaming all files in folder")
-        directory = listdir(zip_folder)
-        print(f"\tNumber of submissions downloaded from assignment: {len(directory)}")
-        for filename in directory:
-            split_filename = filename.split('-')
-            file_student_id = split_filename[0]
-            file_assignment_id = split_filename[1]
-            file_student_name = split_filename[2]
-            file_rest_of_filename = " ".join(str(item) for item in split_filename[3:]).replace('/', '_').replace('\\', '_')
-            
-            if file_student_id in student_id_assignment_grades:
-                print(f"\t\tThere is an associated grade with file")
-                grade = student_id_assignment_grades[file_student_id]
-
-                output_name = f'{grade}%---{incrementing_unique_id}---{file_assignment_id}---{file_rest_of_filename}'
-                incrementing_unique_id+=1
-                print(f"\t\tRenaming file to {output_name}")
-                os.rename(os.path.join(zip_folder, filename), os.path.join(zip_folder, output_name))
-                #os.remove(os.path.join(zip_folder, filename))
-            else:
-                print(f"\t\tThere is no associated grade with file")
-                output_name = f'NA%---{incrementing_unique_id}---{file_assignment_id}---{file_rest_of_filename}'
-                incrementing_unique_id+=1
-                print(f"\t\tRenaming file to {output_name}")
-                os.rename(os.path.join(zip_folder, filename), os.path.join(zip_folder, output_name))
-
-        # directory = listdir(zip_folder)
-        # for filename in directory:
-        #     if not any(filename.endswith(ext) for ext in allowed_extensions):
-        #         # If not, delete the file
-        #         os.remove(os.path.join(zip_folder, filename))
-            # elif filename.endswith('.py'): # if python file, remove comments
-            #     if os.path.isfile(os.path.join(zip_folder, filename)):
-            #         with open(os.path.join(zip_folder, filename), 'r') as fileobj:
-            #             python_code = fileobj.read()
-
-            #         cleaned_python_code = remove_python_comments_and_docstrings(python_code)
-
-            #         with open(os.path.join(zip_folder, filename), 'w') as fileobj:
-            #             fileobj.write(cleaned_python_code)
-
-        print("\tDeleting original files")
-        zip_directory(zip_folder, zip_path)
-        shutil.rmtree(zip_folder)
-        
-        # close download window and go back to main window
-        print("\tWaiting .5 seconds")
-        sleep(.5)
-        print("\tClosing extra window and going back to main window")
-        driver.switch_to.default_content()
-        driver.close()
-        driver.switch_to.window(driver.window_handles[0])
-        sleep(.1)
-        print("\tDone with assignment")
-        print()
-
-    # combine all downloads together into downloads.zip
-    print("Zipping all files together")
-    zip_directory(f"{getcwd()}/downloads", f"{getcwd()}/downloads.zip")
     
     print("finished")
-    # Close the browser
+    # Close the browsers
 
-    driver.quit()
+    browsers.close()
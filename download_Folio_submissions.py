@@ -8,8 +8,25 @@ When finished, it combines all downloaded files into "downloads.zip".
 # Replace with your credentials and preferences
 username = 'username' # just username, no email (i.e. 'as13770' not 'as13770@georgiasouthern.edu')
 password = 'password'
+grade_workers = 4 # how many assignments have their grades fetched at the same time
+browser_workers = 1 # how many browsers prepare downloads at the same time, more than 1 starts extra headless browsers that share the login
+download_workers = 4 # how many assignments are downloaded at the same time
+rewrite_workers = 2 # how many downloaded zips are renamed and added to downloads.zip at the same time
+pipeline_queue_size = 8 # how many assignments can wait between two stages, e.g. prepared by the browser but not downloaded yet
+filter_extensions = True # only keep submitted files whose extension is in allowed_extensions, the rest is never read or written
+strip_comments = False # strip comments and docstrings from Python and C-family source files before they go into downloads.zip
+strip_processes = None # how many processes strip source files, None uses one per CPU
+connection_pool_size = 8 # how many HTTP connections to the LMS are kept open for the download workers
+incremental_sync = True # keep earlier downloads and only fetch assignments whose submissions or grades changed
+use_session_cache = True # reuse the login of an earlier run while it is still valid, so Duo is only needed once the session expires
+enumeration_backend = 'api' # 'api' lists courses and assignments through the Brightspace REST API, 'browser' scrapes the course search pages
+grade_backend = 'api' # 'api' loads each course's gradebook once through the REST API, 'page' reads one grade page per assignment
+archive_format = 'zip' # 'zip' adds each assignment to downloads.zip as it finishes, stored as it is since its members are already deflated (by D2L or the strip stage); 'tar.zst' writes downloads.tar.zst with multi-threaded zstd at the end (pip install zstandard)
+export_dataset = False # write every kept source file with its grade, course and anonymized id into sharded files in dataset/ for training and analysis jobs
+dataset_formats = ['jsonl'] # add 'parquet' for columnar shards as well (pip install pyarrow)
+fingerprint_submissions = False # fingerprint every submission into similarity_index.sqlite while it is rewritten, for near-duplicate lookups (see similarity_index.py)
+save_metrics = True # write the counters and latency histograms of every stage to run_metrics.json at the end
 
-from time import sleep
 from getpass import getuser
 from selenium import webdriver
 from selenium.webdriver.common.by import By
@@ -19,16 +36,28 @@ from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.chrome.service import Service
 #import pickle
 from os.path import isfile
-from os import getcwd,listdir
+from os import getcwd
 import os
 from pathlib import Path
 import requests
-import shutil
-import zipfile
-import re
-import io
-import tokenize
-from bs4 import BeautifulSoup
+from grade_parsers import parse_folio_grades
+from download_pool import make_pooled_session, download_resumable
+from pipeline import Pipeline
+from concurrent.futures import ProcessPoolExecutor
+from source_stripping import strip_zip_members
+from browser_pool import BrowserPool
+from page_waits import WaitTimings, document_ready, network_idle, option_value_is
+from archive_utils import rewrite_zip_members, IncrementalZipArchive, MemberFilter, write_tar_zst, tar_zst_available
+from brightspace_api import authorize_session, browser_fetch_tokens, FetchTokenAuth, list_courses, list_assignments, CourseGradebook
+from session_cache import load_session, save_session, session_is_valid, restore_browser_session
+from sync_manifest import SyncManifest, grade_snapshot_hash
+from run_metrics import RunMetrics
+from submission_catalog import SubmissionCatalog, zip_member_rows
+from dataset_export import DatasetExporter, parquet_available
+from similarity_index import SimilarityIndex
+from time import perf_counter
+from sampling_profiler import SamplingProfiler
+import sys
 #import ast
 
 if username == 'username' or password == 'password':
@@ -36,6 +65,13 @@ if username == 'username' or password == 'password':
     exit()
 
 executable_path = f'{getcwd()}/chromedriver.exe'
+session_cache_path = f'{getcwd()}/session_cache.bin'
+manifest_path = f'{getcwd()}/downloads_manifest.json'
+metrics_path = f'{getcwd()}/run_metrics.json'
+catalog_path = f'{getcwd()}/downloads_catalog.sqlite'
+profile_path = f'{getcwd()}/profile.folded'
+# every stage of the run is timed into this, shared by all worker threads
+metrics = RunMetrics()
 
 hostname_url = 'https://georgiasouthern.desire2learn.com'
 home_url = f'{hostname_url}/d2l/home'
@@ -86,105 +122,218 @@ allowed_extensions = [
 #    '.log',             # Log
 ]
 
-def remove_java_comments(java_code):
-    # Remove single-line comments (//...)
-    single_line_comment_pattern = r"//.*"
-    java_code = re.sub(single_line_comment_pattern, '', java_code)
-
-    # Remove multi-line comments (/*...*/)
-    multi_line_comment_pattern = r"/\*[\s\S]*?\*/"
-    java_code = re.sub(multi_line_comment_pattern, '', java_code)
-
-    return java_code
-
-def remove_python_comments_and_docstrings(source):
-    io_obj = io.StringIO(source)
-    out = ""
-    prev_toktype = tokenize.INDENT
-    last_lineno = -1
-    last_col = 0
-    for tok in tokenize.generate_tokens(io_obj.readline):
-        token_type = tok[0]
-        token_string = tok[1]
-        start_line, start_col = tok[2]
-        end_line, end_col = tok[3]
-        ltext = tok[4]
-        if start_line > last_lineno:
-            last_col = 0
-        if start_col > last_col:
-            out += (" " * (start_col - last_col))
-        if token_type == tokenize.COMMENT:
-            pass
-        elif token_type == tokenize.STRING:
-            if prev_toktype != tokenize.INDENT:
-                if prev_toktype != tokenize.NEWLINE:
-                    if start_col > 0:
-                        out += token_string
-        else:
-            out += token_string
-        prev_toktype = token_type
-        last_col = end_col
-        last_lineno = end_line
-    out = '\n'.join(l for l in out.splitlines() if l.strip())
-    return out
-
 def download_file(session, url, file_path):
-    reply = session.get(url, stream=True)
-    with open(file_path, 'wb') as file:
-        for chunk in reply.iter_content(chunk_size=1024): 
-            if chunk:
-                file.write(chunk)
-
-def zip_directory(folder_path, zip_file_path):
-    with zipfile.ZipFile(zip_file_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-        for root, _, files in os.walk(folder_path):
-            for file in files:
-                file_path = os.path.join(root, file)
-                zipf.write(file_path, os.path.relpath(file_path, folder_path))
+    # retried and resumed where it stopped when the connection drops, the file only appears once it is complete
+    downloaded, _ = download_resumable(session, url, file_path)
+    return downloaded
+
+def submission_member_name(filename, student_id_assignment_grades, unique_ids):
+    # Include grades in filename and remove student names
+    split_filename = filename.split('-')
+    file_student_id = split_filename[0]
+    file_assignment_id = split_filename[1]
+    file_student_name = split_filename[2]
+    file_rest_of_filename = " ".join(str(item) for item in split_filename[3:])
+    if file_student_id in student_id_assignment_grades:
+        grade = student_id_assignment_grades[file_student_id]
+
+        return f'{grade}---{next(unique_ids)}---{file_assignment_id}---{file_rest_of_filename}'
+    return filename
+
+def fetch_grade_page(session, course_id, assignment_id):
+    # get grades
+    # https://lms.augusta.edu/d2l/lms/grades/admin/enter/grade_item_edit.d2l?objectId=597438&ou=398537&dlg=true&d2l_body_type=2
+    with metrics.timer('activities_api'):
+        response = session.get(f'https://05add601-93ff-4b2d-8a27-7363df2a5463.activities.api.brightspace.com/old/activities/6606_2000_{assignment_id}/usages/{course_id}')
+        associated_grade_object_id = response.json()['links'][17]['href'].split('/')[-1]
+    with metrics.timer('grade_page'):
+        response = session.get(f'{hostname_url}/d2l/lms/grades/admin/enter/grade_item_edit.d2l?objectId={associated_grade_object_id}&ou={course_id}&dlg=true&d2l_body_type=2')
+    with metrics.timer('grade_parse'):
+        return parse_folio_grades(response.text)
+
+def fetch_assignment_grades(session, gradebook, item, manifest, dataset):
+    course_id = item['course_id']
+    assignment_id = item['assignment_id']
+    student_id_assignment_grades = None
+    if grade_backend == 'api':
+        try:
+            # the first assignment of a course waits for the whole gradebook, the others are lookups
+            with metrics.timer('gradebook_api'):
+                student_id_assignment_grades = gradebook.assignment_grades(course_id, assignment_id)
+        except (requests.RequestException, KeyError, ValueError) as e:
+            print(f"\tREST API gradebook failed for course {course_id} ({e!r}), reading the grade page instead")
+    if student_id_assignment_grades is None:
+        student_id_assignment_grades = fetch_grade_page(session, course_id, assignment_id)
+    item['grades'] = student_id_assignment_grades
+    item['grades_hash'] = grade_snapshot_hash(student_id_assignment_grades)
+
+    # skip assignments that haven't changed since they were downloaded by an earlier run, and exported if that is on
+    if (incremental_sync and manifest.is_unchanged(course_id, assignment_id, item['submission_count'], item['grades_hash'])
+            and (dataset is None or dataset.exported('folio', course_id, assignment_id))):
+        metrics.count('assignments_unchanged')
+        return None
+    return item
+
+def prepare_assignment_download(driver, waits, auth, item):
+    # everything that needs the browser: have D2L prepare the zip of all submissions and get its link
+    driver.get(f'{hostname_url}/d2l/lms/dropbox/admin/mark/folder_submissions_files.d2l?d2l_isfromtab=1&db={item["assignment_id"]}&ou={item["course_id"]}&d2l_change=0')
+    waits.wait(driver, 'submissions page', EC.presence_of_element_located((By.XPATH, '/html/body/div[2]/div/div[2]/div/div/div/form/div/div/div[2]/div[3]/div/table[2]/tbody/tr/td/table/tbody/tr/td[2]/div/select/option[5]')))
+
+    # little hack to load all submissions
+    driver.execute_script("document.evaluate('/html/body/div[2]/div/div[2]/div/div/div/form/div/div/div[2]/div[3]/div/table[2]/tbody/tr/td/table/tbody/tr/td[2]/div/select/option[5]', document, null, XPathResult.ANY_TYPE, null).iterateNext().value = 1000;")
+    waits.wait(driver, 'page size hack', option_value_is('/html/body/div[2]/div/div[2]/div/div/div/form/div/div/div[2]/div[3]/div/table[2]/tbody/tr/td/table/tbody/tr/td[2]/div/select/option[5]', 1000))
+
+    # keep the token the worker threads use fresh, FetchTokenAuth takes it under its lock
+    with metrics.timer('token_fetch'):
+        auth.update(browser_fetch_tokens(driver))
+
+    table_path = '/html/body/div/div[2]/div[3]/div/div/div/form/div/div[4]/d2l-table-wrapper/table'
+
+    # click on top-left select all box and click download
+    waits.wait(driver, 'page size dropdown', EC.presence_of_element_located((By.XPATH, '/html/body/div[2]/div/div[2]/div/div/div/form/div/div/div[2]/div[3]/div/table[2]/tbody/tr/td/table/tbody/tr/td[2]/div/select')))
+    driver.find_element(By.XPATH, '/html/body/div[2]/div/div[2]/div/div/div/form/div/div/div[2]/div[3]/div/table[2]/tbody/tr/td/table/tbody/tr/td[2]/div/select').click()
+    waits.wait(driver, 'page size option', EC.presence_of_element_located((By.XPATH, '/html/body/div[2]/div/div[2]/div/div/div/form/div/div/div[2]/div[3]/div/table[2]/tbody/tr/td/table/tbody/tr/td[2]/div/select/option[5]')))
+    driver.find_element(By.XPATH, '/html/body/div[2]/div/div[2]/div/div/div/form/div/div/div[2]/div[3]/div/table[2]/tbody/tr/td/table/tbody/tr/td[2]/div/select/option[5]').click()
+    waits.wait(driver, 'select all box', EC.presence_of_element_located((By.XPATH, '/html/body/div[2]/div/div[2]/div/div/div/form/div/div/div[2]/div[3]/div/d2l-table-wrapper/table/tbody/tr[1]/th[1]/input')))
+    driver.find_element(By.XPATH, '/html/body/div[2]/div/div[2]/div/div/div/form/div/div/div[2]/div[3]/div/d2l-table-wrapper/table/tbody/tr[1]/th[1]/input').click()
+    waits.wait(driver, 'download button', EC.presence_of_element_located((By.XPATH, '/html/body/div[2]/div/div[2]/div/div/div/form/div/div/div[2]/div[3]/div/table[1]/tbody/tr/td/table/tbody/tr/td/div/d2l-overflow-group/d2l-button-subtle[1]')))
+
+    # Wait for download window to open and click download
+    driver.find_element(By.XPATH, '/html/body/div[2]/div/div[2]/div/div/div/form/div/div/div[2]/div[3]/div/table[1]/tbody/tr/td/table/tbody/tr/td/div/d2l-overflow-group/d2l-button-subtle[1]').click()
+    waits.wait(driver, 'download popup', EC.number_of_windows_to_be(2))
+    driver.switch_to.window(driver.window_handles[1])
+    waits.wait(driver, 'download popup frame', EC.frame_to_be_available_and_switch_to_it((By.XPATH, '/html/frameset/frame[2]')))
+    waits.wait(driver, 'download ready', EC.element_to_be_clickable((By.XPATH,'/html/body/div/div[1]/div[3]/div/div/div/form/div/div/span/a')))
+    href = driver.find_element(By.XPATH,'/html/body/div/div[1]/div[3]/div/div/div/form/div/div/span/a').get_attribute('href')
+
+    # close download window and go back to main window
+    driver.switch_to.default_content()
+    driver.close()
+    waits.wait(driver, 'popup closed', EC.number_of_windows_to_be(1))
+    driver.switch_to.window(driver.window_handles[0])
+    item['href'] = href
+    return item
+
+def download_assignment(session, item):
+    item['download_path'] = Path(f"{getcwd()}/downloads/{item['course_id']}_{item['course_name']}_{item['assignment_id']}.download.zip")
+    with metrics.timer('download') as measurement:
+        item['stage_bytes'] = measurement.bytes = download_file(session, item['href'], item['download_path'])
+    return item
+
+def strip_assignment(item, executor, member_filter):
+    # strips the source files of the downloaded zip on the process pool, the rewrite stage then reads the stripped copy
+    download_path = item['download_path']
+    stripped_path = download_path.with_suffix('.stripped.zip')
+    with metrics.timer('strip') as measurement:
+        bytes_in, _ = strip_zip_members(download_path, stripped_path, executor, member_filter=member_filter)
+        measurement.bytes = bytes_in
+    download_path.unlink()
+    # the stripped copy only has allowed files left, so the rewrite stage doesn't filter or count them again
+    item['download_path'] = stripped_path
+    item['filtered'] = True
+    item['stage_bytes'] = bytes_in
+    return item
+
+def rewrite_assignment(item, unique_ids, downloads_archive, manifest, member_filter, catalog, dataset, similarity):
+    # copies the downloaded zip's members, renamed and without index.html, straight into the final zip
+    download_path = item['download_path']
+    zip_path = Path(f"{getcwd()}/downloads/{item['course_id']}_{item['course_name']}_{item['assignment_id']}.zip")
+    rename = lambda filename: submission_member_name(filename, item['grades'], unique_ids)
+    # files with other extensions are skipped while the zip is read, they never reach the disk
+    with metrics.timer('rewrite') as measurement:
+        measurement.bytes = download_path.stat().st_size
+        rewrite_zip_members(download_path, zip_path, rename, member_filter=None if item.get('filtered') else member_filter)
+
+    download_path.unlink()
+
+    if downloads_archive is not None:
+        # add the finished assignment to downloads.zip right away so an interrupted run keeps it
+        with metrics.timer('final_zip') as measurement:
+            measurement.bytes = zip_path.stat().st_size
+            downloads_archive.add_file(zip_path, zip_path.name)
+    # one catalog row per kept file, replacing the rows of an earlier download of the assignment
+    with metrics.timer('catalog'):
+        catalog.replace_assignment('folio', item['course_id'], item['course_name'], item['assignment_id'], None, zip_member_rows(zip_path, zip_path.name))
+    if dataset is not None:
+        with metrics.timer('dataset_export'):
+            dataset.add_zip(zip_path, zip_path.name, 'folio', item['course_id'], item['course_name'], item['assignment_id'])
+    if similarity is not None:
+        with metrics.timer('fingerprint'):
+            similarity.add_zip(zip_path, 'folio', item['course_id'], item['course_name'], item['assignment_id'])
+    manifest.record(item['course_id'], item['assignment_id'], item['submission_count'], item['grades_hash'], zip_path)
+    return item
+
+def start_browser(headless):
+    options = webdriver.ChromeOptions()
+
+    # Use existing broswer session. Warning: Will close all tabs
+    #options.add_argument(f'user-data-dir=C:/Users/{getuser()}/AppData/Local/Google/Chrome/User Data/')
+    prefs = {'download.prompt_for_download': False,
+            'download.default_directory': f"{getcwd()}/downloads",
+            'download.directory_upgrage': True,
+            'profile.default_content_settings.popups': 0,
+            }
+    options.add_experimental_option("prefs",prefs)
+
+    if headless:
+        options.add_argument("--headless")
+    return webdriver.Chrome(options=options, service = Service(executable_path))
 
 if __name__ == '__main__':
+    if archive_format == 'tar.zst' and not tar_zst_available():
+        print("archive_format 'tar.zst' needs the zstandard package: pip install zstandard")
+        exit()
+    if export_dataset and 'parquet' in dataset_formats and not parquet_available():
+        print("dataset_formats 'parquet' needs the pyarrow package: pip install pyarrow")
+        exit()
+
+    # run with --profile to sample every thread's stack for the whole run, see sampling_profiler.py
+    profiling = '--profile' in sys.argv
+    profiler = SamplingProfiler()
+    if profiling:
+        profiler.start()
+    profiler.set_stage('setup')
 
     # make directory if it doesn't exist
     if not os.path.exists(f"{getcwd()}/downloads/"):
         os.makedirs(f"{getcwd()}/downloads/")
-    else:
+    elif not incremental_sync:
         for root, dirs, files in os.walk(f"{getcwd()}/downloads/", topdown=False):
             for directory in dirs:
                 os.rmdir(os.path.join(root, directory))
             for file in files:
                 os.remove(os.path.join(root, file))
 
-    if os.path.isfile(os.path.join(f"{getcwd()}", "downloads.zip")):
+    if not incremental_sync and os.path.isfile(os.path.join(f"{getcwd()}", "downloads.zip")):
         os.remove(os.path.join(f"{getcwd()}", "downloads.zip"))
 
-    s = requests.Session()
+    # downloads.zip is built up as each assignment finishes, downloads.tar.zst is written in one go at the end.
+    # No compression executor: the archive's members are the assignment zips, which are stored as they are
+    downloads_archive = IncrementalZipArchive(f"{getcwd()}/downloads.zip") if archive_format == 'zip' else None
+    # what earlier runs downloaded, starts over when the old downloads were just deleted
+    manifest = SyncManifest(manifest_path, reset=not incremental_sync)
+    # indexed list of every file in downloads.zip, see submission_catalog.py for querying it
+    catalog = SubmissionCatalog(catalog_path, reset=not incremental_sync)
+    # the kept source files as JSONL/Parquet shards, see dataset_export.py
+    dataset = DatasetExporter(f"{getcwd()}/dataset", dataset_formats, reset=not incremental_sync) if export_dataset else None
+    # winnowing/MinHash fingerprints of every submission in an LSH index, see similarity_index.py
+    similarity = SimilarityIndex(f"{getcwd()}/similarity_index.sqlite", reset=not incremental_sync) if fingerprint_submissions else None
 
-    # Initialize the WebDriver and authenticate
-    options = webdriver.ChromeOptions()
+    s = make_pooled_session(connection_pool_size)
 
-    # Use existing broswer session. Warning: Will close all tabs
-    #options.add_argument(f'user-data-dir=C:/Users/{getuser()}/AppData/Local/Google/Chrome/User Data/')
-    prefs = {'download.prompt_for_download': False,
-            'download.default_directory': f"{getcwd()}/downloads",
-            'download.directory_upgrage': True,
-            'profile.default_content_settings.popups': 0,
-            }
-    options.add_experimental_option("prefs",prefs)
-    
-    options.add_argument("--headless")
-    driver = webdriver.Chrome(options=options, service = Service(executable_path))
+    # Initialize the WebDriver and authenticate
+    driver = start_browser(headless=True)
     original_window = driver.current_window_handle
-
-    '''
-    # Go to homepage and load previously stored cookies if they exist
-    driver.get(home_url)
-    if isfile("cookies.pkl"):
-        cookies = pickle.load(open("cookies.pkl", "rb"))
-        for cookie in cookies:
-            driver.add_cookie(cookie)
-    driver.refresh()
-    sleep(1)
-    '''
+    # every wait on the page is timed for the report at the end
+    waits = WaitTimings()
+
+    # Go to homepage and load the cookies of an earlier run if that session is still valid
+    login_start = perf_counter()
+    profiler.set_stage('login')
+    if use_session_cache:
+        cached_session = load_session(session_cache_path)
+        if cached_session is not None and session_is_valid(s, hostname_url, cached_session['cookies']):
+            restore_browser_session(driver, hostname_url, home_url, cached_session)
     # If cookies do not exist or session is expired, go through Duo auth process
     if driver.current_url != home_url:
         driver.get(login_url)
@@ -194,10 +343,10 @@ if __name__ == '__main__':
         WebDriverWait(driver, 50).until(EC.presence_of_element_located((By.XPATH, '//*[@id="duo_iframe"]')))
         driver.switch_to.frame(driver.find_element(By.XPATH, '//*[@id="duo_iframe"]'))
         WebDriverWait(driver, 50).until(EC.presence_of_element_located((By.XPATH, '//*[@id="auth_methods"]/fieldset/div[1]/button')))
-        sleep(1)
+        waits.wait(driver, 'duo remember me', EC.element_to_be_clickable((By.XPATH, '/html/body/div/div/div[1]/div/form/div[2]/div/label/input')))
         driver.find_element(By.XPATH, '/html/body/div/div/div[1]/div/form/div[2]/div/label/input').click()
         #duo_push = driver.find_element(By.CLASS_NAME, 'row-label push-label')
-        sleep(1)
+        waits.wait(driver, 'duo push button', EC.element_to_be_clickable((By.XPATH, '//*[@id="auth_methods"]/fieldset/div[1]/button')))
         driver.find_element(By.XPATH, '//*[@id="auth_methods"]/fieldset/div[1]/button').click()
         driver.switch_to.default_content()
     WebDriverWait(driver, 50).until(EC.url_to_be(home_url) or EC.url_to_be(session_expired_url))
@@ -205,181 +354,180 @@ if __name__ == '__main__':
         driver.get(home_url)
 
     WebDriverWait(driver, 30).until(EC.url_to_be(home_url))
+    # includes the time waiting for the Duo push to be accepted
+    metrics.observe('login', perf_counter() - login_start)
 
-    # Dumping cookies so it doesn't need to login every time
+    # Saving cookies so it doesn't need to login every time
     cookies = driver.get_cookies()
-    # pickle.dump(cookies, open("cookies.pkl", "wb"))
+    if use_session_cache:
+        fetch_tokens = driver.execute_script("return localStorage['D2L.Fetch.Tokens'] || null")
+        save_session(session_cache_path, cookies, fetch_tokens)
 
     for cookie in cookies:
         s.cookies.set(cookie['name'], cookie['value'])
 
-    # Wait for the page to load
-    driver.get(advanced_course_search_url)
-    WebDriverWait(driver, 10).until(EC.presence_of_element_located((By.XPATH, '/html/body/div[2]/div/div[3]/d2l-input-search')))
-
-    # only get CSCI courses
-    driver.find_element(By.XPATH, "/html/body/div[2]/div/div[3]/d2l-input-search").send_keys("CSCI")
-    driver.find_element(By.XPATH, "/html/body/div[2]/div/div[3]/d2l-input-search").send_keys(Keys.ENTER)
-
-    # only get courses in which the user was an Instructor
-    driver.find_element(By.XPATH, "/html/body/div[2]/div/form/div[1]/div/div/div/div/div[1]/div/select").click()
-    driver.find_element(By.XPATH, "/html/body/div[2]/div/form/div[1]/div/div/div/div/div[1]/div/select/option[2]").click()
-
-    # little hack to load all courses
-    driver.execute_script("document.evaluate('/html/body/div[2]/div/div[5]/div/div/div[2]/div/div/div[2]/div/select/option[4]', document, null, XPathResult.ANY_TYPE, null).iterateNext().value = 1000;")
-    sleep(2)
-    WebDriverWait(driver, 10).until(EC.presence_of_element_located((By.XPATH, '/html/body/div[2]/div/div[5]/div/div/div[2]/div/div/div[2]/div/select')))
-    sleep(2)
-    driver.find_element(By.XPATH, '/html/body/div[2]/div/div[5]/div/div/div[2]/div/div/div[2]/div/select').click()
-    WebDriverWait(driver, 10).until(EC.presence_of_element_located((By.XPATH, '/html/body/div[2]/div/div[5]/div/div/div[2]/div/div/div[2]/div/select/option[4]')))
-    driver.find_element(By.XPATH, '/html/body/div[2]/div/div[5]/div/div/div[2]/div/div/div[2]/div/select/option[4]').click()
-    sleep(2)
-
-    # loop through table of courses and add each course name and id to a list
-    courses = []
-    table = driver.find_element(By.XPATH, '/html/body/div[2]/div/div[5]/div/div/d2l-table-wrapper/table').find_elements(By.CLASS_NAME, 'd2l-link')
-    for row in table:
-        course_name = row.text
-        course_id = row.get_attribute("href").split("/")[-1]
-        courses.append((course_name, course_id))
-
-    # visit each course's page and get all of the assignments
+    profiler.set_stage('course_enumeration')
     all_assignments = []
-    for course in courses:
-        course_name = course[0]
-        course_id = course[1]
-        driver.get(f"{hostname_url}/d2l/lms/dropbox/admin/folders_manage.d2l?ou={course_id}&d2l_stateScopes=%7B%221%22%3A%5B%22gridpagenum%22,%22search%22,%22pagenum%22%5D,%222%22%3A%5B%22lcs%22%5D,%223%22%3A%5B%22grid%22,%22pagesize%22,%22htmleditor%22,%22hpg%22%5D%7D&d2l_stateGroups=%5B%22grid%22,%22gridpagenum%22%5D&d2l_statePageId=223&d2l_state_grid=%7B%22Name%22%3A%22grid%22,%22Controls%22%3A%5B%7B%22ControlId%22%3A%7B%22ID%22%3A%22grid_main%22%7D,%22StateType%22%3A%22%22,%22Key%22%3A%22%22,%22Name%22%3A%22gridFolders%22,%22State%22%3A%7B%22PageSize%22%3A%222000%22,%22SortField%22%3A%22DropBoxId%22,%22SortDir%22%3A0%7D%7D%5D%7D&d2l_state_gridpagenum=%7B%22Name%22%3A%22gridpagenum%22,%22Controls%22%3A%5B%7B%22ControlId%22%3A%7B%22ID%22%3A%22grid_main%22%7D,%22StateType%22%3A%22pagenum%22,%22Key%22%3A%22%22,%22Name%22%3A%22gridFolders%22,%22State%22%3A%7B%22PageNum%22%3A1%7D%7D%5D%7D&d2l_change=1")
-        sleep(1)
-
-        # If there are no assignments, go to next course
+    submission_counts = {}
+    if enumeration_backend == 'api':
+        # list courses and assignments as JSON with the token and cookies the login left behind
         try:
-            table = driver.find_element(By.XPATH, '/html/body/div[2]/div/div[2]/div/div/div[2]/form/div/div/div/div/d2l-table-wrapper/table/tbody')
-        except:
-            continue
-
-        # find all elements with "d2l-link" in the class name. This is only contained within the assignment links. I'm not aware of it being contained anywhere else.
-        table_inner_rows = table.find_elements(By.CLASS_NAME, 'd2l-link')
-
-        # go through each row in table on the assignments page
-        for row in table_inner_rows:
-            # If a row doesn't have text, like a new category(?), skip it
-            if row.text == '':
+            access_token = driver.execute_script("return JSON.parse(localStorage['D2L.Fetch.Tokens'] || '{}')['*:*:*']?.['access_token']")
+            authorize_session(s, access_token, driver.get_cookies())
+            with metrics.timer('course_enumeration'):
+                courses = list_courses(s, hostname_url, course_prefix='CSCI', role_name='Instructor')
+            all_assignments = list_assignments(s, hostname_url, courses, count_field='TotalUsersWithFeedback', max_workers=connection_pool_size, submission_counts=submission_counts, metrics=metrics)
+        except (requests.RequestException, KeyError, ValueError) as e:
+            print(f"REST API listing failed ({e!r}), falling back to the course search pages")
+            enumeration_backend = 'browser'
+
+    if enumeration_backend == 'browser':
+        course_search_start = perf_counter()
+        # Wait for the page to load
+        driver.get(advanced_course_search_url)
+        WebDriverWait(driver, 10).until(EC.presence_of_element_located((By.XPATH, '/html/body/div[2]/div/div[3]/d2l-input-search')))
+
+        # only get CSCI courses
+        driver.find_element(By.XPATH, "/html/body/div[2]/div/div[3]/d2l-input-search").send_keys("CSCI")
+        driver.find_element(By.XPATH, "/html/body/div[2]/div/div[3]/d2l-input-search").send_keys(Keys.ENTER)
+
+        # only get courses in which the user was an Instructor
+        driver.find_element(By.XPATH, "/html/body/div[2]/div/form/div[1]/div/div/div/div/div[1]/div/select").click()
+        driver.find_element(By.XPATH, "/html/body/div[2]/div/form/div[1]/div/div/div/div/div[1]/div/select/option[2]").click()
+
+        # little hack to load all courses
+        driver.execute_script("document.evaluate('/html/body/div[2]/div/div[5]/div/div/div[2]/div/div/div[2]/div/select/option[4]', document, null, XPathResult.ANY_TYPE, null).iterateNext().value = 1000;")
+        waits.wait(driver, 'course search results', network_idle(), 10, required=False)
+        waits.wait(driver, 'course page size dropdown', EC.presence_of_element_located((By.XPATH, '/html/body/div[2]/div/div[5]/div/div/div[2]/div/div/div[2]/div/select')), 10)
+        driver.find_element(By.XPATH, '/html/body/div[2]/div/div[5]/div/div/div[2]/div/div/div[2]/div/select').click()
+        WebDriverWait(driver, 10).until(EC.presence_of_element_located((By.XPATH, '/html/body/div[2]/div/div[5]/div/div/div[2]/div/div/div[2]/div/select/option[4]')))
+        driver.find_element(By.XPATH, '/html/body/div[2]/div/div[5]/div/div/div[2]/div/div/div[2]/div/select/option[4]').click()
+        waits.wait(driver, 'course list', network_idle(), 10, required=False)
+
+        # loop through table of courses and add each course name and id to a list
+        courses = []
+        table = driver.find_element(By.XPATH, '/html/body/div[2]/div/div[5]/div/div/d2l-table-wrapper/table').find_elements(By.CLASS_NAME, 'd2l-link')
+        for row in table:
+            course_name = row.text
+            course_id = row.get_attribute("href").split("/")[-1]
+            courses.append((course_name, course_id))
+        metrics.observe('course_enumeration', perf_counter() - course_search_start)
+
+        # visit each course's page and get all of the assignments
+        profiler.set_stage('assignment_scrape')
+        for course in courses:
+            course_start = perf_counter()
+            course_name = course[0]
+            course_id = course[1]
+            driver.get(f"{hostname_url}/d2l/lms/dropbox/admin/folders_manage.d2l?ou={course_id}&d2l_stateScopes=%7B%221%22%3A%5B%22gridpagenum%22,%22search%22,%22pagenum%22%5D,%222%22%3A%5B%22lcs%22%5D,%223%22%3A%5B%22grid%22,%22pagesize%22,%22htmleditor%22,%22hpg%22%5D%7D&d2l_stateGroups=%5B%22grid%22,%22gridpagenum%22%5D&d2l_statePageId=223&d2l_state_grid=%7B%22Name%22%3A%22grid%22,%22Controls%22%3A%5B%7B%22ControlId%22%3A%7B%22ID%22%3A%22grid_main%22%7D,%22StateType%22%3A%22%22,%22Key%22%3A%22%22,%22Name%22%3A%22gridFolders%22,%22State%22%3A%7B%22PageSize%22%3A%222000%22,%22SortField%22%3A%22DropBoxId%22,%22SortDir%22%3A0%7D%7D%5D%7D&d2l_state_gridpagenum=%7B%22Name%22%3A%22gridpagenum%22,%22Controls%22%3A%5B%7B%22ControlId%22%3A%7B%22ID%22%3A%22grid_main%22%7D,%22StateType%22%3A%22pagenum%22,%22Key%22%3A%22%22,%22Name%22%3A%22gridFolders%22,%22State%22%3A%7B%22PageNum%22%3A1%7D%7D%5D%7D&d2l_change=1")
+            waits.wait(driver, 'assignments page', document_ready, 10, required=False)
+
+            # If there are no assignments, go to next course
+            try:
+                table = driver.find_element(By.XPATH, '/html/body/div[2]/div/div[2]/div/div/div[2]/form/div/div/div/div/d2l-table-wrapper/table/tbody')
+            except:
+                metrics.observe('assignment_scrape', perf_counter() - course_start)
                 continue
-            evaluated_assignment_string = row.find_elements(By.XPATH, './parent::*/parent::*/parent::*/parent::*/parent::*/parent::*/parent::*/parent::*/*')[4].text
-            if evaluated_assignment_string != '':
-                evaluated_assignment = eval(evaluated_assignment_string)
-                if evaluated_assignment > 0:
-                    assignment_id = row.get_attribute("href").split("?db=")[1].split("&")[0]
-                    all_assignments.append((course[0], course[1], assignment_id))
 
-    incrementing_unique_id = 0
+            # find all elements with "d2l-link" in the class name. This is only contained within the assignment links. I'm not aware of it being contained anywhere else.
+            table_inner_rows = table.find_elements(By.CLASS_NAME, 'd2l-link')
+
+            # go through each row in table on the assignments page
+            for row in table_inner_rows:
+                # If a row doesn't have text, like a new category(?), skip it
+                if row.text == '':
+                    continue
+                evaluated_assignment_string = row.find_elements(By.XPATH, './parent::*/parent::*/parent::*/parent::*/parent::*/parent::*/parent::*/parent::*/*')[4].text
+                if evaluated_assignment_string != '':
+                    evaluated_assignment = eval(evaluated_assignment_string)
+                    if evaluated_assignment > 0:
+                        assignment_id = row.get_attribute("href").split("?db=")[1].split("&")[0]
+                        all_assignments.append((course[0], course[1], assignment_id))
+                        submission_counts[(course[1], assignment_id)] = evaluated_assignment
+            metrics.observe('assignment_scrape', perf_counter() - course_start)
+
+    # ids that replace student names, continuing from earlier runs; safe to share between the workers
+    unique_ids = manifest.unique_ids
+
+    # the grade and download requests need the D2L access token and cookies from the browser. The cookies are set once
+    # here, before the stages share the session. The token expires during a long run: FetchTokenAuth holds it for the
+    # workers, the browser stage hands it the token of every page it loads, and a request that still gets a 401
+    # waits for an idle browser of the pool to read a new one
+    authorize_session(s, None, driver.get_cookies())
+    s.headers.pop('Authorization', None)
+    auth = FetchTokenAuth(lambda: browsers.run(browser_fetch_tokens))
+    with metrics.timer('token_fetch'):
+        auth.update(browser_fetch_tokens(driver))
+    s.auth = auth
+    # grades of a whole course are loaded the first time one of its assignments reaches the grades stage
+    gradebook = CourseGradebook(s, hostname_url)
+    # extra headless browsers get the login of this one, each prepares the downloads of different assignments
+    browsers = BrowserPool(driver, lambda: start_browser(headless=True), hostname_url, home_url, browser_workers)
+
+    # grades are fetched ahead of the browser so unchanged assignments never open the download popup.
+    # The browser only prepares each download, so it can move on while earlier zips are still downloading and being rewritten.
+    # built once, every member of every downloaded zip is checked against it
+    member_filter = MemberFilter(allowed_extensions) if filter_extensions else None
+    stages = [
+        ('grades', lambda item: fetch_assignment_grades(s, gradebook, item, manifest, dataset), grade_workers),
+        ('browser', lambda item: browsers.run(prepare_assignment_download, waits, auth, item), len(browsers.drivers)),
+        ('download', lambda item: download_assignment(s, item), download_workers),
+        ('rewrite', lambda item: rewrite_assignment(item, unique_ids, downloads_archive, manifest, member_filter, catalog, dataset, similarity), rewrite_workers),
+    ]
+    if strip_comments:
+        # one thread is enough, it keeps several files in flight on the process pool
+        strip_executor = ProcessPoolExecutor(strip_processes)
+        stages.insert(-1, ('strip', lambda item: strip_assignment(item, strip_executor, member_filter), 1))
+    pipeline = Pipeline(stages, queue_size=pipeline_queue_size)
 
     # for each assignment, go to the page and download all submissions
-    for assignment in all_assignments:
-        course_name = assignment[0]
-        course_id = assignment[1]
-        assignment_id = assignment[2]
-        driver.get(f'{hostname_url}/d2l/lms/dropbox/admin/mark/folder_submissions_files.d2l?d2l_isfromtab=1&db={assignment_id}&ou={course_id}&d2l_change=0')
-        sleep(.5)
-
-        # little hack to load all submissions
-        driver.execute_script("document.evaluate('/html/body/div[2]/div/div[2]/div/div/div/form/div/div/div[2]/div[3]/div/table[2]/tbody/tr/td/table/tbody/tr/td[2]/div/select/option[5]', document, null, XPathResult.ANY_TYPE, null).iterateNext().value = 1000;")
-        sleep(.5)
-
-        # get grades
-        # https://lms.augusta.edu/d2l/lms/grades/admin/enter/grade_item_edit.d2l?objectId=597438&ou=398537&dlg=true&d2l_body_type=2
-        access_token = driver.execute_script("return JSON.parse(localStorage['D2L.Fetch.Tokens'])['*:*:*']['access_token']")
-        d2lSecureSessionVal = driver.get_cookies()[0]['value']
-        d2lSessionVal = driver.get_cookies()[1]['value']
-        s.headers['Authorization'] = f'Bearer {access_token}'
-        response = s.get(f'https://05add601-93ff-4b2d-8a27-7363df2a5463.activities.api.brightspace.com/old/activities/6606_2000_{assignment_id}/usages/{course_id}')
-        associated_grade_object_id = response.json()['links'][17]['href'].split('/')[-1]
-        response = s.get(f'{hostname_url}/d2l/lms/grades/admin/enter/grade_item_edit.d2l?objectId={associated_grade_object_id}&ou={course_id}&dlg=true&d2l_body_type=2')
-        soup = BeautifulSoup(response.text, 'html.parser')
-        student_id_assignment_grades = {}
-        for row in soup.find('table', id='z_p').find_all('tr')[1:]:
-            student_id = row.find('input').get('value').split('_')[1]
-            assignment_grade = row.find_all('input')[4].get('value')
-            student_id_assignment_grades[student_id] = assignment_grade
-        table_path = '/html/body/div/div[2]/div[3]/div/div/div/form/div/div[4]/d2l-table-wrapper/table'
-
-        # click on top-left select all box and click download
-        WebDriverWait(driver, 30).until(EC.presence_of_element_located((By.XPATH, '/html/body/div[2]/div/div[2]/div/div/div/form/div/div/div[2]/div[3]/div/table[2]/tbody/tr/td/table/tbody/tr/td[2]/div/select')))
-        driver.find_element(By.XPATH, '/html/body/div[2]/div/div[2]/div/div/div/form/div/div/div[2]/div[3]/div/table[2]/tbody/tr/td/table/tbody/tr/td[2]/div/select').click()
-        WebDriverWait(driver, 30).until(EC.presence_of_element_located((By.XPATH, '/html/body/div[2]/div/div[2]/div/div/div/form/div/div/div[2]/div[3]/div/table[2]/tbody/tr/td/table/tbody/tr/td[2]/div/select/option[5]')))
-        driver.find_element(By.XPATH, '/html/body/div[2]/div/div[2]/div/div/div/form/div/div/div[2]/div[3]/div/table[2]/tbody/tr/td/table/tbody/tr/td[2]/div/select/option[5]').click()
-        WebDriverWait(driver, 30).until(EC.presence_of_element_located((By.XPATH, '/html/body/div[2]/div/div[2]/div/div/div/form/div/div/div[2]/div[3]/div/d2l-table-wrapper/table/tbody/tr[1]/th[1]/input')))
-        driver.find_element(By.XPATH, '/html/body/div[2]/div/div[2]/div/div/div/form/div/div/div[2]/div[3]/div/d2l-table-wrapper/table/tbody/tr[1]/th[1]/input').click()
-        WebDriverWait(driver, 30).until(EC.presence_of_element_located((By.XPATH, '/html/body/div[2]/div/div[2]/div/div/div/form/div/div/div[2]/div[3]/div/table[1]/tbody/tr/td/table/tbody/tr/td/div/d2l-overflow-group/d2l-button-subtle[1]')))
-
-        # Wait for download window to open and click download
-        driver.find_element(By.XPATH, '/html/body/div[2]/div/div[2]/div/div/div/form/div/div/div[2]/div[3]/div/table[1]/tbody/tr/td/table/tbody/tr/td/div/d2l-overflow-group/d2l-button-subtle[1]').click()
-        WebDriverWait(driver, 30).until(EC.number_of_windows_to_be(2))
-        sleep(.2)
-        driver.switch_to.window(driver.window_handles[1])
-        driver.switch_to.frame(driver.find_element(By.XPATH, '/html/frameset/frame[2]'))
-        WebDriverWait(driver, 30).until(EC.element_to_be_clickable((By.XPATH,'/html/body/div/div[1]/div[3]/div/div/div/form/div/div/span/a')))
-        href = driver.find_element(By.XPATH,'/html/body/div/div[1]/div[3]/div/div/div/form/div/div/span/a').get_attribute('href')
-
-        # Downloads zip and removes all irrelevant files
-        download_file(s, href, f"{getcwd()}/downloads/{course_id}_{course_name}_{assignment_id}.zip")
-        zip_path = Path(f"{getcwd()}/downloads/{course_id}_{course_name}_{assignment_id}.zip")
-        z = zipfile.ZipFile(zip_path)
-        z.extractall(f"{getcwd()}/downloads/{course_id}_{course_name}_{assignment_id}/")
-        z.close()
-        zip_path.unlink()
-        zip_folder = Path(f"{getcwd()}/downloads/{course_id}_{course_name}_{assignment_id}/")
-        
-        if os.path.isfile(os.path.join(zip_folder, "index.html")):
-            os.remove(os.path.join(zip_folder, "index.html"))
-
-        # Include grades in filename and remove student names
-        directory = listdir(zip_folder)
-        for filename in directory:
-            split_filename = filename.split('-')
-            file_student_id = split_filename[0]
-            file_assignment_id = split_filename[1]
-            file_student_name = split_filename[2]
-            file_rest_of_filename = " ".join(str(item) for item in split_filename[3:])
-            if file_student_id in student_id_assignment_grades:
-                grade = student_id_assignment_grades[file_student_id]
-
-                output_name = f'{grade}---{incrementing_unique_id}---{file_assignment_id}---{file_rest_of_filename}'
-                incrementing_unique_id+=1
-
-                os.rename(os.path.join(zip_folder, filename), os.path.join(zip_folder, output_name))
-                #os.remove(os.path.join(zip_folder, filename))
-
-        # directory = listdir(zip_folder)
-        # for filename in directory:
-        #     if not any(filename.endswith(ext) for ext in allowed_extensions):
-        #         # If not, delete the file
-        #         os.remove(os.path.join(zip_folder, filename))
-        #     # elif filename.endswith('.py'): # if python file, remove comments
-        #     #     if os.path.isfile(os.path.join(zip_folder, filename)):
-        #     #         with open(os.path.join(zip_folder, filename), 'r') as fileobj:
-        #     #             python_code = fileobj.read()
-
-        #     #         cleaned_python_code = remove_python_comments_and_docstrings(python_code)
-
-        #     #         with open(os.path.join(zip_folder, filename), 'w') as fileobj:
-        #     #             fileobj.write(cleaned_python_code)
-
-        
-        zip_directory(zip_folder, zip_path)
-        shutil.rmtree(zip_folder)
-        
-        # close download window and go back to main window
-        sleep(.5)
-        driver.switch_to.default_content()
-        driver.close()
-        driver.switch_to.window(driver.window_handles[0])
-        sleep(.1)
+    # the main thread only feeds the pipeline and waits for it, the stages' own threads are sampled under their names
+    profiler.set_stage('pipeline_feed')
+    metrics.count('assignments_listed', len(all_assignments))
+    for course_name, course_id, assignment_id in all_assignments:
+        pipeline.put({'course_name': course_name, 'course_id': course_id, 'assignment_id': assignment_id,
+                      'submission_count': submission_counts.get((course_id, assignment_id))})
+
+    # wait for the remaining assignments to go through every stage
+    pipeline.close()
+    if strip_comments:
+        strip_executor.shutdown()
+    pipeline.print_report()
+    waits.print_report()
+    if member_filter is not None:
+        member_filter.print_report()
+
+    profiler.set_stage('final_zip')
+    if downloads_archive is not None:
+        # drop the copies of re-downloaded assignments that earlier runs left in downloads.zip
+        with metrics.timer('final_zip_compact'):
+            downloads_archive.compact()
+    else:
+        # the whole downloads folder in one go, the assignment zips unpacked so zstd compresses the submitted files themselves
+        with metrics.timer('final_tar_zst') as measurement:
+            measurement.bytes, archive_bytes = write_tar_zst(f"{getcwd()}/downloads", f"{getcwd()}/downloads.tar.zst")
+        print(f"Wrote downloads.tar.zst: {measurement.bytes / 1e6:.1f} MB of files in {archive_bytes / 1e6:.1f} MB")
+    manifest.save()
+    catalog.close()
+    if dataset is not None:
+        dataset.close()
+        dataset.print_report()
+    if similarity is not None:
+        similarity.close()
+        similarity.print_report()
+    metrics.print_report()
+    if save_metrics:
+        metrics.write(metrics_path, pipeline=pipeline.summary(), browser_waits=waits.summary(),
+                      extension_filter=member_filter.summary() if member_filter is not None else None,
+                      dataset=dataset.summary() if dataset is not None else None)
+    if profiling:
+        profiler.stop()
+        profiler.print_report()
+        profiler.write(profile_path)
+        print(f"Flame graph stacks written to {profile_path}")
 
-    # combine all downloads together into downloads.zip
-    zip_directory(f"{getcwd()}/downloads", f"{getcwd()}/downloads.zip")
     # example_link = f'{hostname_url}/d2l/common/viewFile.d2lfile/Temp/1680069530636/Completed%20Course%20Evaluation%20Download%20Mar%2029,%202023%20158%20AM.zip?ou=653373&fid=MDg4ZTY0MjQ0OWZhY2EwNDFiZDhlZmNlNDhkZmQ4OTk0YzkwMDExMDE5OTg3MDcuemlwO0NvbXBsZXRlZCBDb3Vyc2UgRXZhbHVhdGlvbiBEb3dubG9hZCBNYXIgMjksIDIwMjMgMTU4IEFNLnppcA'
     print("finished")
-    # Close the browser
+    # Close the browsers
 
-    driver.quit()
+    browsers.close()
@@ -0,0 +1,194 @@
+'''
+Bounded worker pool for downloading and post-processing assignment submissions in parallel.
+
+The browser keeps driving the LMS on the main thread while the HTTP downloads and the
+unzip/rename/rezip work of earlier assignments run on the pool's worker threads.
+All workers share one connection-pooled requests session.
+
+download_resumable() is what every download goes through. It streams into a .part
+file in large chunks, hashing as it writes, and checks the length against the
+response's Content-Length. A dropped connection, a timeout, a short body or a
+429/5xx reply is retried with exponential backoff. Each retry asks for the
+missing bytes with a Range request instead of starting over, so a blip near the
+end of a large assignment zip costs one round trip and not the whole transfer.
+If-Range makes the server send the whole file again if it changed in the
+meantime, and a server that ignores Range is simply read from the start again.
+The file only gets its real name once it is complete, so a failed download never
+leaves a truncated zip behind for the next stage.
+'''
+
+import hashlib
+import os
+import random
+import re
+import threading
+from time import perf_counter, sleep
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+
+download_chunk_size = 1024 * 1024
+# what one read from the socket asks for: iter_content() drops a read that is cut off, and a retry resumes behind the last whole one
+download_read_size = 64 * 1024
+retry_statuses = {408, 429, 500, 502, 503, 504}
+_content_range = re.compile(r'bytes (\d+)-(\d+)/(\d+|\*)')
+
+
+class DownloadFailed(Exception):
+    pass
+
+
+class _Retry(Exception):
+    # a failure worth another try, retry_after is the delay the server asked for
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def _retry_after(reply):
+    try:
+        return float(reply.headers.get('Retry-After'))
+    except (TypeError, ValueError):
+        return None
+
+
+def _expected_size(reply, offset):
+    # the complete file's size from a 206's Content-Range or a 200's Content-Length, None when the server doesn't say
+    if reply.status_code == 206:
+        match = _content_range.fullmatch(reply.headers.get('Content-Range', ''))
+        if match is None or int(match.group(1)) != offset:
+            raise _Retry(f"unexpected Content-Range {reply.headers.get('Content-Range')!r}")
+        return None if match.group(3) == '*' else int(match.group(3))
+    if reply.headers.get('Content-Encoding', 'identity') != 'identity':
+        # Content-Length counts the encoded bytes, iter_content() yields decoded ones
+        return None
+    length = reply.headers.get('Content-Length')
+    return int(length) if length is not None and length.isdigit() else None
+
+
+def download_resumable(session, url, file_path, retries=5, backoff=1.0, max_backoff=60, timeout=60, chunk_size=download_chunk_size,
+                      read_size=download_read_size):
+    # Downloads url to file_path and returns (bytes, sha256 hex digest). Raises DownloadFailed once retries attempts
+    # in a row got nothing further, and requests.HTTPError right away for statuses that won't change, like 404.
+    file_path = str(file_path)
+    part_path = f'{file_path}.part'
+    checksum = hashlib.sha256()
+    received = 0
+    validator = None  # ETag or Last-Modified of the first reply, for If-Range
+    attempt = 0
+    # the .part file of an earlier run isn't trusted, the LMS builds its zips again for every request
+    with open(part_path, 'wb'):
+        pass
+    while True:
+        # zips don't shrink with gzip, and identity keeps Content-Length comparable with what is written
+        headers = {'Accept-Encoding': 'identity'}
+        if received:
+            headers['Range'] = f'bytes={received}-'
+            if validator:
+                headers['If-Range'] = validator
+        progress = received
+        try:
+            with session.get(url, headers=headers, stream=True, timeout=timeout) as reply:
+                if reply.status_code in retry_statuses:
+                    raise _Retry(f"HTTP {reply.status_code}", _retry_after(reply))
+                if reply.status_code == 416 and received:
+                    # the file shrank since, start over
+                    checksum = hashlib.sha256()
+                    received = 0
+                    raise _Retry("HTTP 416")
+                reply.raise_for_status()
+                if received and reply.status_code != 206:
+                    # Range ignored or the file changed since, what arrived so far is worthless
+                    checksum = hashlib.sha256()
+                    received = progress = 0
+                validator = validator or reply.headers.get('ETag') or reply.headers.get('Last-Modified')
+                expected = _expected_size(reply, received)
+                with open(part_path, 'ab' if received else 'wb', buffering=chunk_size) as file:
+                    for chunk in reply.iter_content(chunk_size=read_size):
+                        file.write(chunk)
+                        checksum.update(chunk)
+                        received += len(chunk)
+            if expected is not None and received != expected:
+                raise _Retry(f"got {received} of {expected} bytes")
+            os.replace(part_path, file_path)
+            return received, checksum.hexdigest()
+        except (_Retry, requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+            # a try that got further starts the count again, only attempts in a row without progress give up
+            attempt = 1 if received > progress else attempt + 1
+            if attempt > retries:
+                os.remove(part_path)
+                raise DownloadFailed(f"{url}: {e} after {retries} retries, {received} bytes received") from e
+            delay = min(max_backoff, backoff * 2 ** (attempt - 1)) * random.uniform(.5, 1)
+            retry_after = getattr(e, 'retry_after', None)
+            if retry_after is not None:
+                delay = min(max_backoff, max(delay, retry_after))
+            print(f"\tDownload interrupted ({e}), retrying {'from byte ' + str(received) if received else 'from the start'} in {delay:.1f} s")
+            sleep(delay)
+        except BaseException:
+            os.remove(part_path)
+            raise
+
+
+def make_pooled_session(pool_size):
+    # one adapter with enough keep-alive connections for every worker, mounted for both schemes
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+class DownloadPool:
+
+    def __init__(self, max_workers, max_pending=None):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='download')
+        # submit() blocks once this many jobs are running or waiting, so the browser can't run far ahead
+        self.slots = threading.BoundedSemaphore(max_pending or max_workers * 2)
+        self.lock = threading.Lock()
+        self.worker_stats = {}  # worker name -> {'jobs', 'failures', 'bytes', 'seconds'}
+        self.futures = []
+        self.start_time = perf_counter()
+
+    def submit(self, job, *args, **kwargs):
+        # job must return the number of bytes it downloaded
+        self.slots.acquire()
+        future = self.executor.submit(self._run, job, *args, **kwargs)
+        self.futures.append(future)
+        return future
+
+    def _run(self, job, *args, **kwargs):
+        worker = threading.current_thread().name
+        start = perf_counter()
+        downloaded = 0
+        failed = False
+        try:
+            downloaded = job(*args, **kwargs) or 0
+            return downloaded
+        except Exception as e:
+            failed = True
+            print(f"\t[{worker}] Job failed: {e!r}")
+        finally:
+            elapsed = perf_counter() - start
+            with self.lock:
+                stats = self.worker_stats.setdefault(worker, {'jobs': 0, 'failures': 0, 'bytes': 0, 'seconds': 0.0})
+                stats['jobs'] += 1
+                stats['failures'] += failed
+                stats['bytes'] += downloaded
+                stats['seconds'] += elapsed
+            self.slots.release()
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+    def print_throughput(self):
+        wall_time = perf_counter() - self.start_time
+        total_bytes = 0
+        print("Per-worker download throughput:")
+        for worker in sorted(self.worker_stats):
+            stats = self.worker_stats[worker]
+            total_bytes += stats['bytes']
+            rate = stats['bytes'] / stats['seconds'] if stats['seconds'] else 0
+            print(f"\t{worker}: {stats['jobs']} jobs ({stats['failures']} failed), "
+                  f"{stats['bytes'] / 1e6:.1f} MB in {stats['seconds']:.1f} s busy ({rate / 1e6:.2f} MB/s)")
+        overall = total_bytes / wall_time if wall_time else 0
+        print(f"\tTotal: {total_bytes / 1e6:.1f} MB in {wall_time:.1f} s wall time ({overall / 1e6:.2f} MB/s)")
@@ -0,0 +1,164 @@
+'''
+Grade extraction from the D2L grade_item_edit.d2l and Gradescope review_grades pages.
+
+The scripts only need a few cells of each row, so instead of building a
+BeautifulSoup tree of the whole page these functions cut out the grade table and
+scan its tags with regular expressions (re runs in C). The *_soup functions are
+the BeautifulSoup versions the scripts used before; benchmark_grade_parsing.py
+checks that both give the same result and compares their speed.
+'''
+
+import re
+from html import unescape
+
+_tag = re.compile(r'<(/?)([a-zA-Z][\w:-]*)((?:[^>"\']|"[^"]*"|\'[^\']*\')*)>')
+_grade_input = re.compile(r'<(input|d2l-input-number)(?=[\s>/])((?:[^>"\']|"[^"]*"|\'[^\']*\')*)>', re.IGNORECASE)
+_score_header = re.compile(r'<[a-zA-Z][\w:-]*\b[^>]*\bclass\s*=\s*["\'](?:[^"\']*\s)?(?:u-centeredText|sorting)(?:\s[^"\']*)?["\'][^>]*>')
+_attribute = re.compile(r'([^\s"\'=<>/]+)(?:\s*=\s*(?:"([^"]*)"|\'([^\']*)\'|([^\s"\'=<>`]+)))?')
+_table = re.compile(r'<(/?)table\b', re.IGNORECASE)
+_row_start = re.compile(r'<tr\b', re.IGNORECASE)
+_cell_start = re.compile(r'<t[dh]\b', re.IGNORECASE)
+_data_cell_start = re.compile(r'<td\b', re.IGNORECASE)
+_cell_end = re.compile(r'</t[dh]\b', re.IGNORECASE)
+_markup = re.compile(r'<[^>]*>')
+
+
+def _attributes(attribute_text):
+    attributes = {}
+    for match in _attribute.finditer(attribute_text):
+        value = next((group for group in match.groups()[1:] if group is not None), '')
+        attributes.setdefault(match.group(1).lower(), unescape(value))
+    return attributes
+
+
+def _element_span(html, start, tag_pattern):
+    # end of the element starting at start, counting nested elements of the same kind
+    depth = 0
+    for match in tag_pattern.finditer(html, start):
+        depth += -1 if match.group(1) else 1
+        if depth == 0:
+            return match.end()
+    return len(html)
+
+
+def _split(html, start_pattern):
+    # the pieces of html that begin at each match of start_pattern, like find_all() on that tag
+    starts = [match.start() for match in start_pattern.finditer(html)]
+    return [html[start:end] for start, end in zip(starts, starts[1:] + [len(html)])]
+
+
+def _text(html):
+    return unescape(_markup.sub('', html))
+
+
+def _d2l_grade_rows(html):
+    # (tag name, unparsed attributes) of the inputs in every row of table#z_p after the header row,
+    # or nothing when the table is missing. Only the attributes that are used get parsed
+    table = re.search(r'<table\b[^>]*\bid\s*=\s*["\']?z_p["\'\s>]', html, re.IGNORECASE)
+    if table is None:
+        return
+    table_html = html[table.start():_element_span(html, table.start(), _table)]
+    for row in _split(table_html, _row_start)[1:]:
+        yield [(match.group(1).lower(), match.group(2)) for match in _grade_input.finditer(row)]
+
+
+def parse_d2l_grades(html):
+    # Augusta's grade page: student id from the first input's value, grade from the d2l-input-number
+    grades = {}
+    for tags in _d2l_grade_rows(html):
+        inputs = [attributes for name, attributes in tags if name == 'input']
+        numbers = [attributes for name, attributes in tags if name == 'd2l-input-number']
+        if not inputs or not numbers:
+            continue
+        student_id = _attributes(inputs[0]).get('value', '')
+        if '_' in student_id:
+            grades[student_id.split('_')[1]] = _attributes(numbers[0]).get('value')
+    return grades
+
+
+def parse_folio_grades(html):
+    # Georgia Southern's grade page: student id from the first input's value, grade from the fifth input
+    grades = {}
+    for tags in _d2l_grade_rows(html):
+        inputs = [attributes for name, attributes in tags if name == 'input']
+        if len(inputs) < 5:
+            continue
+        student_id = _attributes(inputs[0]).get('value', '')
+        if '_' in student_id:
+            grades[student_id.split('_')[1]] = _attributes(inputs[4]).get('value')
+    return grades
+
+
+def parse_review_grades(html):
+    # Gradescope's review_grades page: the assignment's "out of" score and (name, link, grade text) per row.
+    # The score is None when the page has no "out of" header, callers that scale grades by it have to check.
+    # Rows without a submission have an empty grade text, the caller decides what to do with them.
+    score = None
+    header = _score_header.search(html)
+    if header is not None:
+        span = re.compile(r'<span\b[^>]*>(.*?)</span', re.IGNORECASE | re.DOTALL).search(html, header.end())
+        try:
+            score = float(_text(span.group(1)).split('/')[-1])
+        except (AttributeError, ValueError):
+            # no span after the header, or no number in it, e.g. '—'
+            score = None
+
+    rows = []
+    table = re.search(r'<table\b[^>]*\bclass\s*=\s*["\'][^"\']*\bjs-reviewGradesTable\b', html)
+    if table is None:
+        return score, rows
+    table_html = html[table.start():_element_span(html, table.start(), _table)]
+    body = re.search(r'<tbody\b', table_html, re.IGNORECASE)
+    for row in _split(table_html[body.start():] if body else '', _row_start):
+        for cell in _split(row, _cell_start):
+            cell_tag = _tag.match(cell)
+            # cheap substring test first, most cells aren't the link cell
+            if 'table--primaryLink' not in cell_tag.group(3) or \
+                    'table--primaryLink' not in _attributes(cell_tag.group(3)).get('class', '').split():
+                continue
+            link = re.search(r'<a\b((?:[^>"\']|"[^"]*"|\'[^\']*\')*)>(.*?)</a', cell, re.IGNORECASE | re.DOTALL)
+            if link is None:
+                continue
+            # some tables have more columns than others, the grade is in a different one
+            data = _split(row, _data_cell_start)
+            grade_cell = data[4] if len(data) == 9 else data[3]
+            grade_end = _cell_end.search(grade_cell)
+            grade_text = _text(grade_cell[_tag.match(grade_cell).end():grade_end.start() if grade_end else len(grade_cell)])
+            rows.append((_text(link.group(2)), _attributes(link.group(1)).get('href'), grade_text))
+    return score, rows
+
+
+def parse_d2l_grades_soup(html):
+    from bs4 import BeautifulSoup
+    soup = BeautifulSoup(html, 'html.parser')
+    grades = {}
+    if soup.find('table', id='z_p') is not None:
+        for row in soup.find('table', id='z_p').find_all('tr')[1:]:
+            try:
+                grades[row.find('input').get('value').split('_')[1]] = row.find('d2l-input-number').get('value')
+            except (AttributeError, IndexError):
+                pass
+    return grades
+
+
+def parse_folio_grades_soup(html):
+    from bs4 import BeautifulSoup
+    soup = BeautifulSoup(html, 'html.parser')
+    grades = {}
+    for row in soup.find('table', id='z_p').find_all('tr')[1:]:
+        grades[row.find('input').get('value').split('_')[1]] = row.find_all('input')[4].get('value')
+    return grades
+
+
+def parse_review_grades_soup(html):
+    from bs4 import BeautifulSoup
+    parsed_outline_resp = BeautifulSoup(html, 'html.parser')
+    score_text = parsed_outline_resp.find(class_=["u-centeredText", "sorting"]).find("span").text
+    score = float(score_text.split("/")[-1])
+    rows = []
+    for row in parsed_outline_resp.find(class_="js-reviewGradesTable").find("tbody").find_all(class_=["table--primaryLink", " sorting_3"]):
+        a = row.find("a")
+        data = row.parent.find_all("td")
+        grade_text = data[4].text if len(data) == 9 else data[3].text
+        rows.append((a.text, a.get("href"), grade_text))
+    return score, rows
@@ -16,6 +16,15 @@ Instructions:
 
 email='email'
 pswd='pswd' # for gradescope, not Folio
+incremental_sync = True # keep earlier downloads and only fetch assignments whose submissions or grades changed
+download_workers = 8 # how many student submissions are downloaded and extracted at the same time
+use_bulk_export = True # fetch each assignment's "Export Submissions" archive in one request, per-student downloads only when that fails
+metadata_cache_hours = 12 # how long the rosters and assignment lists of active courses are reused, courses whose term is over are never fetched again
+archive_format = 'zip' # 'zip' adds each course to downloads.zip as it finishes, 'tar.zst' writes downloads.tar.zst with multi-threaded zstd at the end (pip install zstandard)
+export_dataset = False # write every kept source file with its grade, course and anonymized id into sharded files in dataset/ for training and analysis jobs
+dataset_formats = ['jsonl'] # add 'parquet' for columnar shards as well (pip install pyarrow)
+fingerprint_submissions = False # fingerprint every submission into similarity_index.sqlite while it is rewritten, for near-duplicate lookups (see similarity_index.py)
+compression_threads = None # how many threads deflate the files going into downloads.zip, None uses one per CPU
 
 from time import sleep
 from getpass import getuser
@@ -30,118 +39,271 @@ import re
 import io
 import tokenize
 import os
-from bs4 import BeautifulSoup
+from grade_parsers import parse_review_grades
 from pyscope.pyscope import GSConnection
 from pyscope.person import GSRole
+from sync_manifest import SyncManifest, grade_snapshot_hash
+from download_pool import DownloadPool, DownloadFailed, make_pooled_session, download_resumable
+from gradescope_export import ExportFailed, csrf_token, request_export, split_export, submission_id
+from metadata_cache import MetadataCache, course_is_closed
+from archive_utils import IncrementalZipArchive, write_tar_zst, tar_zst_available
+from concurrent.futures import ThreadPoolExecutor
+from submission_catalog import SubmissionCatalog, folder_rows
+from dataset_export import DatasetExporter, parquet_available
+from similarity_index import SimilarityIndex
+from sampling_profiler import SamplingProfiler
+import sys
+
+if archive_format == 'tar.zst' and not tar_zst_available():
+    print("archive_format 'tar.zst' needs the zstandard package: pip install zstandard")
+    exit()
+if export_dataset and 'parquet' in dataset_formats and not parquet_available():
+    print("dataset_formats 'parquet' needs the pyarrow package: pip install pyarrow")
+    exit()
+
+# run with --profile to sample the whole run, see sampling_profiler.py
+profiling = '--profile' in sys.argv
+profiler = SamplingProfiler()
+if profiling:
+    profiler.start()
+profiler.set_stage('setup')
 
 def download_file(session, url, file_path):
-    reply = session.get(url, stream=True)
-    with open(file_path, 'wb') as file:
-        for chunk in reply.iter_content(chunk_size=1024): 
-            if chunk:
-                file.write(chunk)
-
-def zip_directory(folder_path, zip_file_path):
-    with zipfile.ZipFile(zip_file_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-        for root, _, files in os.walk(folder_path):
-            for file in files:
-                file_path = os.path.join(root, file)
-                zipf.write(file_path, os.path.relpath(file_path, folder_path))
+    # retried and resumed where it stopped when the connection drops, the file only appears once it is complete
+    downloaded, _ = download_resumable(session, url, file_path)
+    return downloaded
+
+def download_submission(session, url, file_path, extract_folder):
+    # one student's submission, run on the download pool: download the zip, extract it and drop Gradescope's metadata.yml
+    downloaded = download_file(session, url, f"{file_path}")
+    try:
+        z = zipfile.ZipFile(f"{file_path}")
+        z.extractall(extract_folder)
+        z.close()
+
+        if os.path.isfile(os.path.join(extract_folder, "metadata.yml")):
+            os.remove(os.path.join(extract_folder, "metadata.yml"))
+    finally:
+        # a corrupt or truncated zip raises BadZipFile, the pool counts it as a failed job and the assignment stays out of the manifest
+        file_path.unlink()
+    return downloaded
 
 # make directory if it doesn't exist
 if not os.path.exists(f"{getcwd()}/downloads/"):
     os.makedirs(f"{getcwd()}/downloads/")
-else:
+elif not incremental_sync:
     for root, dirs, files in os.walk(f"{getcwd()}/downloads/", topdown=False):
         for directory in dirs:
             os.rmdir(os.path.join(root, directory))
         for file in files:
             os.remove(os.path.join(root, file))
-if os.path.isfile(os.path.join(f"{getcwd()}", "downloads.zip")):
+if not incremental_sync and os.path.isfile(os.path.join(f"{getcwd()}", "downloads.zip")):
     os.remove(os.path.join(f"{getcwd()}", "downloads.zip"))
 
+# downloads.zip gets each course's new downloads as soon as the course is finished.
+# A new archive starts with whatever earlier runs left in downloads/, the assignments skipped as unchanged included.
+# The files are deflated on a thread pool, this script can't start processes on Windows and zlib releases the GIL anyway.
+# downloads.tar.zst is written in one go at the end instead
+downloads_archive = None
+if archive_format == 'zip':
+    compression_executor = ThreadPoolExecutor(compression_threads or os.cpu_count(), thread_name_prefix='compression')
+    new_archive = not os.path.isfile(f"{getcwd()}/downloads.zip")
+    downloads_archive = IncrementalZipArchive(f"{getcwd()}/downloads.zip", executor=compression_executor)
+    if new_archive:
+        downloads_archive.add_folder(f"{getcwd()}/downloads", f"{getcwd()}/downloads")
+
+# what earlier runs downloaded, starts over when the old downloads were just deleted
+manifest = SyncManifest(f"{getcwd()}/downloads_manifest.json", reset=not incremental_sync)
+# rosters, assignment lists and grades tables of earlier runs
+metadata_cache = MetadataCache(f"{getcwd()}/gradescope_metadata_cache.json", max_age=metadata_cache_hours * 3600)
+# indexed list of every file in downloads.zip, see submission_catalog.py for querying it
+catalog = SubmissionCatalog(f"{getcwd()}/downloads_catalog.sqlite", reset=not incremental_sync)
+# the kept source files as JSONL/Parquet shards, see dataset_export.py
+dataset = DatasetExporter(f"{getcwd()}/dataset", dataset_formats, reset=not incremental_sync) if export_dataset else None
+# winnowing/MinHash fingerprints of every submission in an LSH index, see similarity_index.py
+similarity = SimilarityIndex(f"{getcwd()}/similarity_index.sqlite", reset=not incremental_sync) if fingerprint_submissions else None
+
 # Login to gradescope and get account details
+profiler.set_stage('login')
 session = GSConnection()
 print(session.login(email=email, pswd=pswd))
 
 # don't get details for placeholder courses, if they exist
 session.get_account(excluded_courses=['Gradescope 101', 'Gradescope 202', 'Assignment Examples', 'Gradescope Tutorial'])
 
-# increasing ID to replace student names
-increasing_no = 0
+# increasing ID to replace student names, continuing from earlier runs
+unique_ids = manifest.unique_ids
+
+# the submissions are downloaded by the pool's workers over one session with a connection per worker,
+# which gets the login cookies of each course's session before that course's downloads start
+download_session = make_pooled_session(download_workers)
+pool = DownloadPool(download_workers)
 
 # for each course and each assignment, we want to download all submissions for each student
 for course in list(session.account.instructor_courses.values()):
     
-    # required before looping through course assignments
-    course._lazy_load_roster()
-    course._lazy_load_assignments()
+    # required before looping through course assignments, unless the metadata cache still has them
+    profiler.set_stage('course_metadata')
+    closed = course_is_closed(course.year)
+    roster_key = metadata_cache.key('roster', course.cid)
+    assignments_key = metadata_cache.key('assignments', course.cid)
+    roster = metadata_cache.get(roster_key)
+    course_assignments = metadata_cache.get(assignments_key)
+    if roster is None or course_assignments is None:
+        course._lazy_load_roster()
+        course._lazy_load_assignments()
+        # name -> role name, and (assignment id, short name) of each assignment
+        roster = {name: person.role.name for name, person in course.roster.items()}
+        course_assignments = [(assignment.aid, assignment.shortname) for assignment in course.assignments.values()]
+        metadata_cache.put(roster_key, roster, closed)
+        metadata_cache.put(assignments_key, course_assignments, closed)
 
     # make a directory for each course to organize submission downloads
-    os.mkdir(os.path.join(f"{os.getcwd()}/downloads/", f"{course.shortname}"))
+    os.makedirs(os.path.join(f"{os.getcwd()}/downloads/", f"{course.shortname}"), exist_ok=True)
+    download_session.cookies.update(course.session.cookies)
+    download_session.headers.update(course.session.headers)
+
+    # assignments whose downloads are still running, recorded in the manifest once all of them finished
+    pending_assignments = []
 
     # for each assignment, download all submissions
-    for assignment in course.assignments.values():
+    for assignment_id, assignment_name in course_assignments:
 
         # go to course url and parse html
-        outline_resp = course.session.get('https://www.gradescope.com/courses/' + assignment.course.cid + '/assignments/' + assignment.aid + '/review_grades')
-        parsed_outline_resp = BeautifulSoup(outline_resp.text, 'html.parser')
-
-        # "out of" grade so each score can be properly scaled, e.g. 100/130 = 77%
-        score_text = parsed_outline_resp.find(class_=["u-centeredText","sorting"]).find("span").text
-        score = float(score_text.split("/")[-1])
+        profiler.set_stage('grades')
+        review_grades_url = 'https://www.gradescope.com/courses/' + course.cid + '/assignments/' + assignment_id + '/review_grades'
+        review_grades_html = None
+        # an active course's grades can still change, so only a closed course's table comes from the cache
+        grades_key = metadata_cache.key('review_grades', course.cid, assignment_id)
+        cached_grades = metadata_cache.get(grades_key, max_age=0)
+        if cached_grades is None:
+            review_grades_html = course.session.get(review_grades_url).text
 
-        # parse html to get all student submissions
-        submission_rows = parsed_outline_resp.find(class_="js-reviewGradesTable").find("tbody").find_all(class_=["table--primaryLink", " sorting_3"])
-
-        # make directory for each assignment
-        os.mkdir(os.path.join(os.path.join(f"{os.getcwd()}/downloads/", f"{course.shortname}"), f"{assignment.shortname}"))
+            # "out of" grade so each score can be properly scaled, e.g. 100/130 = 77%,
+            # and the name, submission url and grade of each row of the grades table
+            score, submission_rows = parse_review_grades(review_grades_html)
+            if score:
+                metadata_cache.put(grades_key, [score, submission_rows], closed)
+        else:
+            score, submission_rows = cached_grades
+        if not score:
+            # no "out of" score on the page, or 0, so the grades can't be turned into percentages
+            print(f"{assignment_name}: no maximum score on the grades page, skipping")
+            continue
 
         # for each student, get their information and submission url
-        for row in submission_rows:
-            a = row.find("a")
-
+        submissions = []
+        for name, link, grade_text in submission_rows:
             # name is used to make sure a submission is by a student, not an instructor
-            name = a.text
-
             # there's a weird duplication thing, so it needs to be checked if the name is in the course roster
-            if name not in course.roster or course.roster[name].role == GSRole.INSTRUCTOR:
+            if name not in roster or roster[name] == GSRole.INSTRUCTOR.name:
                 continue
 
-            # get url of submission
-            link = a.get("href")
-
-            # for some reason, some tables have different amounts of data, so we have to handle both cases.
-            data = row.parent.find_all("td")
-            if len(data) == 9:
-                 grade_text = data[4].text
-            else:
-                grade_text = data[3].text
-
             # if a person does not have a submission,
             if grade_text == '':
                 continue
             grade = float(grade_text)/score
             grade = round(grade * 100)
+            submissions.append((name, link, grade))
+
+        # skip assignments that haven't changed since they were downloaded by an earlier run, and exported if that is on
+        assignment_folder = Path(f"{getcwd()}/downloads/{course.shortname}/{assignment_name}")
+        grades_hash = grade_snapshot_hash({name: grade for name, link, grade in submissions})
+        if (incremental_sync and manifest.is_unchanged(course.cid, assignment_id, len(submissions), grades_hash)
+                and (dataset is None or dataset.exported('gradescope', course.cid, assignment_id))):
+            print(f"{assignment_name}: submissions and grades unchanged since the last run, skipping")
+            continue
+
+        # make directory for each assignment, replacing what an earlier run downloaded
+        if assignment_folder.exists():
+            shutil.rmtree(assignment_folder)
+        os.mkdir(assignment_folder)
+
+        # ids are handed out here in the order of the grades table, so the names don't depend on how the files arrive
+        submission_folders = []
+        for name, link, grade in submissions:
+            increasing_no = next(unique_ids)
             print(f"{name}: {grade}%, {link}")
+            submission_folders.append((link, f"{increasing_no}_{grade}%"))
 
-            file_path = Path(f"{getcwd()}/downloads/{course.shortname}/{assignment.shortname}/{increasing_no}_{grade}%.zip")
-            download_file(course.session, f"https://www.gradescope.com{link}.zip", f"{file_path}")
-            
+        # the whole assignment in one archive when Gradescope can build it
+        exported = set()
+        if use_bulk_export and submissions:
+            profiler.set_stage('bulk_export')
+            export_path = Path(f"{getcwd()}/downloads/{course.shortname}/{assignment_id}.export.zip")
             try:
-                z = zipfile.ZipFile(f"{file_path}")
-                z.extractall(f"{getcwd()}/downloads/{course.shortname}/{assignment.shortname}/{increasing_no}_{grade}%/")
-                z.close()
-                
-                zip_folder = Path(f"{getcwd()}/downloads/{course.shortname}/{assignment.aid}/{increasing_no}_{grade}%/")
-
-                if os.path.isfile(os.path.join(zip_folder, "metadata.yml")):
-                    os.remove(os.path.join(zip_folder, "metadata.yml"))
-            except zipfile.BadZipFile as e:
-                print(e)
+                if review_grades_html is None:
+                    # the grades came from the cache, the page is only needed for its csrf token
+                    review_grades_html = course.session.get(review_grades_url).text
+                export_url = request_export(course.session, course.cid, assignment_id, csrf_token(review_grades_html))
+                download_file(download_session, export_url, f"{export_path}")
+                exported = split_export(export_path, assignment_folder, {submission_id(link): folder for link, folder in submission_folders})
+                print(f"{assignment_name}: {len(exported)} of {len(submissions)} submissions from the bulk export")
+            except (requests.RequestException, KeyError, ValueError, ExportFailed, DownloadFailed, zipfile.BadZipFile) as e:
+                print(f"{assignment_name}: bulk export failed ({e!r}), downloading each submission instead")
+                exported = set()
+                # split_export() may have extracted part of the export already, those files mustn't end up next to the downloads
+                shutil.rmtree(assignment_folder)
+                os.mkdir(assignment_folder)
             finally:
-                file_path.unlink()
-            
-            increasing_no += 1
+                if export_path.exists():
+                    export_path.unlink()
+
+        # every submission the export didn't have is downloaded on its own
+        profiler.set_stage('download_feed')
+        futures = []
+        for link, folder in submission_folders:
+            if submission_id(link) in exported:
+                continue
+            file_path = Path(f"{getcwd()}/downloads/{course.shortname}/{assignment_name}/{folder}.zip")
+            extract_folder = f"{getcwd()}/downloads/{course.shortname}/{assignment_name}/{folder}/"
+            futures.append(pool.submit(download_submission, download_session, f"https://www.gradescope.com{link}.zip", file_path, extract_folder))
+        pending_assignments.append((assignment_id, len(submissions), grades_hash, assignment_folder, futures))
+
+    # an assignment with a failed download stays out of the manifest, downloads.zip and the indexes, so the next run fetches it again
+    completed_assignments = [(assignment_id, submission_count, grades_hash, assignment_folder)
+                             for assignment_id, submission_count, grades_hash, assignment_folder, futures in pending_assignments
+                             if all(future.result() is not None for future in futures)]
+
+    metadata_cache.save()
+
+    # only this course's new downloads are compressed and appended, not the whole downloads folder again.
+    # The manifest gets an assignment last, a run interrupted before that downloads it again
+    profiler.set_stage('final_zip')
+    for assignment_id, submission_count, grades_hash, assignment_folder in completed_assignments:
+        if downloads_archive is not None:
+            downloads_archive.add_folder(assignment_folder, f"{getcwd()}/downloads")
+        catalog.replace_assignment('gradescope', course.cid, course.shortname, assignment_id, assignment_folder.name,
+                                   folder_rows(assignment_folder, f"{getcwd()}/downloads"))
+        if dataset is not None:
+            dataset.add_folder(assignment_folder, f"{getcwd()}/downloads", 'gradescope', course.cid, course.shortname,
+                               assignment_id, assignment_folder.name)
+        if similarity is not None:
+            similarity.add_folder(assignment_folder, 'gradescope', course.cid, course.shortname, assignment_id, assignment_folder.name)
+        manifest.record(course.cid, assignment_id, submission_count, grades_hash, assignment_folder)
+
+pool.shutdown()
+pool.print_throughput()
+
+profiler.set_stage('final_zip')
+if downloads_archive is not None:
+    # drop what downloads.zip still has of assignments that were downloaded again, their files got new names
+    downloads_archive.compact(keep=lambda name: os.path.isfile(os.path.join(f"{getcwd()}/downloads", name)))
+    compression_executor.shutdown()
+else:
+    # zips in the downloads folder are what students submitted, they go in as they are
+    bytes_in, archive_bytes = write_tar_zst(f"{getcwd()}/downloads", f"{getcwd()}/downloads.tar.zst", expand_zips=False)
+    print(f"Wrote downloads.tar.zst: {bytes_in / 1e6:.1f} MB of files in {archive_bytes / 1e6:.1f} MB")
+metadata_cache.print_report()
+catalog.close()
+if dataset is not None:
+    dataset.close()
+    dataset.print_report()
+if similarity is not None:
+    similarity.close()
+    similarity.print_report()
 
-    zip_directory(f"{getcwd()}/downloads", f"{getcwd()}/downloads.zip")
\ No newline at end of file
+if profiling:
+    profiler.stop()
+    profiler.print_report()
+    profiler.write(f"{getcwd()}/profile.folded")
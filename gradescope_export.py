@@ -0,0 +1,87 @@
+'''
+Gradescope's assignment-level "Export Submissions" archive, instead of one zip per student.
+
+Asking for the export starts a job on Gradescope's side; its status is polled
+until the archive is ready and then the whole assignment is downloaded in one
+request. The archive has a folder per submission,
+    assignment_<assignment id>_export/submission_<submission id>/<submitted files>
+next to a submission_metadata.yml with the students' names, so split_export()
+writes each submission's files into the same <increasing_no>_<grade>% folders
+the per-student downloads produce, using the submission ids of the
+review_grades links. Anything that goes wrong raises ExportFailed or a requests
+error, and the caller falls back to the per-student downloads.
+'''
+
+import os
+import re
+import shutil
+import zipfile
+from time import perf_counter, sleep
+
+base_url = 'https://www.gradescope.com'
+
+_csrf_token = re.compile(r'<meta\b[^>]*\bname\s*=\s*["\']csrf-token["\'][^>]*\bcontent\s*=\s*["\']([^"\']*)["\']', re.IGNORECASE)
+_submission_folder = re.compile(r'(?:^|/)submission_(\d+)/(.+)$')
+
+
+class ExportFailed(Exception):
+    pass
+
+
+def csrf_token(html):
+    # the token Gradescope's forms post back, from any page of the logged-in site
+    match = _csrf_token.search(html)
+    if match is None:
+        raise ExportFailed("no csrf-token on the page")
+    return match.group(1)
+
+
+def submission_id(link):
+    # /courses/<course>/assignments/<assignment>/submissions/<submission id>
+    return link.rstrip('/').split('/')[-1]
+
+
+def request_export(session, course_id, assignment_id, token, timeout=900, poll_interval=2):
+    # starts the export and returns the archive's url once Gradescope has built it
+    response = session.post(f'{base_url}/courses/{course_id}/assignments/{assignment_id}/export', headers={'X-CSRF-Token': token})
+    response.raise_for_status()
+    generated_file_id = response.json()['generated_file_id']
+    status_url = f'{base_url}/courses/{course_id}/generated_files/{generated_file_id}.json'
+    deadline = perf_counter() + timeout
+    while True:
+        response = session.get(status_url)
+        response.raise_for_status()
+        status = response.json().get('status')
+        if status == 'completed':
+            return f'{base_url}/courses/{course_id}/generated_files/{generated_file_id}.zip'
+        if status in ('failed', 'error'):
+            raise ExportFailed(f"export of assignment {assignment_id} {status}")
+        if perf_counter() > deadline:
+            raise ExportFailed(f"export of assignment {assignment_id} not ready after {timeout} s")
+        sleep(poll_interval)
+
+
+def split_export(export_path, assignment_folder, submission_folders):
+    # Writes the files of every submission in submission_folders (submission id -> folder name) into
+    # assignment_folder/<folder name>/, skipping the metadata files and submissions that aren't listed.
+    # Returns the ids of the submissions found in the archive.
+    found = set()
+    with zipfile.ZipFile(export_path) as export:
+        for info in export.infolist():
+            match = _submission_folder.search(info.filename)
+            if match is None or info.is_dir():
+                continue
+            folder_name = submission_folders.get(match.group(1))
+            rest = match.group(2)
+            if folder_name is None or os.path.basename(rest) == 'metadata.yml':
+                continue
+            # member names come from students, never let one write outside its folder
+            parts = [part for part in rest.split('/') if part not in ('', '.', '..')]
+            if not parts:
+                continue
+            destination = os.path.join(assignment_folder, folder_name, *parts)
+            os.makedirs(os.path.dirname(destination), exist_ok=True)
+            with export.open(info) as source, open(destination, 'wb') as target:
+                shutil.copyfileobj(source, target, 1024 * 1024)
+            found.add(match.group(1))
+    return found
@@ -0,0 +1,90 @@
+'''
+On-disk cache of Gradescope course metadata: rosters, assignment lists and review_grades tables.
+
+Entries are keyed by what they describe, e.g. roster/<course id> or
+review_grades/<course id>/<assignment id>, and remember when they were fetched
+and whether the course was closed by then. A course whose term ended more than
+closed_grace_days ago can't change any more, so what was fetched after that
+never expires and repeat runs don't ask Gradescope about it at all. Entries of
+active courses are used for max_age seconds, and callers pass max_age=0 for what
+has to be fresh on every run, like an active course's grades.
+The file holds student names, so like the session cache it is only readable
+by the current user, and it is written with a temporary file and a swap.
+'''
+
+import json
+import os
+import re
+import threading
+from datetime import date
+from time import time
+
+closed_grace_days = 30
+# last day of each term, (month, day, years after the year in the term's name)
+_term_ends = {'winter': (3, 31, 0), 'spring': (6, 1, 0), 'summer': (9, 1, 0), 'fall': (1, 15, 1), 'autumn': (1, 15, 1)}
+_term = re.compile(r'(winter|spring|summer|fall|autumn)\D*(\d{4})', re.IGNORECASE)
+
+
+def course_is_closed(term, today=None):
+    # term is the course's term as Gradescope shows it, e.g. 'Fall 2023'; terms that don't parse count as active
+    match = _term.search(term or '')
+    if match is None:
+        return False
+    month, day, year_offset = _term_ends[match.group(1).lower()]
+    term_end = date(int(match.group(2)) + year_offset, month, day)
+    return ((today or date.today()) - term_end).days > closed_grace_days
+
+
+class MetadataCache:
+
+    def __init__(self, cache_path, max_age=12 * 3600):
+        self.cache_path = cache_path
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        if os.path.isfile(cache_path):
+            try:
+                with open(cache_path, 'r', encoding='utf-8') as file:
+                    self.entries = json.load(file).get('entries', {})
+            except (OSError, ValueError):
+                # a damaged cache is only a slower run
+                self.entries = {}
+
+    @staticmethod
+    def key(*parts):
+        return '/'.join(str(part) for part in parts)
+
+    def get(self, key, max_age=None):
+        # the cached value, or None when there is none or it is too old to use
+        max_age = self.max_age if max_age is None else max_age
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and (entry['closed'] or time() - entry['fetched_at'] < max_age):
+                self.hits += 1
+                return entry['value']
+            self.misses += 1
+            return None
+
+    def put(self, key, value, closed=False):
+        # value has to be JSON-serializable, tuples come back as lists. closed is whether the course was closed when
+        # value was fetched; something fetched while the course was active expires even after the course closes
+        with self.lock:
+            self.entries[key] = {'fetched_at': time(), 'closed': closed, 'value': value}
+
+    def save(self):
+        with self.lock:
+            data = json.dumps({'entries': self.entries})
+        temp_path = f'{self.cache_path}.tmp'
+        # create the file with owner-only permissions before anything is written to it; a temp file left by an
+        # interrupted save would keep its own permissions, so it is removed and the new one must not exist yet
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, 'w', encoding='utf-8') as file:
+            file.write(data)
+        os.replace(temp_path, self.cache_path)
+
+    def print_report(self):
+        print(f"Metadata cache: {self.hits} hits, {self.misses} misses, {len(self.entries)} entries")
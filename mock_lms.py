@@ -0,0 +1,338 @@
+'''
+Local stand-in for a D2L (Brightspace) and Gradescope tenant, for benchmarks and testing.
+
+MockLMS generates a deterministic set of courses, dropbox folders, students, grades
+and submission zips, and serves them over HTTP the way the scripts request them:
+    /d2l/api/lp/<version>/users/whoami and enrollments/myenrollments/    Valence, paged by bookmark
+    /d2l/api/le/<version>/<course>/dropbox/folders/    Valence dropbox folders
+    /d2l/api/le/<version>/<course>/grades/<grade object>/values/    Valence grade values, paged by Next
+    /old/activities/6606_2000_<assignment>/usages/<course>    activities API (served on the same host)
+    /d2l/lms/grades/admin/enter/grade_item_edit.d2l?objectId=&ou=    grade page
+    /d2l/le/manageCourses/search/6606    course search page
+    /d2l/lms/dropbox/admin/folders_manage.d2l?ou=    assignments page
+    /d2l/lms/dropbox/admin/mark/folder_submissions_files.d2l?db=&ou=    submissions page with the download link
+    /d2l/common/viewFile.d2lfile/Temp/<assignment>.zip?ou=    zip of every submission of an assignment
+    /courses/<course>/assignments/<assignment>/review_grades    Gradescope grades page
+    /courses/<course>/assignments/<assignment>/submissions/<student>.zip    Gradescope submission
+    /courses/<course>/assignments/<assignment>/export (POST), /courses/<course>/generated_files/<id>.json and .zip
+        Gradescope's bulk export, ready as soon as it is asked for
+The zips are served like static files, with an ETag and Range requests, and
+MockLMS(drop_every=n) cuts every n-th zip reply off halfway to exercise resumed
+downloads. The HTML pages have the elements the scripts read, not D2L's full layout, so the
+XPaths the browser steps use don't match them; the login can't be mocked either.
+Run this file to serve a tenant on localhost:
+    python mock_lms.py [port]
+'''
+
+import io
+import json
+import random
+import re
+import sys
+import threading
+import zipfile
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+from brightspace_api import course_offering_type_id
+from benchmark_grade_parsing import synthetic_grade_item_edit, synthetic_review_grades
+
+_python_source = '''"""Assignment {assignment}, submitted by student {student}."""
+import sys  # for argv
+
+
+def solve(values):
+    """Returns the running total."""
+    total = 0
+    for value in values:  # every value counts
+        total += value
+    return total
+
+
+if __name__ == '__main__':
+    print(solve(int(arg) for arg in sys.argv[1:]))
+'''
+
+_java_source = '''/* Assignment {assignment}, submitted by student {student}. */
+public class Solution {{
+    // running total
+    public static int solve(int[] values) {{
+        int total = 0; // start at zero
+        for (int value : values) total += value;
+        return total;
+    }}
+
+    public static void main(String[] args) {{
+        System.out.println("http://example.edu // not a comment");
+    }}
+}}
+'''
+
+
+class MockLMS:
+
+    def __init__(self, courses=3, assignments_per_course=5, students=30, files_per_submission=3,
+                 file_size=20000, binary_share=.5, folio=False, page_size=100, seed=0, drop_every=0):
+        # file_size is roughly the size of every submitted file, binary_share the fraction of files that are
+        # already-compressed PDFs/images instead of source. folio serves Georgia Southern's grade page layout.
+        # drop_every=n closes the connection halfway through every n-th zip reply, 0 never does.
+        self.students = students
+        self.files_per_submission = files_per_submission
+        self.file_size = file_size
+        self.binary_share = binary_share
+        self.folio = folio
+        self.page_size = page_size
+        self.seed = seed
+        self.courses = [(f'CSCI {1301 + number} Section A', str(6000 + number)) for number in range(courses)]
+        # course_id -> list of folder dicts like the Valence DropboxFolder
+        self.folders = {}
+        for course_number, (course_name, course_id) in enumerate(self.courses):
+            self.folders[course_id] = [{
+                'Id': 70000 + course_number * 100 + number,
+                'Name': f'Assignment {number + 1}',
+                'TotalUsers': students,
+                'TotalUsersWithSubmissions': students,
+                'TotalUsersWithFeedback': students,
+                'GradeItemId': 90000 + course_number * 100 + number,
+            } for number in range(assignments_per_course)]
+        self.drop_every = drop_every
+        self.lock = threading.Lock()
+        self.zips = {}
+        self.zip_replies = 0
+
+    def user_id(self, student):
+        return 100000 + student
+
+    def grade(self, student):
+        # the same grades the synthetic grade pages show
+        return student % 101
+
+    def drop_reply(self):
+        # whether the zip reply being sent now gets cut off
+        with self.lock:
+            self.zip_replies += 1
+            return bool(self.drop_every) and self.zip_replies % self.drop_every == 0
+
+    def assignments(self):
+        # (course_name, course_id, assignment_id) of every folder, the work list the scripts build
+        return [(course_name, course_id, str(folder['Id'])) for course_name, course_id in self.courses for folder in self.folders[course_id]]
+
+    def submitted_files(self, assignment_id, student):
+        # deterministic (file name, contents) for one student's submission
+        generator = random.Random(self.seed * 1000003 + int(assignment_id) * 1009 + student)
+        files = []
+        for number in range(self.files_per_submission):
+            if generator.random() < self.binary_share:
+                suffix = generator.choice(('.pdf', '.png', '.jpg'))
+                files.append((f'file{number}{suffix}', generator.randbytes(self.file_size)))
+            else:
+                suffix, template = generator.choice((('.py', _python_source), ('.java', _java_source)))
+                source = template.format(assignment=assignment_id, student=student)
+                files.append((f'file{number}{suffix}', (source * (self.file_size // len(source) + 1)).encode('utf-8')))
+        return files
+
+    def submissions_zip(self, assignment_id):
+        # the zip D2L builds for "download all": one entry per file, named student id-assignment id - name - date - file
+        with self.lock:
+            if assignment_id in self.zips:
+                return self.zips[assignment_id]
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as zipf:
+            zipf.writestr('index.html', '<html><body>Submissions</body></html>')
+            for student in range(self.students):
+                for file_name, data in self.submitted_files(assignment_id, student):
+                    zipf.writestr(f'{self.user_id(student)}-{assignment_id} - Student{student}, Name - Jan 1, 2024 1200 PM - {file_name}', data)
+        with self.lock:
+            self.zips[assignment_id] = buffer.getvalue()
+        return self.zips[assignment_id]
+
+    def student_zip(self, assignment_id, student):
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as zipf:
+            zipf.writestr('metadata.yml', f'student: {student}\n')
+            for file_name, data in self.submitted_files(assignment_id, student):
+                zipf.writestr(file_name, data)
+        return buffer.getvalue()
+
+    def export_zip(self, assignment_id):
+        # Gradescope's "Export Submissions" archive: a folder per submission, the submission id being the student number
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as zipf:
+            root = f'assignment_{assignment_id}_export'
+            zipf.writestr(f'{root}/submission_metadata.yml', ''.join(f'submission_{student}:\n  :submitters:\n  - :name: Student {student}\n'
+                                                                     for student in range(self.students)))
+            for student in range(self.students):
+                for file_name, data in self.submitted_files(assignment_id, student):
+                    zipf.writestr(f'{root}/submission_{student}/{file_name}', data)
+        return buffer.getvalue()
+
+    def folder(self, course_id, folder_id):
+        for folder in self.folders.get(course_id, ()):
+            if str(folder['Id']) == str(folder_id):
+                return folder
+        return None
+
+    def grade_item_folder(self, course_id, grade_object_id):
+        for folder in self.folders.get(course_id, ()):
+            if str(folder['GradeItemId']) == str(grade_object_id):
+                return folder
+        return None
+
+
+def _enrollments_page(lms, bookmark):
+    start = int(bookmark or 0)
+    items = [{'OrgUnit': {'Id': int(course_id), 'Name': course_name, 'Code': course_name.replace(' ', ''),
+                          'Type': {'Id': course_offering_type_id, 'Code': 'Course Offering'}},
+              'Access': {'IsActive': True, 'ClasslistRoleName': 'Instructor'}}
+             for course_name, course_id in lms.courses[start:start + lms.page_size]]
+    more = start + lms.page_size < len(lms.courses)
+    return {'Items': items, 'PagingInfo': {'Bookmark': str(start + lms.page_size) if more else '', 'HasMoreItems': more}}
+
+
+def _grade_values_page(lms, base_url, path, bookmark):
+    start = int(bookmark or 0)
+    objects = [{'User': {'Identifier': str(lms.user_id(student)), 'DisplayName': f'Student{student}, Name'},
+                'GradeValue': {'PointsNumerator': float(lms.grade(student)), 'PointsDenominator': 100.0,
+                               'DisplayedGrade': f'{lms.grade(student)} / 100'}}
+               for student in range(start, min(start + lms.page_size, lms.students))]
+    more = start + lms.page_size < lms.students
+    return {'Objects': objects, 'Next': f'{base_url}{path}?bookmark={start + lms.page_size}' if more else None}
+
+
+def _course_search_page(lms):
+    rows = ''.join(f'<tr><td><a class="d2l-link" href="/d2l/home/{course_id}">{course_name}</a></td></tr>' for course_name, course_id in lms.courses)
+    return f'<html><body><d2l-input-search></d2l-input-search><select><option>Instructor</option></select><d2l-table-wrapper><table>{rows}</table></d2l-table-wrapper></body></html>'
+
+
+def _folders_manage_page(lms, course_id):
+    rows = ''.join(f'<tr><td><a class="d2l-link" title="View {folder["Name"]}" href="/d2l/lms/dropbox/admin/mark/folder_submissions_files.d2l?db={folder["Id"]}&amp;ou={course_id}">{folder["Name"]}</a></td>'
+                   f'<td>{folder["TotalUsersWithSubmissions"]}</td><td>{folder["TotalUsersWithFeedback"]}</td></tr>' for folder in lms.folders.get(course_id, ()))
+    return f'<html><body><form><d2l-table-wrapper><table><tbody>{rows}</tbody></table></d2l-table-wrapper></form></body></html>'
+
+
+def _submissions_page(assignment_id, course_id):
+    return (f'<html><body><select><option value="200">200 per page</option></select><d2l-table-wrapper><table><tr><th><input type="checkbox"></th></tr></table></d2l-table-wrapper>'
+            f'<d2l-button-subtle text="Download"></d2l-button-subtle><span><a href="/d2l/common/viewFile.d2lfile/Temp/{assignment_id}.zip?ou={course_id}">Download</a></span></body></html>')
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    lms = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, body, content_type, status=200):
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_file(self, body, content_type):
+        etag = f'"{zlib.crc32(body):08x}-{len(body)}"'
+        match = re.fullmatch(r'bytes=(\d+)-', self.headers.get('Range', ''))
+        # a Range with an outdated If-Range gets the whole file
+        partial = match is not None and self.headers.get('If-Range', etag) == etag
+        start = int(match.group(1)) if partial else 0
+        if start and start >= len(body):
+            self.send_response(416)
+            self.send_header('Content-Range', f'bytes */{len(body)}')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(206 if partial else 200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body) - start))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', etag)
+        if partial:
+            self.send_header('Content-Range', f'bytes {start}-{len(body) - 1}/{len(body)}')
+        self.end_headers()
+        if self.lms.drop_reply():
+            self.wfile.write(body[start:start + (len(body) - start) // 2])
+            self.close_connection = True
+            return
+        self.wfile.write(body[start:])
+
+    def _json(self, data):
+        self._send(json.dumps(data), 'application/json')
+
+    def do_GET(self):
+        lms = self.lms
+        url = urlsplit(self.path)
+        path = url.path
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        base_url = f'http://{self.headers.get("Host")}'
+
+        if re.fullmatch(r'/d2l/api/lp/[\d.]+/users/whoami', path):
+            return self._json({'Identifier': '1', 'FirstName': 'Mock', 'LastName': 'Instructor'})
+        if re.fullmatch(r'/d2l/api/lp/[\d.]+/enrollments/myenrollments/', path):
+            return self._json(_enrollments_page(lms, query.get('bookmark')))
+        match = re.fullmatch(r'/d2l/api/le/[\d.]+/(\d+)/dropbox/folders/', path)
+        if match:
+            return self._json(lms.folders.get(match.group(1), []))
+        match = re.fullmatch(r'/d2l/api/le/[\d.]+/(\d+)/grades/(\d+)/values/', path)
+        if match and lms.grade_item_folder(match.group(1), match.group(2)) is not None:
+            return self._json(_grade_values_page(lms, base_url, path, query.get('bookmark')))
+        match = re.fullmatch(r'/old/activities/6606_2000_(\d+)/usages/(\d+)', path)
+        if match and lms.folder(match.group(2), match.group(1)) is not None:
+            grade_object_id = lms.folder(match.group(2), match.group(1))['GradeItemId']
+            links = [{'rel': [f'rel{number}'], 'href': f'{base_url}/link/{number}'} for number in range(17)]
+            links.append({'rel': ['https://activities.api.brightspace.com/rels/grade'],
+                          'href': f'{base_url}/organizations/{match.group(2)}/grade-objects/{grade_object_id}'})
+            return self._json({'class': ['activity-usage'], 'links': links})
+        if path == '/d2l/lms/grades/admin/enter/grade_item_edit.d2l':
+            return self._send(synthetic_grade_item_edit(lms.students, folio=lms.folio), 'text/html')
+        if path == '/d2l/le/manageCourses/search/6606':
+            return self._send(_course_search_page(lms), 'text/html')
+        if path == '/d2l/lms/dropbox/admin/folders_manage.d2l':
+            return self._send(_folders_manage_page(lms, query.get('ou')), 'text/html')
+        if path == '/d2l/lms/dropbox/admin/mark/folder_submissions_files.d2l':
+            return self._send(_submissions_page(query.get('db'), query.get('ou')), 'text/html')
+        match = re.fullmatch(r'/d2l/common/viewFile\.d2lfile/Temp/(\d+)\.zip', path)
+        if match:
+            return self._send_file(lms.submissions_zip(match.group(1)), 'application/zip')
+        match = re.fullmatch(r'/courses/(\d+)/assignments/(\d+)/review_grades', path)
+        if match:
+            return self._send(synthetic_review_grades(lms.students, match.group(1), match.group(2)), 'text/html')
+        match = re.fullmatch(r'/courses/(\d+)/assignments/(\d+)/submissions/(\d+)\.zip', path)
+        if match:
+            return self._send_file(lms.student_zip(match.group(2), int(match.group(3))), 'application/zip')
+        match = re.fullmatch(r'/courses/(\d+)/generated_files/(\d+)\.json', path)
+        if match:
+            return self._json({'id': int(match.group(2)), 'status': 'completed'})
+        match = re.fullmatch(r'/courses/(\d+)/generated_files/(\d+)\.zip', path)
+        if match:
+            # the generated file id is the assignment id
+            return self._send_file(lms.export_zip(match.group(2)), 'application/zip')
+        self._send('Not found', 'text/plain', 404)
+
+    def do_POST(self):
+        path = urlsplit(self.path).path
+        self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        match = re.fullmatch(r'/courses/(\d+)/assignments/(\d+)/export', path)
+        if match:
+            return self._json({'generated_file_id': int(match.group(2))})
+        self._send('Not found', 'text/plain', 404)
+
+
+def start_mock_lms(lms, port=0):
+    # serves lms on localhost from a daemon thread, returns (server, hostname_url); port 0 picks a free port
+    handler = type('Handler', (_Handler,), {'lms': lms})
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='mock_lms', daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_address[1]}'
+
+
+if __name__ == '__main__':
+    server, hostname_url = start_mock_lms(MockLMS(), int(sys.argv[1]) if len(sys.argv) > 1 else 8000)
+    print(f"Mock LMS serving on {hostname_url}, press Ctrl+C to stop")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
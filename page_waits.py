@@ -0,0 +1,85 @@
+'''
+Waits on the real page state instead of fixed sleeps.
+
+Each wait polls a condition (document ready, network idle, element present,
+window count, ...) and returns as soon as it holds, so a fast page costs a few
+milliseconds instead of a whole sleep. WaitTimings records how long every kind
+of wait actually took, so the run report shows where the browser time goes.
+'''
+
+import threading
+from time import perf_counter
+from selenium.common.exceptions import TimeoutException
+from selenium.webdriver.support.ui import WebDriverWait
+
+poll_frequency = .05
+
+
+def document_ready(driver):
+    return driver.execute_script("return document.readyState") == 'complete'
+
+
+class network_idle:
+    # true once the document is loaded and no new request has finished for idle_seconds.
+    # Requests are counted through the browser's resource timing entries, whose buffer is raised from its default 250.
+
+    def __init__(self, idle_seconds=.3):
+        self.idle_seconds = idle_seconds
+        self.state = None
+        self.changed_at = None
+
+    def __call__(self, driver):
+        state = driver.execute_script("performance.setResourceTimingBufferSize(100000);"
+                                      "return [document.readyState, performance.getEntriesByType('resource').length];")
+        now = perf_counter()
+        if state != self.state:
+            self.state = state
+            self.changed_at = now
+            return False
+        return state[0] == 'complete' and now - self.changed_at >= self.idle_seconds
+
+
+def option_value_is(xpath, value):
+    # for the 'x per page' hack: true once the option really carries the new value
+    def condition(driver):
+        return driver.execute_script("const option = document.evaluate(arguments[0], document, null, XPathResult.ANY_TYPE, null).iterateNext();"
+                                     "return option !== null && option.value === arguments[1];", xpath, str(value))
+    return condition
+
+
+class WaitTimings:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.waits = {}  # label -> {'count', 'timeouts', 'seconds', 'max'}
+
+    def wait(self, driver, label, condition, timeout=30, required=True):
+        # Returns what the condition returned. A required wait raises TimeoutException like WebDriverWait,
+        # otherwise the timeout is only counted and False is returned, like the sleep it replaced would have carried on.
+        start = perf_counter()
+        timed_out = False
+        try:
+            return WebDriverWait(driver, timeout, poll_frequency=poll_frequency).until(condition)
+        except TimeoutException:
+            timed_out = True
+            if required:
+                raise
+            return False
+        finally:
+            elapsed = perf_counter() - start
+            with self.lock:
+                stats = self.waits.setdefault(label, {'count': 0, 'timeouts': 0, 'seconds': 0.0, 'max': 0.0})
+                stats['count'] += 1
+                stats['timeouts'] += timed_out
+                stats['seconds'] += elapsed
+                stats['max'] = max(stats['max'], elapsed)
+
+    def summary(self):
+        with self.lock:
+            return {label: dict(stats) for label, stats in self.waits.items()}
+
+    def print_report(self):
+        print("Browser waits")
+        for label, stats in sorted(self.waits.items(), key=lambda entry: -entry[1]['seconds']):
+            print(f"\t{label}: {stats['count']} waits ({stats['timeouts']} timed out), {stats['seconds']:.1f} s total, "
+                  f"{stats['seconds'] / stats['count']:.2f} s average, {stats['max']:.2f} s longest")
@@ -0,0 +1,97 @@
+'''
+Staged pipeline with bounded queues between the stages.
+
+Each stage is a function run by its own worker threads. It takes a work item (a dict)
+and returns it for the next stage, or None to drop it. The queues between stages are
+bounded, so a fast stage can only run a few items ahead of a slow one. A stage that
+must stay on one thread, like the one driving the browser, gets a single worker.
+'''
+
+import queue
+import threading
+from time import perf_counter
+
+_done = object()
+
+
+class Pipeline:
+
+    def __init__(self, stages, queue_size=4):
+        # stages is a list of (name, function, number of workers)
+        self.stages = stages
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in stages]
+        self.lock = threading.Lock()
+        self.stats = {}  # (stage name, worker name) -> {'items', 'dropped', 'failures', 'bytes', 'seconds'}
+        self.start_time = perf_counter()
+        self.threads = []
+        for index, (name, function, workers) in enumerate(stages):
+            stage_threads = []
+            for number in range(workers):
+                thread = threading.Thread(target=self._work, args=(index, name, function),
+                                          name=f'{name}_{number}', daemon=True)
+                thread.start()
+                stage_threads.append(thread)
+            self.threads.append(stage_threads)
+
+    def put(self, item):
+        # blocks while the first stage's queue is full
+        self.queues[0].put(item)
+
+    def _work(self, index, name, function):
+        worker = threading.current_thread().name
+        next_queue = self.queues[index + 1] if index + 1 < len(self.queues) else None
+        while True:
+            item = self.queues[index].get()
+            if item is _done:
+                return
+            start = perf_counter()
+            failed = False
+            try:
+                result = function(item)
+            except Exception as e:
+                failed = True
+                result = None
+                print(f"\t[{worker}] {name} failed for {item.get('assignment_id', item)}: {e!r}")
+            elapsed = perf_counter() - start
+            with self.lock:
+                stats = self.stats.setdefault((name, worker), {'items': 0, 'dropped': 0, 'failures': 0, 'bytes': 0, 'seconds': 0.0})
+                stats['items'] += 1
+                stats['failures'] += failed
+                stats['dropped'] += result is None and not failed
+                stats['seconds'] += elapsed
+                if result is not None:
+                    stats['bytes'] += result.pop('stage_bytes', 0)
+            if result is not None and next_queue is not None:
+                next_queue.put(result)
+
+    def close(self):
+        # let every stage drain in order: a stage only gets its stop signals once everything before it has finished
+        for stage_queue, stage_threads in zip(self.queues, self.threads):
+            for _ in stage_threads:
+                stage_queue.put(_done)
+            for thread in stage_threads:
+                thread.join()
+
+    def summary(self):
+        # the same numbers as print_report(), as JSON-friendly dicts for the run metrics file
+        with self.lock:
+            stages = {}
+            for name, _, _ in self.stages:
+                stages[name] = {worker: dict(stats) for (stage, worker), stats in sorted(self.stats.items()) if stage == name}
+        return {'wall_seconds': perf_counter() - self.start_time, 'stages': stages}
+
+    def print_report(self):
+        wall_time = perf_counter() - self.start_time
+        print(f"Pipeline finished in {wall_time:.1f} s")
+        for name, _, _ in self.stages:
+            workers = sorted(worker for stage, worker in self.stats if stage == name)
+            items = sum(self.stats[(name, worker)]['items'] for worker in workers)
+            print(f"\tStage {name}: {items} items")
+            for worker in workers:
+                stats = self.stats[(name, worker)]
+                line = (f"\t\t{worker}: {stats['items']} items ({stats['dropped']} skipped, {stats['failures']} failed), "
+                        f"{stats['seconds']:.1f} s busy")
+                if stats['bytes']:
+                    rate = stats['bytes'] / stats['seconds'] if stats['seconds'] else 0
+                    line += f", {stats['bytes'] / 1e6:.1f} MB ({rate / 1e6:.2f} MB/s)"
+                print(line)
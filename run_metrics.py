@@ -0,0 +1,129 @@
+'''
+Counters and latency histograms for each stage of a run, saved as JSON at the end.
+
+The scripts time every login, listing, token fetch, grade request, download,
+rewrite and final zip step through one RunMetrics object shared by all worker
+threads. Latencies go into fixed buckets (10 ms up to 10 min), so the file has
+the same shape on every run and two runs can be compared bucket by bucket.
+Steps that move data also record bytes, from which the throughput is computed.
+The file is written with a temporary file and a swap, like the sync manifest.
+'''
+
+import json
+import os
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from time import perf_counter
+
+# upper bounds in seconds, everything slower lands in the last '+inf' bucket
+latency_buckets = (.01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+
+def quiet_print(*args, **kwargs):
+    # stands in for print when the scripts run with verbose = False
+    pass
+
+
+class _Measurement:
+    # what a timer() block can fill in before it ends: the bytes it moved
+
+    def __init__(self):
+        self.bytes = 0
+
+
+class RunMetrics:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = datetime.now(timezone.utc)
+        self.start_time = perf_counter()
+        self.counters = {}  # name -> count
+        self.latencies = {}  # name -> {'count', 'seconds', 'min', 'max', 'bytes', 'buckets'}
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def observe(self, name, seconds, size=0):
+        with self.lock:
+            stats = self.latencies.get(name)
+            if stats is None:
+                stats = self.latencies[name] = {'count': 0, 'seconds': 0.0, 'min': seconds, 'max': seconds, 'bytes': 0,
+                                                'buckets': [0] * (len(latency_buckets) + 1)}
+            stats['count'] += 1
+            stats['seconds'] += seconds
+            stats['min'] = min(stats['min'], seconds)
+            stats['max'] = max(stats['max'], seconds)
+            stats['bytes'] += size
+            stats['buckets'][bisect_left(latency_buckets, seconds)] += 1
+
+    @contextmanager
+    def timer(self, name):
+        # times the block under name; a block that raises is counted as '<name>.failures' instead
+        measurement = _Measurement()
+        start = perf_counter()
+        try:
+            yield measurement
+        except BaseException:
+            self.count(f'{name}.failures')
+            raise
+        self.observe(name, perf_counter() - start, measurement.bytes)
+
+    @staticmethod
+    def _percentile(stats, fraction):
+        # upper bound of the bucket the percentile falls in, the largest observation for the last bucket
+        rank = fraction * stats['count']
+        seen = 0
+        for index, bucket_count in enumerate(stats['buckets']):
+            seen += bucket_count
+            if seen >= rank and bucket_count:
+                return min(latency_buckets[index], stats['max']) if index < len(latency_buckets) else stats['max']
+        return stats['max']
+
+    def summary(self):
+        with self.lock:
+            latencies = {}
+            for name, stats in sorted(self.latencies.items()):
+                latencies[name] = {
+                    'count': stats['count'],
+                    'seconds': stats['seconds'],
+                    'mean': stats['seconds'] / stats['count'],
+                    'min': stats['min'],
+                    'max': stats['max'],
+                    'p50': self._percentile(stats, .5),
+                    'p95': self._percentile(stats, .95),
+                    'buckets': {(f'<={bound:g}' if index < len(latency_buckets) else '+inf'): bucket_count
+                                for index, (bound, bucket_count) in enumerate(zip(latency_buckets + (None,), stats['buckets']))},
+                }
+                if stats['bytes']:
+                    latencies[name]['bytes'] = stats['bytes']
+                    latencies[name]['bytes_per_second'] = stats['bytes'] / stats['seconds'] if stats['seconds'] else None
+            return {
+                'started': self.started.isoformat(),
+                'wall_seconds': perf_counter() - self.start_time,
+                'counters': dict(sorted(self.counters.items())),
+                'latencies': latencies,
+            }
+
+    def write(self, path, **sections):
+        # sections are extra JSON-friendly reports that go into the file next to the metrics, e.g. the pipeline's
+        data = self.summary()
+        data.update(sections)
+        temp_path = f'{path}.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as file:
+            json.dump(data, file, indent=1)
+        os.replace(temp_path, path)
+
+    def print_report(self):
+        summary = self.summary()
+        print(f"Run metrics ({summary['wall_seconds']:.1f} s)")
+        for name, stats in summary['latencies'].items():
+            line = (f"\t{name}: {stats['count']} x, {stats['seconds']:.1f} s total, "
+                    f"p50 {stats['p50']:.2f} s, p95 {stats['p95']:.2f} s, longest {stats['max']:.2f} s")
+            if stats.get('bytes_per_second'):
+                line += f", {stats['bytes'] / 1e6:.1f} MB ({stats['bytes_per_second'] / 1e6:.2f} MB/s)"
+            print(line)
+        for name, value in summary['counters'].items():
+            print(f"\t{name}: {value}")
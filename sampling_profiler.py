@@ -0,0 +1,166 @@
+'''
+Sampling profiler for whole runs of the download scripts (their --profile option).
+
+A background thread wakes up every few milliseconds and records the Python stack
+of every other thread through sys._current_frames(). Nothing is hooked into the
+code being run, so the overhead stays around a percent and the profiler can stay
+on for a full run. The samples are wall-clock time: a thread waiting on Selenium
+or a download shows up in the function it waits in, which is what makes a slow
+run slow.
+
+Every sample is put under the stage its thread works for. A thread gets its
+stage from set_stage(), or else from its name: the pipeline and pool threads are
+named after their stage with a worker number (download_0, rewrite_1, ...).
+Workers waiting for their next item are counted as idle instead of sampled.
+
+write() saves the stacks in the folded format of flamegraph.pl and speedscope,
+one "stage;outer function;...;inner function count" line per distinct stack:
+    flamegraph.pl profile.folded > profile.svg
+print_report() prints the time per stage and the functions with the most samples.
+Work done in other processes, like the strip stage's process pool, is not sampled.
+'''
+
+import os
+import re
+import sys
+import threading
+from collections import Counter
+from time import perf_counter
+
+# the frames a worker sits in while it has nothing to do: queue.get() called by the pipeline or a thread pool
+_idle_callers = {'_work', '_worker'}
+_worker_number = re.compile(r'_\d+$')
+
+
+class SamplingProfiler:
+
+    def __init__(self, interval=.005):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.stacks = Counter()  # (stage, frame, ..., frame) -> samples
+        self.idle = Counter()  # stage -> samples spent waiting for work
+        self.stages = {}  # thread id -> stage set with set_stage()
+        self.labels = {}  # code object -> frame label, so each function is formatted once
+        self.samples = 0
+        self.sampling_seconds = 0.0
+        self.thread = None
+        self.stopping = threading.Event()
+        self.start_time = None
+        self.stop_time = None
+
+    def set_stage(self, stage):
+        # the stage the calling thread's samples go under from now on
+        self.stages[threading.get_ident()] = stage
+
+    def start(self):
+        self.start_time = perf_counter()
+        self.stopping.clear()
+        self.thread = threading.Thread(target=self._sample_loop, name='sampling_profiler', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is None:
+            return
+        self.stopping.set()
+        self.thread.join()
+        self.thread = None
+        self.stop_time = perf_counter()
+
+    def _label(self, code):
+        label = self.labels.get(code)
+        if label is None:
+            label = self.labels[code] = f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'
+        return label
+
+    def _stage(self, thread_id, names):
+        stage = self.stages.get(thread_id)
+        if stage is None:
+            stage = _worker_number.sub('', names.get(thread_id, 'unknown thread'))
+        return stage
+
+    def _sample_loop(self):
+        own_id = threading.get_ident()
+        next_sample = perf_counter()
+        while not self.stopping.is_set():
+            start = perf_counter()
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            stacks = []
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                codes = []
+                while frame is not None:
+                    codes.append(frame.f_code)
+                    frame = frame.f_back
+                stage = self._stage(thread_id, names)
+                if self._is_idle(codes):
+                    stacks.append((stage, None))
+                else:
+                    stacks.append((stage, tuple(self._label(code) for code in reversed(codes))))
+            with self.lock:
+                for stage, stack in stacks:
+                    if stack is None:
+                        self.idle[stage] += 1
+                    else:
+                        self.stacks[(stage,) + stack] += 1
+                self.samples += 1
+                self.sampling_seconds += perf_counter() - start
+            # fixed schedule, so a slow sample doesn't shift the ones after it
+            next_sample += self.interval
+            delay = next_sample - perf_counter()
+            if delay > 0:
+                self.stopping.wait(delay)
+            else:
+                next_sample = perf_counter()
+
+    @staticmethod
+    def _is_idle(codes):
+        # codes go from the innermost frame outwards.
+        # ThreadPoolExecutor workers wait in SimpleQueue.get(), which is C, so their innermost Python frame is _worker itself
+        if codes and codes[0].co_name == '_worker' and codes[0].co_filename.replace(os.sep, '/').endswith('concurrent/futures/thread.py'):
+            return True
+        for inner, outer in zip(codes, codes[1:]):
+            if inner.co_name == 'get' and os.path.basename(inner.co_filename) == 'queue.py':
+                return outer.co_name in _idle_callers
+        return False
+
+    def write(self, path):
+        with self.lock:
+            lines = [f"{';'.join(stack)} {count}" for stack, count in sorted(self.stacks.items())]
+        temp_path = f'{path}.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as file:
+            file.write('\n'.join(lines) + '\n')
+        os.replace(temp_path, path)
+
+    def print_report(self, top=25):
+        with self.lock:
+            stacks = dict(self.stacks)
+            idle = dict(self.idle)
+            samples = self.samples
+            sampling_seconds = self.sampling_seconds
+        elapsed = (self.stop_time or perf_counter()) - self.start_time
+        print(f"Profile: {samples} samples over {elapsed:.1f} s, "
+              f"{sampling_seconds / elapsed * 100 if elapsed else 0:.1f}% of the time spent sampling")
+
+        # a sample stands for one sampling period of one thread's wall-clock time
+        period = elapsed / samples if samples else self.interval
+        stage_samples = Counter()
+        stage_functions = Counter()
+        self_samples = Counter()
+        total_samples = Counter()
+        for stack, count in stacks.items():
+            stage_samples[stack[0]] += count
+            stage_functions[(stack[0], stack[-1])] += count
+            self_samples[stack[-1]] += count
+            for label in set(stack[1:]):
+                total_samples[label] += count
+        print("\tTime per stage, with its busiest functions")
+        for stage, count in stage_samples.most_common():
+            print(f"\t\t{stage}: {count * period:.1f} s busy, {idle.get(stage, 0) * period:.1f} s idle")
+            hottest = [(label, function_count) for (function_stage, label), function_count in stage_functions.most_common()
+                       if function_stage == stage][:3]
+            for label, function_count in hottest:
+                print(f"\t\t\t{function_count * period:8.1f} s  {label}")
+        print(f"\tTop {top} functions by own time")
+        for label, count in self_samples.most_common(top):
+            print(f"\t\t{count * period:8.1f} s own, {total_samples[label] * period:8.1f} s total  {label}")
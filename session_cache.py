@@ -0,0 +1,104 @@
+'''
+Persistent cache of an authenticated D2L session.
+
+After a full SAML + Duo login the browser cookies and the D2L.Fetch.Tokens entry
+are saved to disk. The next run checks them with one cheap API request and, if the
+session is still alive, loads them into the browser so the login is skipped.
+On Windows the cache is encrypted for the current user with DPAPI, elsewhere it
+is only readable by the current user.
+'''
+
+import json
+import os
+from time import time
+import requests
+
+from brightspace_api import lp_api_version
+
+# the keys webdriver's add_cookie() accepts
+_cookie_keys = ('name', 'value', 'path', 'domain', 'secure', 'httpOnly', 'expiry')
+
+
+if os.name == 'nt':
+    import ctypes
+    from ctypes import wintypes
+
+    class _DataBlob(ctypes.Structure):
+        _fields_ = [('cbData', wintypes.DWORD), ('pbData', ctypes.POINTER(ctypes.c_char))]
+
+    def _dpapi(function, data):
+        buffer = ctypes.create_string_buffer(data, len(data))
+        blob_in = _DataBlob(len(data), ctypes.cast(buffer, ctypes.POINTER(ctypes.c_char)))
+        blob_out = _DataBlob()
+        if not function(ctypes.byref(blob_in), None, None, None, None, 0, ctypes.byref(blob_out)):
+            raise ctypes.WinError()
+        try:
+            return ctypes.string_at(blob_out.pbData, blob_out.cbData)
+        finally:
+            ctypes.windll.kernel32.LocalFree(blob_out.pbData)
+
+    def _protect(data):
+        return _dpapi(ctypes.windll.crypt32.CryptProtectData, data)
+
+    def _unprotect(data):
+        return _dpapi(ctypes.windll.crypt32.CryptUnprotectData, data)
+else:
+    def _protect(data):
+        return data
+
+    def _unprotect(data):
+        return data
+
+
+def save_session(cache_path, cookies, fetch_tokens):
+    # cookies come from driver.get_cookies(), fetch_tokens is the raw localStorage['D2L.Fetch.Tokens'] string
+    data = json.dumps({'saved_at': time(), 'cookies': cookies, 'fetch_tokens': fetch_tokens}).encode('utf-8')
+    # create the file with owner-only permissions before anything is written to it
+    fd = os.open(cache_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'wb') as file:
+        file.write(_protect(data))
+
+
+def load_session(cache_path):
+    if not os.path.isfile(cache_path):
+        return None
+    try:
+        with open(cache_path, 'rb') as file:
+            return json.loads(_unprotect(file.read()).decode('utf-8'))
+    except (OSError, ValueError) as e:
+        print(f"Could not read session cache {cache_path}: {e!r}")
+        return None
+
+
+def fetch_token(fetch_tokens):
+    # the access token from a raw D2L.Fetch.Tokens value, or None if it is missing or expired
+    try:
+        token = json.loads(fetch_tokens)['*:*:*']
+    except (TypeError, ValueError, KeyError):
+        return None
+    if token.get('expires_at', 0) <= time():
+        return None
+    return token.get('access_token')
+
+
+def session_is_valid(session, hostname_url, cookies):
+    # whoami is the cheapest authenticated request, it fails with 401/403 or a login redirect once the session expired
+    for cookie in cookies:
+        session.cookies.set(cookie['name'], cookie['value'])
+    try:
+        response = session.get(f'{hostname_url}/d2l/api/lp/{lp_api_version}/users/whoami', allow_redirects=False, timeout=30)
+    except requests.RequestException as e:
+        print(f"Could not check cached session: {e!r}")
+        return False
+    return response.status_code == 200
+
+
+def restore_browser_session(driver, hostname_url, home_url, cached_session):
+    # cookies can only be added for the domain the browser is on, so load a page there first
+    driver.get(f'{hostname_url}/d2l/login')
+    for cookie in cached_session['cookies']:
+        driver.add_cookie({key: cookie[key] for key in _cookie_keys if key in cookie})
+    if fetch_token(cached_session.get('fetch_tokens')):
+        driver.execute_script("localStorage['D2L.Fetch.Tokens'] = arguments[0];", cached_session['fetch_tokens'])
+    driver.get(home_url)
+    return driver.current_url == home_url
@@ -0,0 +1,270 @@
+'''
+Similarity fingerprints of every submission, computed while the scripts rewrite them.
+
+Each source file loses its comments and docstrings through strip_source() (the
+same remove_python_comments_and_docstrings() / remove_java_comments() the strip
+stage uses) and is split into tokens, with every identifier that isn't a keyword
+turned into I, numbers into N and string literals into S, so renaming variables
+or rewording comments changes nothing. The hashes of every k tokens in a row are
+winnowed (Schleimer et al.) into the submission's fingerprints, and those get a
+MinHash signature. A submission is all files with one anonymized id: one
+submitted file or folder for the D2L scripts, one student's folder on Gradescope.
+
+The signatures go into an SQLite locality-sensitive index: split into bands,
+each band hashed into a bucket, and two submissions that share a bucket in any
+band are a candidate pair. Finding near-duplicates across a course or across
+semesters is then one indexed self-join on the buckets instead of comparing
+every pair of files. With the default 32 bands of 4 rows, pairs whose
+fingerprints have a Jaccard similarity of .5 are found 87% of the time and
+pairs at .8 almost always. Candidates are ranked by the exact Jaccard
+similarity of their fingerprints.
+
+Run this file to list the candidate pairs:
+    python similarity_index.py similarity_index.sqlite --course 6001 --threshold .6
+'''
+
+import argparse
+import hashlib
+import os
+import random
+import re
+import sqlite3
+import struct
+import threading
+import zipfile
+from collections import defaultdict
+
+from dataset_export import languages, decode_text
+from source_stripping import strip_source
+from submission_catalog import parse_d2l_member_name, parse_gradescope_folder_name, grade_number
+
+kgram_size = 5 # tokens hashed together, shorter common runs don't count
+winnow_window = 4 # consecutive k-gram hashes that share one fingerprint, any common run of window + k - 1 tokens is found
+bands = 32
+rows_per_band = 4
+
+_token = re.compile(r'''
+      (?P<name>[A-Za-z_$][\w$]*)
+    | (?P<number>\d[\w.]*)
+    | (?P<string>"(?:\\.|[^"\\\n])*"|'(?:\\.|[^'\\\n])*')
+    | (?P<operator>==|!=|<=|>=|&&|\|\||->|=>|::|\+\+|--|\+=|-=|\*=|/=|<<|>>|\*\*|[^\s\w])
+''', re.VERBOSE)
+
+# kept as they are, they carry the structure that renaming can't change
+_keywords = frozenset('''
+    and as assert async await break case catch class const continue def default del do elif else enum except extends
+    final finally for foreach from func function fn global if implements import in interface is lambda let match new
+    nonlocal not null None or package pass print private protected public raise return self static struct super switch
+    this throw throws True False true false try typedef union using var void while with yield
+    int long short char float double bool boolean byte string String unsigned signed auto
+'''.split())
+
+_mersenne_prime = (1 << 61) - 1
+# fixed seed, signatures of different runs have to be comparable
+_generator = random.Random(20240101)
+_permutations = [(_generator.randrange(1, _mersenne_prime), _generator.randrange(_mersenne_prime))
+                 for _ in range(bands * rows_per_band)]
+
+_schema = '''
+CREATE TABLE IF NOT EXISTS submissions (
+    id INTEGER PRIMARY KEY,
+    lms TEXT NOT NULL,
+    course_id TEXT NOT NULL,
+    course_name TEXT,
+    assignment_id TEXT NOT NULL,
+    assignment_name TEXT,
+    anonymized_id INTEGER NOT NULL,
+    grade REAL,
+    files INTEGER NOT NULL,
+    tokens INTEGER NOT NULL,
+    minhash BLOB NOT NULL,
+    fingerprints BLOB NOT NULL,
+    UNIQUE (lms, course_id, assignment_id, anonymized_id)
+);
+CREATE TABLE IF NOT EXISTS lsh_buckets (
+    band INTEGER NOT NULL,
+    bucket INTEGER NOT NULL,
+    submission INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS lsh_buckets_bucket ON lsh_buckets (band, bucket);
+CREATE INDEX IF NOT EXISTS lsh_buckets_submission ON lsh_buckets (submission);
+CREATE INDEX IF NOT EXISTS submissions_assignment ON submissions (lms, course_id, assignment_id);
+'''
+
+
+def normalized_tokens(file_name, text):
+    source = strip_source(file_name, text.encode('utf-8', errors='surrogateescape')).decode('utf-8', errors='surrogateescape')
+    tokens = []
+    for match in _token.finditer(source):
+        kind = match.lastgroup
+        if kind == 'name':
+            tokens.append(match.group() if match.group() in _keywords else 'I')
+        elif kind == 'number':
+            tokens.append('N')
+        elif kind == 'string':
+            tokens.append('S')
+        else:
+            tokens.append(match.group())
+    return tokens
+
+
+def _hash64(text):
+    return int.from_bytes(hashlib.blake2b(text.encode('utf-8'), digest_size=8).digest(), 'big')
+
+
+def winnow(tokens, k=kgram_size, window=winnow_window):
+    # the smallest of every window of consecutive k-gram hashes
+    hashes = [_hash64(' '.join(tokens[start:start + k])) for start in range(len(tokens) - k + 1)]
+    if len(hashes) <= window:
+        return set(hashes)
+    return {min(hashes[start:start + window]) for start in range(len(hashes) - window + 1)}
+
+
+def minhash(fingerprints):
+    return [min((a * value + b) % _mersenne_prime for value in fingerprints) for a, b in _permutations]
+
+
+def _band_buckets(signature):
+    # one bucket per band, a signed 64-bit hash of the band's rows so SQLite stores it as an INTEGER
+    for band in range(bands):
+        rows = signature[band * rows_per_band:(band + 1) * rows_per_band]
+        digest = hashlib.blake2b(struct.pack(f'<{rows_per_band}Q', *rows), digest_size=8).digest()
+        yield band, int.from_bytes(digest, 'big', signed=True)
+
+
+def _pack(values):
+    return struct.pack(f'<{len(values)}Q', *values)
+
+
+def _unpack(blob):
+    return struct.unpack(f'<{len(blob) // 8}Q', blob)
+
+
+class SimilarityIndex:
+
+    def __init__(self, db_path, reset=False):
+        if reset and os.path.isfile(db_path):
+            os.remove(db_path)
+        # shared by the rewrite workers, the lock keeps their transactions apart
+        self.connection = sqlite3.connect(db_path, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.submissions = 0
+        with self.lock, self.connection:
+            self.connection.executescript(_schema)
+
+    def add_zip(self, zip_path, lms, course_id, course_name, assignment_id, assignment_name=None):
+        # the submissions of an assignment zip whose members are named by submission_member_name().
+        # Folio keeps the original names of files without a grade, those have no anonymized id and are left out
+        files = defaultdict(list)
+        with zipfile.ZipFile(zip_path) as zipf:
+            for info in zipf.infolist():
+                anonymized_id, grade_text = parse_d2l_member_name(info.filename)
+                if info.is_dir() or anonymized_id is None or os.path.splitext(info.filename)[1].lower() not in languages:
+                    continue
+                files[(anonymized_id, grade_text)].append((info.filename, zipf.read(info)))
+        self._replace_assignment(lms, course_id, course_name, assignment_id, assignment_name, files)
+
+    def add_folder(self, folder_path, lms, course_id, course_name, assignment_id, assignment_name=None):
+        # the submissions of an assignment folder with a '<increasing_no>_<grade>%' folder per submission
+        files = defaultdict(list)
+        for root, dirs, names in os.walk(folder_path):
+            dirs.sort()
+            anonymized_id, grade_text = parse_gradescope_folder_name(os.path.relpath(root, folder_path).replace(os.sep, '/').split('/')[0])
+            if anonymized_id is None:
+                continue
+            for name in sorted(names):
+                if os.path.splitext(name)[1].lower() in languages:
+                    with open(os.path.join(root, name), 'rb') as file:
+                        files[(anonymized_id, grade_text)].append((name, file.read()))
+        self._replace_assignment(lms, course_id, course_name, assignment_id, assignment_name, files)
+
+    def _replace_assignment(self, lms, course_id, course_name, assignment_id, assignment_name, files):
+        # the fingerprints are computed before taking the lock, only the writes are serialized
+        submissions = []
+        for (anonymized_id, grade_text), submission_files in sorted(files.items()):
+            fingerprints = set()
+            token_count = 0
+            for file_name, data in submission_files:
+                text = decode_text(data)
+                if text is None:
+                    continue
+                tokens = normalized_tokens(file_name, text)
+                token_count += len(tokens)
+                fingerprints |= winnow(tokens)
+            if fingerprints:
+                submissions.append((anonymized_id, grade_number(grade_text), len(submission_files), token_count,
+                                    minhash(fingerprints), sorted(fingerprints)))
+        with self.lock, self.connection:
+            self.connection.execute('DELETE FROM lsh_buckets WHERE submission IN (SELECT id FROM submissions WHERE lms = ? AND course_id = ? AND assignment_id = ?)',
+                                    (lms, str(course_id), str(assignment_id)))
+            self.connection.execute('DELETE FROM submissions WHERE lms = ? AND course_id = ? AND assignment_id = ?',
+                                    (lms, str(course_id), str(assignment_id)))
+            for anonymized_id, grade, file_count, token_count, signature, fingerprints in submissions:
+                cursor = self.connection.execute(
+                    'INSERT INTO submissions (lms, course_id, course_name, assignment_id, assignment_name, anonymized_id, grade, files, tokens, minhash, fingerprints) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    (lms, str(course_id), course_name, str(assignment_id), assignment_name, anonymized_id, grade, file_count, token_count,
+                     _pack(signature), _pack(fingerprints)))
+                self.connection.executemany('INSERT INTO lsh_buckets (band, bucket, submission) VALUES (?, ?, ?)',
+                                            [(band, bucket, cursor.lastrowid) for band, bucket in _band_buckets(signature)])
+            self.submissions += len(submissions)
+
+    def candidate_pairs(self, course_id=None, assignment_id=None, threshold=.5):
+        # Pairs of submissions that share an LSH bucket, at least one of them in course_id / assignment_id when given,
+        # with a fingerprint Jaccard similarity of at least threshold, most similar first.
+        # Returns (similarity, submission dict, submission dict) tuples.
+        scope = []
+        parameters = []
+        for column, value in (('course_id', course_id), ('assignment_id', assignment_id)):
+            if value is not None:
+                scope.append(f'{column} = ?')
+                parameters.append(str(value))
+        where = ' AND '.join(scope) or '1'
+        with self.lock:
+            pairs = self.connection.execute(f'''
+                SELECT DISTINCT mine.submission, other.submission
+                FROM lsh_buckets AS mine JOIN lsh_buckets AS other
+                    ON other.band = mine.band AND other.bucket = mine.bucket AND other.submission != mine.submission
+                WHERE mine.submission IN (SELECT id FROM submissions WHERE {where})''', parameters).fetchall()
+            ids = sorted({submission for pair in pairs for submission in pair})
+            submissions = {}
+            # in chunks, SQLite limits the number of parameters of one statement
+            for start in range(0, len(ids), 500):
+                chunk = ids[start:start + 500]
+                cursor = self.connection.execute(f'SELECT * FROM submissions WHERE id IN ({", ".join("?" for _ in chunk)})', chunk)
+                names = [description[0] for description in cursor.description]
+                submissions.update((row[0], dict(zip(names, row))) for row in cursor.fetchall())
+        fingerprints = {submission_id: set(_unpack(submission.pop('fingerprints'))) for submission_id, submission in submissions.items()}
+        for submission in submissions.values():
+            del submission['minhash']
+        results = []
+        for first, second in {tuple(sorted(pair)) for pair in pairs}:
+            similarity = len(fingerprints[first] & fingerprints[second]) / len(fingerprints[first] | fingerprints[second])
+            if similarity >= threshold:
+                results.append((similarity, submissions[first], submissions[second]))
+        results.sort(key=lambda result: -result[0])
+        return results
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def print_report(self):
+        print(f"Similarity index: fingerprinted {self.submissions} submissions")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="List the near-duplicate submissions the similarity index finds.")
+    parser.add_argument('index', help="the similarity_index.sqlite a script wrote")
+    parser.add_argument('--course', help="only pairs with a submission in this course id")
+    parser.add_argument('--assignment', help="only pairs with a submission of this assignment id")
+    parser.add_argument('--threshold', type=float, default=.5, help="smallest Jaccard similarity of the fingerprints to list")
+    options = parser.parse_args()
+
+    index = SimilarityIndex(options.index)
+    results = index.candidate_pairs(options.course, options.assignment, options.threshold)
+    index.close()
+    for similarity, first, second in results:
+        print(f"{similarity:.2f}\t{first['course_name']} {first['assignment_id']} #{first['anonymized_id']}\t"
+              f"{second['course_name']} {second['assignment_id']} #{second['anonymized_id']}")
+    print(f"{len(results)} pairs")
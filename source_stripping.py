@@ -0,0 +1,167 @@
+'''
+Comment and docstring stripping for submitted source files.
+
+Python files go through the tokenize module once and the output is collected in a
+list, so the time is linear in the file size. C-family files (Java, C, C++, C#,
+JavaScript, TypeScript, Go, Kotlin, Swift, Rust, ...) go through one regular
+expression that matches comments and string literals in a single left-to-right
+pass, so a // inside a string is left alone. Files that don't tokenize are kept
+as they are.
+
+strip_zip_members() strips every supported member of a submissions zip on a
+process pool and copies the rest as-is. Run this file directly to strip a whole
+zip, e.g. downloads.zip, and print the throughput:
+    python source_stripping.py downloads.zip stripped.zip
+'''
+
+import io
+import os
+import re
+import sys
+import tokenize
+import zipfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from time import perf_counter
+
+from archive_utils import copy_raw_member, deflate_bytes, write_deflated_member
+
+python_extensions = {'.py'}
+c_family_extensions = {
+    '.java', '.js', '.ts', '.c', '.cpp', '.cc', '.cxx', '.c++', '.h', '.hpp', '.hxx', '.hh', '.h++',
+    '.cs', '.go', '.kt', '.kts', '.swift', '.m', '.scala', '.dart', '.rs', '.php',
+}
+
+# one alternation, tried at each position: whichever of comment or string literal starts first wins
+_c_family_token = re.compile(r'''
+      (?P<line_comment>//[^\n]*)
+    | (?P<block_comment>/\*.*?(?:\*/|\Z))
+    | (?P<text_block>""".*?(?:"""|\Z))
+    | (?P<string>"(?:\\.|[^"\\\n])*"?)
+    | (?P<char>'(?:\\.|[^'\\\n])*'?)
+    | (?P<raw_string>`[^`]*`?)
+''', re.DOTALL | re.VERBOSE)
+
+_layout_tokens = (tokenize.NEWLINE, tokenize.NL, tokenize.INDENT, tokenize.DEDENT, tokenize.ENCODING)
+
+
+def remove_python_comments_and_docstrings(source):
+    out = []
+    prev_toktype = tokenize.INDENT
+    last_lineno = -1
+    last_col = 0
+    try:
+        for tok in tokenize.generate_tokens(io.StringIO(source).readline):
+            token_type = tok[0]
+            token_string = tok[1]
+            start_line, start_col = tok[2]
+            end_line, end_col = tok[3]
+            if start_line > last_lineno:
+                # a token on a new line without a newline token in between was continued with a backslash
+                if last_lineno > 0 and prev_toktype not in _layout_tokens and token_type not in _layout_tokens:
+                    out.append(" \\\n")
+                last_col = 0
+            if start_col > last_col:
+                out.append(" " * (start_col - last_col))
+            if token_type == tokenize.COMMENT:
+                pass
+            elif token_type == tokenize.STRING:
+                # a string that is a statement of its own is a docstring
+                if prev_toktype != tokenize.INDENT and prev_toktype != tokenize.NEWLINE and start_col > 0:
+                    out.append(token_string)
+            else:
+                out.append(token_string)
+            prev_toktype = token_type
+            last_col = end_col
+            last_lineno = end_line
+    except (tokenize.TokenError, SyntaxError):
+        # not valid Python (IndentationError is a SyntaxError), keep the file as submitted
+        return source
+    return '\n'.join(line for line in ''.join(out).splitlines() if line.strip())
+
+
+def _strip_c_family_match(match):
+    kind = match.lastgroup
+    if kind == 'line_comment':
+        return ''
+    if kind == 'block_comment':
+        # keep the tokens on either side apart, a/**/b must not become ab
+        return ' '
+    return match.group()
+
+
+def remove_c_family_comments(source):
+    return _c_family_token.sub(_strip_c_family_match, source)
+
+
+# the name the scripts used for the old two-regex version
+remove_java_comments = remove_c_family_comments
+
+
+def strippable(file_name):
+    suffix = os.path.splitext(file_name)[1].lower()
+    return suffix in python_extensions or suffix in c_family_extensions
+
+
+def strip_source(file_name, data):
+    # bytes in, bytes out; bytes that aren't valid UTF-8 survive the round trip through surrogateescape
+    suffix = os.path.splitext(file_name)[1].lower()
+    source = data.decode('utf-8', errors='surrogateescape')
+    if suffix in python_extensions:
+        source = remove_python_comments_and_docstrings(source)
+    elif suffix in c_family_extensions:
+        source = remove_c_family_comments(source)
+    else:
+        return data
+    return source.encode('utf-8', errors='surrogateescape')
+
+
+def strip_and_deflate(file_name, data):
+    # strip_source() and the compression both run in the worker, the writing thread only copies bytes
+    return deflate_bytes(strip_source(file_name, data))
+
+
+def strip_zip_members(source_path, destination_path, executor, max_pending=16, member_filter=None):
+    # Writes a copy of source_path with every supported member stripped on executor (a process pool),
+    # leaving out members member_filter (an archive_utils.MemberFilter) doesn't allow.
+    # Returns (bytes read from stripped members, bytes they were stripped to).
+    bytes_in = 0
+    bytes_out = 0
+    pending = deque()
+
+    def write_oldest():
+        nonlocal bytes_out
+        info, future = pending.popleft()
+        new_info = zipfile.ZipInfo(info.filename, date_time=info.date_time)
+        new_info.external_attr = info.external_attr
+        write_deflated_member(destination, new_info, future.result())
+        bytes_out += new_info.file_size
+
+    with zipfile.ZipFile(source_path) as source, zipfile.ZipFile(destination_path, 'w') as destination:
+        for info in source.infolist():
+            if member_filter is not None and not member_filter.allows(info):
+                continue
+            if info.is_dir() or not strippable(info.filename):
+                # copied right away, so stripped members can end up after members that came later in the source
+                copy_raw_member(source, info, destination, info.filename)
+                continue
+            data = source.read(info)
+            bytes_in += len(data)
+            pending.append((info, executor.submit(strip_and_deflate, info.filename, data)))
+            if len(pending) >= max_pending:
+                write_oldest()
+        while pending:
+            write_oldest()
+    return bytes_in, bytes_out
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        print("usage: python source_stripping.py <source zip> <destination zip>")
+        sys.exit(1)
+    start = perf_counter()
+    with ProcessPoolExecutor() as executor:
+        bytes_in, bytes_out = strip_zip_members(sys.argv[1], sys.argv[2], executor)
+    elapsed = perf_counter() - start
+    print(f"Stripped {bytes_in / 1e6:.1f} MB of source to {bytes_out / 1e6:.1f} MB in {elapsed:.1f} s "
+          f"({bytes_in / 1e6 / elapsed if elapsed else 0:.2f} MB/s)")
@@ -0,0 +1,207 @@
+'''
+SQLite catalog of every submitted file the scripts put into downloads.zip.
+
+One row per file: the LMS, course, assignment, anonymized id and grade that the
+archive names encode, plus the file's name, extension, size, sha256 and where it
+is in downloads.zip. The D2L scripts name files with the points the gradebook
+holds, Gradescope folders with the percentage of the assignment's "out of"
+score; grade_unit says which ('points' or 'percent') so queries don't compare
+the two. archive_member is the member of downloads.zip and
+inner_member the path inside it when that member is an assignment zip (the D2L
+scripts), or '' when the file is a member of its own (Gradescope). The columns
+queries filter on are indexed, so finding e.g. every Java file of a course with
+a grade above 90% doesn't touch the archive at all, and extract() then only
+opens the members that matched. With archive_format = 'tar.zst' the same file
+is <archive_member without .zip>/<inner_member> in downloads.tar.zst, which
+extract() doesn't read.
+
+Folio keeps the original names of files without a grade, student id and name
+included; the catalog leaves those out like the dataset export does. An
+assignment's rows are replaced in one transaction whenever it is downloaded
+again. Run this file to query the catalog and optionally extract the matches:
+    python submission_catalog.py downloads_catalog.sqlite "extension = '.java' AND course_name LIKE 'CSCI 1301%' AND grade_unit = 'percent' AND grade > 90"
+    python submission_catalog.py downloads_catalog.sqlite "assignment_id = '123456'" --extract selected/ --archive downloads.zip
+'''
+
+import argparse
+import hashlib
+import os
+import sqlite3
+import threading
+import zipfile
+
+_schema = '''
+CREATE TABLE IF NOT EXISTS submission_files (
+    lms TEXT NOT NULL,
+    course_id TEXT NOT NULL,
+    course_name TEXT,
+    assignment_id TEXT NOT NULL,
+    assignment_name TEXT,
+    anonymized_id INTEGER,
+    grade REAL,
+    grade_unit TEXT,
+    grade_text TEXT,
+    file_name TEXT NOT NULL,
+    extension TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    sha256 TEXT NOT NULL,
+    archive_member TEXT NOT NULL,
+    inner_member TEXT NOT NULL DEFAULT '',
+    PRIMARY KEY (archive_member, inner_member)
+);
+CREATE INDEX IF NOT EXISTS submission_files_assignment ON submission_files (lms, course_id, assignment_id);
+CREATE INDEX IF NOT EXISTS submission_files_course_name ON submission_files (course_name);
+CREATE INDEX IF NOT EXISTS submission_files_extension ON submission_files (extension, grade);
+CREATE INDEX IF NOT EXISTS submission_files_grade ON submission_files (grade);
+CREATE INDEX IF NOT EXISTS submission_files_anonymized_id ON submission_files (anonymized_id);
+CREATE INDEX IF NOT EXISTS submission_files_sha256 ON submission_files (sha256);
+'''
+
+_columns = ('anonymized_id', 'grade', 'grade_unit', 'grade_text', 'file_name', 'extension', 'size', 'sha256', 'archive_member', 'inner_member')
+hash_chunk_size = 1024 * 1024
+
+
+def grade_number(grade_text):
+    try:
+        return float(grade_text.rstrip('%'))
+    except (AttributeError, ValueError):
+        return None
+
+
+def parse_d2l_member_name(name):
+    # (anonymized id, grade text) from a renamed member, '85%---12---345---file.py' or Folio's '85---12---345---file.py'.
+    # Folio keeps the original name of files without a grade, those give (None, None)
+    parts = name.split('/')[0].split('---')
+    if len(parts) < 4 or not parts[1].isdigit():
+        return None, None
+    grade_text = parts[0].rstrip('%')
+    return int(parts[1]), None if grade_text == 'NA' else grade_text
+
+
+def parse_gradescope_folder_name(name):
+    # (anonymized id, grade text) from a submission folder named '<increasing_no>_<grade>%'
+    increasing_no, _, grade_text = name.partition('_')
+    if not increasing_no.isdigit():
+        return None, None
+    return int(increasing_no), grade_text.rstrip('%')
+
+
+def _sha256(file):
+    checksum = hashlib.sha256()
+    size = 0
+    for chunk in iter(lambda: file.read(hash_chunk_size), b''):
+        checksum.update(chunk)
+        size += len(chunk)
+    return checksum.hexdigest(), size
+
+
+def _row(anonymized_id, grade_text, grade_unit, path, sha256, size, archive_member, inner_member):
+    file_name = path.rsplit('/', 1)[-1]
+    return (anonymized_id, grade_number(grade_text), grade_unit, grade_text, file_name, os.path.splitext(file_name)[1].lower(),
+            size, sha256, archive_member, inner_member)
+
+
+def zip_member_rows(zip_path, archive_member):
+    # rows for every file of an assignment zip that went into downloads.zip as archive_member, members named by
+    # submission_member_name(); each member is inflated once to hash it. Members without an anonymized id are left out
+    rows = []
+    with zipfile.ZipFile(zip_path) as zipf:
+        for info in zipf.infolist():
+            if info.is_dir():
+                continue
+            anonymized_id, grade_text = parse_d2l_member_name(info.filename)
+            if anonymized_id is None:
+                continue
+            with zipf.open(info) as member:
+                sha256, size = _sha256(member)
+            rows.append(_row(anonymized_id, grade_text, 'points', info.filename, sha256, size, archive_member, info.filename))
+    return rows
+
+
+def folder_rows(folder_path, root_path):
+    # rows for every file under an assignment folder whose subfolders are named '<increasing_no>_<grade>%',
+    # archived under its path relative to root_path like IncrementalZipArchive.add_folder() names them
+    rows = []
+    for root, dirs, names in os.walk(folder_path):
+        dirs.sort()
+        submission_folder = os.path.relpath(root, folder_path).replace(os.sep, '/').split('/')[0]
+        anonymized_id, grade_text = parse_gradescope_folder_name(submission_folder)
+        for name in sorted(names):
+            file_path = os.path.join(root, name)
+            with open(file_path, 'rb') as file:
+                sha256, size = _sha256(file)
+            archive_member = os.path.relpath(file_path, root_path).replace(os.sep, '/')
+            rows.append(_row(anonymized_id, grade_text, 'percent', archive_member, sha256, size, archive_member, ''))
+    return rows
+
+
+class SubmissionCatalog:
+
+    def __init__(self, db_path, reset=False):
+        if reset and os.path.isfile(db_path):
+            os.remove(db_path)
+        # shared by the rewrite workers, the lock keeps their transactions apart
+        self.connection = sqlite3.connect(db_path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.connection:
+            self.connection.executescript(_schema)
+            # catalogs of earlier runs don't have grade_unit yet, their D2L rows are in points and Gradescope's in percent
+            if 'grade_unit' not in [column[1] for column in self.connection.execute('PRAGMA table_info(submission_files)')]:
+                self.connection.execute('ALTER TABLE submission_files ADD COLUMN grade_unit TEXT')
+                self.connection.execute("UPDATE submission_files SET grade_unit = CASE lms WHEN 'gradescope' THEN 'percent' ELSE 'points' END")
+
+    def replace_assignment(self, lms, course_id, course_name, assignment_id, assignment_name, rows):
+        # drops what an earlier download of the assignment left and inserts rows (from zip_member_rows() or folder_rows())
+        with self.lock, self.connection:
+            self.connection.execute('DELETE FROM submission_files WHERE lms = ? AND course_id = ? AND assignment_id = ?',
+                                    (lms, str(course_id), str(assignment_id)))
+            self.connection.executemany(
+                f'INSERT OR REPLACE INTO submission_files (lms, course_id, course_name, assignment_id, assignment_name, {", ".join(_columns)}) '
+                f'VALUES (?, ?, ?, ?, ?, {", ".join("?" for _ in _columns)})',
+                [(lms, str(course_id), course_name, str(assignment_id), assignment_name) + row for row in rows])
+
+    def query(self, where='1', parameters=()):
+        # rows as dicts, where is an SQL condition on the submission_files columns
+        with self.lock:
+            cursor = self.connection.execute(f'SELECT * FROM submission_files WHERE {where} ORDER BY archive_member, inner_member', parameters)
+            names = [description[0] for description in cursor.description]
+            return [dict(zip(names, row)) for row in cursor.fetchall()]
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+def extract(rows, archive_path, destination):
+    # writes the files of rows (from query()) out of downloads.zip, opening each assignment zip only once
+    by_member = {}
+    for row in rows:
+        by_member.setdefault(row['archive_member'], []).append(row['inner_member'])
+    with zipfile.ZipFile(archive_path) as archive:
+        for archive_member, inner_members in by_member.items():
+            if inner_members == ['']:
+                archive.extract(archive_member, destination)
+                continue
+            with archive.open(archive_member) as member, zipfile.ZipFile(member) as inner:
+                for inner_member in inner_members:
+                    inner.extract(inner_member, os.path.join(destination, os.path.splitext(archive_member)[0]))
+    return len(rows)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Query the submission catalog and extract the matching files.")
+    parser.add_argument('catalog', help="the downloads_catalog.sqlite a script wrote")
+    parser.add_argument('where', nargs='?', default='1', help="SQL condition on the submission_files columns")
+    parser.add_argument('--extract', metavar='FOLDER', help="extract the matching files into this folder")
+    parser.add_argument('--archive', default='downloads.zip', help="the archive the catalog describes")
+    options = parser.parse_args()
+
+    catalog = SubmissionCatalog(options.catalog)
+    rows = catalog.query(options.where)
+    catalog.close()
+    for row in rows:
+        print(f"{row['lms']}\t{row['course_name']}\t{row['assignment_id']}\t{row['anonymized_id']}\t{row['grade_text']}\t"
+              f"{row['size']}\t{row['archive_member']}{'!' + row['inner_member'] if row['inner_member'] else ''}")
+    print(f"{len(rows)} files")
+    if options.extract:
+        print(f"Extracted {extract(rows, options.archive, options.extract)} files to {options.extract}")
@@ -0,0 +1,111 @@
+'''
+Manifest of what earlier runs already downloaded, for incremental syncs.
+
+Every finished assignment is recorded under its course id and assignment id with
+the submission count the scripts read while listing assignments, a hash of the
+grades snapshot, and a checksum of the assignment's archive (or folder). On the
+next run an assignment whose count and grades are unchanged and whose archive is
+still on disk is skipped. The manifest also remembers the next anonymized id so
+ids stay unique across runs.
+'''
+
+import hashlib
+import json
+import os
+import threading
+
+
+class UniqueIdCounter:
+    # thread-safe replacement for itertools.count() whose position can be saved
+
+    def __init__(self, start=0):
+        self.value = start
+        self.lock = threading.Lock()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        with self.lock:
+            value = self.value
+            self.value += 1
+            return value
+
+
+def grade_snapshot_hash(grades):
+    # grades maps a student (id or name) to a grade; the hash doesn't depend on the order
+    snapshot = json.dumps(sorted((str(student), str(grade)) for student, grade in grades.items()))
+    return hashlib.sha256(snapshot.encode('utf-8')).hexdigest()
+
+
+def path_checksum(path):
+    # sha256 of a file, or of every file's relative path and contents for a folder
+    checksum = hashlib.sha256()
+    if os.path.isdir(path):
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for file in sorted(files):
+                file_path = os.path.join(root, file)
+                checksum.update(os.path.relpath(file_path, path).replace('\\', '/').encode('utf-8'))
+                checksum.update(bytes.fromhex(path_checksum(file_path)))
+        return checksum.hexdigest()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b''):
+            checksum.update(chunk)
+    return checksum.hexdigest()
+
+
+def path_size(path):
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(root, file)) for root, _, files in os.walk(path) for file in files)
+    return os.path.getsize(path)
+
+
+class SyncManifest:
+
+    def __init__(self, manifest_path, reset=False):
+        self.manifest_path = manifest_path
+        self.lock = threading.Lock()
+        data = {}
+        if not reset and os.path.isfile(manifest_path):
+            with open(manifest_path, 'r', encoding='utf-8') as file:
+                data = json.load(file)
+        self.assignments = data.get('assignments', {})
+        self.unique_ids = UniqueIdCounter(data.get('next_unique_id', 0))
+
+    @staticmethod
+    def key(course_id, assignment_id):
+        return f'{course_id}/{assignment_id}'
+
+    def is_unchanged(self, course_id, assignment_id, submission_count, grades_hash):
+        # the archive only has to still exist with the recorded size, re-hashing every archive would read the whole output
+        with self.lock:
+            entry = self.assignments.get(self.key(course_id, assignment_id))
+        if entry is None or submission_count is None:
+            return False
+        if entry['submission_count'] != submission_count or entry['grades_hash'] != grades_hash:
+            return False
+        return os.path.exists(entry['archive_path']) and path_size(entry['archive_path']) == entry['archive_size']
+
+    def record(self, course_id, assignment_id, submission_count, grades_hash, archive_path):
+        entry = {
+            'submission_count': submission_count,
+            'grades_hash': grades_hash,
+            'archive_path': str(archive_path),
+            'archive_size': path_size(archive_path),
+            'archive_checksum': path_checksum(archive_path),
+        }
+        with self.lock:
+            self.assignments[self.key(course_id, assignment_id)] = entry
+            self._write()
+
+    def save(self):
+        with self.lock:
+            self._write()
+
+    def _write(self):
+        # write a temporary file and swap it in, so a crash never leaves half a manifest
+        temp_path = f'{self.manifest_path}.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as file:
+            json.dump({'next_unique_id': self.unique_ids.value, 'assignments': self.assignments}, file, indent=1)
+        os.replace(temp_path, self.manifest_path)